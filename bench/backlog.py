@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Quanto o cliente leva para esvaziar um backlog grande ao voltar.
+
+Sobe um servidor local (o mesmo de loadgen.py), deixa --messages mensagens
+privadas de --senders remetentes na fila offline de um destinatário e então o
+destinatário conecta e busca tudo em páginas de fetch_blobs. As mensagens
+recebidas passam pelo pipeline de recepção do client.py (classificação no loop,
+open_all para decifrar, descomprimir e recifrar para o histórico, gravação no
+HistoryStore) duas vezes: abrindo tudo no próprio loop e no pool de threads.
+Para cada modo mede o tempo, mensagens/s e o maior atraso do event loop (o
+quanto a UI ficaria sem responder). O resultado sai em JSON.
+
+Exemplo:
+    python bench/backlog.py --messages 100000 --senders 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nacl.public import Box, PrivateKey
+
+from loadgen import LocalServer
+# loadgen põe a raiz do repositório no sys.path
+from client import (  # noqa: E402
+    DECRYPT_THREADS,
+    RECEIVE_BATCH,
+    KeyCache,
+    TLSSocketClient,
+    b64,
+    open_all,
+    pack_text,
+    ub64,
+)
+from history import open_history  # noqa: E402
+from wire import MAX_BATCH, blob_bytes  # noqa: E402
+
+
+async def fill_backlog(server, recipient, messages, senders, size, compress):
+    rpriv = PrivateKey.generate()
+    conn = TLSSocketClient("localhost", server.port, server.cafile)
+    await conn.login(recipient, rpriv)
+    await conn.close()  # offline daqui em diante: tudo vai para a fila
+
+    rng = random.Random(1)
+    words = [os.urandom(4).hex() for _ in range(256)]
+    per_sender = -(-messages // senders)
+    sent = 0
+    for i in range(senders):
+        priv = PrivateKey.generate()
+        conn = TLSSocketClient("localhost", server.port, server.cafile)
+        await conn.login(f"sender-{i}", priv)
+        box = Box(priv, rpriv.public_key)
+        count = min(per_sender, messages - sent)
+        batch = []
+        for _ in range(count):
+            text = " ".join(rng.choice(words) for _ in range(max(1, size // 9)))
+            data, meta = pack_text(text, compress)
+            envelope = {"sender_pub": b64(bytes(priv.public_key)), "blob": b64(box.encrypt(data))}
+            batch.append({"to": recipient, "blob": json.dumps(envelope).encode(), "meta": meta})
+            if len(batch) == MAX_BATCH:
+                await conn.send_recv({"type": "send_blobs", "messages": batch})
+                batch = []
+        if batch:
+            await conn.send_recv({"type": "send_blobs", "messages": batch})
+        sent += count
+        await conn.close()
+    return rpriv
+
+
+async def fetch_backlog(server, recipient, rpriv, page):
+    conn = TLSSocketClient("localhost", server.port, server.cafile)
+    await conn.login(recipient, rpriv)
+    messages = []
+    while True:
+        resp = await conn.send_recv({"type": "fetch_blobs", "client_id": recipient, "limit": page})
+        messages.extend(resp.get("messages", []))
+        if not resp.get("more"):
+            break
+    await conn.close()
+    return messages
+
+
+async def loop_lag(stop, interval=0.005):
+    # maior atraso visto por uma tarefa que só quer acordar a cada interval
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def receive(messages, rpriv, executor, batch):
+    # o mesmo caminho do interactive(): classificar, abrir em lote e gravar
+    keys = KeyCache(rpriv)
+    history = open_history()
+    for i in range(0, len(messages), batch):
+        jobs, received = [], []
+        for m in messages[i : i + batch]:
+            env = json.loads(blob_bytes(m["blob"]))
+            box = keys.box(env["sender_pub"])
+            jobs.append((box, ub64(env["blob"]), m.get("meta") or {}, m["from"]))
+            received.append(m)
+        results = await open_all(jobs, executor, history.seal)
+        failed = 0
+        for m, result in zip(received, results):
+            if result is None:
+                failed += 1
+                continue
+            text, kind, body = result
+            history.add(m["from"], m["from"], text, kind, m.get("ts"), body=body)
+        if failed:
+            raise RuntimeError(f"{failed} mensagens não abriram")
+    history.close()
+
+
+async def run_mode(messages, rpriv, executor, batch):
+    stop = asyncio.Event()
+    lag = asyncio.create_task(loop_lag(stop))
+    await asyncio.sleep(0)  # o medidor já está esperando quando a recepção começa
+    start = time.perf_counter()
+    await receive(messages, rpriv, executor, batch)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return {
+        "seconds": round(elapsed, 3),
+        "msgs_per_s": round(len(messages) / elapsed),
+        "max_loop_lag_ms": round(await lag * 1000, 2),
+    }
+
+
+async def amain(args):
+    server = LocalServer(
+        store=args.store, key_type="ecdsa", extra=["--queue-quota", str(args.messages + 1)]
+    )
+    await server.start()
+    try:
+        start = time.perf_counter()
+        rpriv = await fill_backlog(
+            server, "backlog", args.messages, args.senders, args.size, not args.no_compress
+        )
+        fill = time.perf_counter() - start
+        start = time.perf_counter()
+        messages = await fetch_backlog(server, "backlog", rpriv, args.page)
+        fetch = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    threads = args.threads or DECRYPT_THREADS
+    report = {
+        "messages": len(messages),
+        "senders": args.senders,
+        "size": args.size,
+        "cpus": os.cpu_count(),
+        "threads": threads,
+        "fill_s": round(fill, 3),
+        "fetch_s": round(fetch, 3),
+        "receive": {"inline": await run_mode(messages, rpriv, None, args.batch)},
+    }
+    with ThreadPoolExecutor(threads) as executor:
+        report["receive"]["pool"] = await run_mode(messages, rpriv, executor, args.batch)
+    return report
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--senders", type=int, default=50)
+    p.add_argument("--size", type=int, default=200, help="tamanho aproximado do texto")
+    p.add_argument("--no-compress", action="store_true")
+    p.add_argument("--page", type=int, default=500, help="limit de cada fetch_blobs")
+    p.add_argument(
+        "--batch",
+        type=int,
+        default=RECEIVE_BATCH,
+        help="mensagens por lote do pipeline (o receive_loop junta as páginas que esperam)",
+    )
+    p.add_argument("--threads", type=int, help="padrão: DECRYPT_THREADS do client.py")
+    p.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    p.add_argument("--output", help="grava o JSON neste arquivo")
+    args = p.parse_args()
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
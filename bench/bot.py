@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Vazão do ChatClient: dois bots trocando mensagens privadas numa conexão cada.
+
+Sobe um servidor local (o mesmo de loadgen.py), conecta um bot remetente e um
+destinatário com o ChatClient do client.py e o remetente dispara --messages
+mensagens com send() sem esperar as respostas, como um bot ou integração faria.
+Mede quanto leva até todas serem confirmadas (on_ack) e até o destinatário ter
+lido todas pelo iterador, em dois modos: "single" (a outbox manda um send_blob
+por mensagem, max_batch=1) e "coalesce" (as que esperam juntas na fila vão num
+send_blobs). O resultado sai em JSON.
+
+Exemplo:
+    python bench/bot.py --messages 20000 --transport tls
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from loadgen import LocalServer
+# loadgen põe a raiz do repositório no sys.path
+from client import ChatClient  # noqa: E402
+from wire import MAX_BATCH  # noqa: E402
+
+
+async def run_mode(server, args, max_batch, mode):
+    websocket = args.transport == "wss"
+    port = server.ws_port if websocket else server.port
+    receiver = ChatClient("localhost", port, server.cafile, f"rx-{mode}", websocket=websocket)
+    sender = ChatClient("localhost", port, server.cafile, f"tx-{mode}", websocket=websocket)
+    for chat in (receiver, sender):
+        resp = await chat.connect()
+        if resp.get("status") != "ok":
+            raise RuntimeError(f"login falhou: {resp}")
+    sender.outbox.max_batch = max_batch
+
+    failed = []
+    acked = asyncio.Event()
+    count = {"acks": 0}
+
+    def on_ack(tag, resp):
+        count["acks"] += 1
+        if resp.get("status") != "ok":
+            failed.append(resp.get("reason"))
+        if count["acks"] == args.messages:
+            acked.set()
+
+    sender.on_ack = on_ack
+    text = "x" * args.size
+
+    async def read_all():
+        received = 0
+        async for msg in receiver:
+            received += 1
+            if received == args.messages:
+                return
+
+    reader = asyncio.create_task(read_all())
+    start = time.perf_counter()
+    for i in range(args.messages):
+        msg, err = await sender.send(receiver.client_id, text, tag=i)
+        if msg is None:
+            raise RuntimeError(f"envio falhou: {err}")
+    await acked.wait()
+    acked_s = time.perf_counter() - start
+    await asyncio.wait_for(reader, args.timeout)
+    received_s = time.perf_counter() - start
+    await sender.close()
+    await receiver.close()
+    return {
+        "acked_s": round(acked_s, 3),
+        "received_s": round(received_s, 3),
+        "msgs_per_s": round(args.messages / received_s),
+        "failed": len(failed),
+    }
+
+
+async def amain(args):
+    server = LocalServer(
+        store=args.store, key_type="ecdsa", extra=["--queue-quota", str(args.messages + 1)]
+    )
+    await server.start()
+    try:
+        report = {
+            "messages": args.messages,
+            "size": args.size,
+            "transport": args.transport,
+            "cpus": os.cpu_count(),
+            "modes": {},
+        }
+        for mode, max_batch in (("single", 1), ("coalesce", MAX_BATCH)):
+            report["modes"][mode] = await run_mode(server, args, max_batch, mode)
+    finally:
+        server.stop()
+    return report
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--size", type=int, default=100, help="tamanho do texto de cada mensagem")
+    p.add_argument("--transport", choices=("tls", "wss"), default="tls")
+    p.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    p.add_argument("--timeout", type=float, default=120, help="espera pelo destinatário")
+    p.add_argument("--output", help="grava o JSON neste arquivo")
+    args = p.parse_args()
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
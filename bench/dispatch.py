@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Micro-benchmark do despacho de mensagens do servidor.
+
+Alimenta handle_reader com pedidos já serializados, por um StreamReader em
+memória e um writer falso: sem TLS, sem socket e sem log, sobra só o custo de
+ler, decodificar, validar e despachar cada pedido (mais o trabalho do próprio
+handler, que é o mesmo antes e depois). O resultado é o tempo médio por pedido,
+por tipo e por framing, em JSON.
+
+Para comparar com uma versão anterior do servidor, aponte --root para outra
+cópia do repositório, por exemplo:
+    git worktree add /tmp/antes HEAD~1
+    python bench/dispatch.py --root /tmp/antes > antes.json
+    python bench/dispatch.py > depois.json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from nacl.public import Box, PrivateKey, PublicKey
+
+
+class NullWriter:
+    # faz também o papel do transport (limites do buffer de escrita)
+    def __init__(self):
+        self.written = 0
+        self.transport = self
+        self.reply = None
+        self.expect()  # a resposta do hello
+
+    def expect(self):
+        # a próxima escrita (a resposta de um pedido) vai para self.reply
+        self.reply = asyncio.get_running_loop().create_future()
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write(self, data):
+        self.written += len(data)
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return ("bench", 0) if name == "peername" else default
+
+
+def load_server(root):
+    root = Path(root).resolve()
+    sys.path[:0] = [str(root / "server"), str(root)]
+    spec = importlib.util.spec_from_file_location("chat_server", root / "server" / "server.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def workload(blob_size, pubkey):
+    # a sessão é de c0 (membro do grupo "g"); publish_key republica a mesma chave
+    blob = os.urandom(blob_size)
+    return {
+        "publish_key": lambda i: {"type": "publish_key", "client_id": "c0", "pubkey": pubkey},
+        "get_key": lambda i: {"type": "get_key", "client_id": f"c{i % 100}"},
+        "send_blob": lambda i: {"type": "send_blob", "to": f"c{i % 100}", "from": "c0", "blob": blob},
+        "send_group_blob": lambda i: {"type": "send_group_blob", "group_id": "g", "from": "c0", "blob": blob},
+        "fetch_blobs": lambda i: {"type": "fetch_blobs", "client_id": f"c{i % 100}"},
+        "unknown": lambda i: {"type": "nao_existe", "blob": blob},
+    }
+
+
+def login(hello, priv):
+    # publish_key com a prova do desafio do hello (servidores com sessão)
+    proof = Box(priv, PublicKey(base64.b64decode(hello["server_pub"]))).encrypt(
+        base64.b64decode(hello["challenge"])
+    )
+    pubkey = base64.b64encode(bytes(priv.public_key)).decode()
+    return {"type": "publish_key", "client_id": "c0", "pubkey": pubkey, "proof": proof}
+
+
+async def run_case(server, wire, proto, make, count, priv):
+    reader = asyncio.StreamReader(limit=wire.MAX_FRAME)
+    writer = NullWriter()
+    task = asyncio.create_task(server.handle_reader(reader, writer))
+    # o hello vai antes, fora da medição: a resposta traz o desafio da sessão
+    reader.feed_data(wire.encode_json({"type": "hello", "proto": proto, "req_id": 1}))
+    hello = json.loads(await writer.reply)
+    binary = proto == wire.PROTO_BINARY
+    encode = wire.encode_frame if binary else wire.encode_json
+    if "challenge" in hello:
+        # o login também fica fora da medição, e precisa dar certo: sem a sessão,
+        # todo pedido seguinte seria só a recusa
+        writer.expect()
+        reader.feed_data(encode({**login(hello, priv), "req_id": 2}))
+        reply = await writer.reply
+        resp = wire.decode_frame(reply[4:]) if binary else json.loads(reply)
+        if resp.get("status") != "ok":
+            raise RuntimeError(f"login falhou: {resp}")
+    chunks = []
+    for i in range(count):
+        chunks.append(encode({**make(i), "req_id": i + 3}))
+    start = time.perf_counter()
+    reader.feed_data(b"".join(chunks))
+    reader.feed_eof()
+    await task
+    return (time.perf_counter() - start) / count
+
+
+def reset_state(server, pubkey):
+    # estado mínimo: 100 chaves e um grupo com 10 membros, fila offline em memória
+    # nova a cada execução, para as filas não crescerem de um caso para o outro.
+    # c0, o da sessão, tem a chave de verdade: o servidor não aceita trocar a de
+    # um id registrado sem a prova da anterior
+    for i in range(100):
+        server.PUBLIC_KEYS[f"c{i}"] = "QUJD"
+    server.PUBLIC_KEYS["c0"] = pubkey
+    server.BLOBS = type(server.BLOBS)()
+    group = {"members": [f"c{i}" for i in range(10)], "admin": "c0"}
+    server.BLOBS.add_group("g", group)
+    server.register_group("g", group)
+    if hasattr(server, "set_limits"):
+        # taxa alta o bastante para nunca recusar, mas o token bucket é consultado
+        server.set_limits(server.Limits(rate=1e9, burst=10**9))
+
+
+async def amain(args):
+    server = load_server(args.root)
+    import wire
+
+    priv = PrivateKey.generate()
+    pubkey = base64.b64encode(bytes(priv.public_key)).decode()
+    results = {}
+    for proto in ("json", wire.PROTO_BINARY):
+        for name, make in workload(args.blob_size, pubkey).items():
+            samples = []
+            for _ in range(args.repeat):
+                reset_state(server, pubkey)
+                samples.append(
+                    await run_case(server, wire, proto, make, args.requests, priv)
+                )
+            results.setdefault(proto, {})[name] = {"us_per_request": round(min(samples) * 1e6, 2)}
+    return {
+        "root": str(Path(args.root).resolve()),
+        "requests": args.requests,
+        "repeat": args.repeat,
+        "blob_size": args.blob_size,
+        "results": results,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description="Custo de despacho por pedido em handle_reader")
+    p.add_argument("--root", default=str(Path(__file__).resolve().parent.parent))
+    p.add_argument("--requests", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=5, help="execuções por caso; vale a mais rápida")
+    p.add_argument("--blob-size", type=int, default=4096)
+    args = p.parse_args()
+    # versões antigas do servidor usam print em cada pedido
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = asyncio.run(amain(args))
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Handshakes TLS por segundo: RSA-2048 x ECDSA P-256, completo x retomado.
+
+Para cada tipo de certificado sobe um servidor local (o mesmo de loadgen.py) e
+mede o estabelecimento de conexões do TLSSocketClient (TCP + TLS + hello):
+no modo "full" cada conexão usa um cliente novo, sem sessão guardada; no modo
+"resumed" cada cliente conecta uma vez fora da medição e depois reconecta com
+a sessão TLS da conexão anterior. Mede também o tempo de CPU que o servidor
+gastou por handshake. O resultado sai em JSON.
+
+Exemplo:
+    python bench/handshake.py --connections 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from loadgen import LocalServer, percentiles, raise_fd_limit
+from client import TLSSocketClient  # loadgen põe a raiz do repositório no sys.path
+
+
+def cpu_seconds(pid):
+    # utime + stime do processo; só Linux
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_mode(server, mode, connections, concurrency, timeout):
+    resume = mode == "resumed"
+    clients = [
+        TLSSocketClient("localhost", server.port, server.cafile, timeout=timeout, resume=resume)
+        for _ in range(concurrency)
+    ]
+    if resume:
+        # a primeira conexão de cada cliente é completa e só serve para ter a sessão
+        for c in clients:
+            await c._connect()
+            await c.close()
+    times = []
+    reused = 0
+    per_client = connections // concurrency
+
+    async def loop(c):
+        nonlocal reused
+        for _ in range(per_client):
+            if not resume:
+                c._sslctx = None  # contexto novo: nenhuma sessão em cache
+            start = time.perf_counter()
+            await c._connect()
+            times.append(time.perf_counter() - start)
+            reused += c.resumed
+            await c.close()
+
+    cpu_before = cpu_seconds(server.proc.pid)
+    start = time.perf_counter()
+    await asyncio.gather(*(loop(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    cpu_after = cpu_seconds(server.proc.pid)
+    result = {
+        **percentiles(times),
+        "elapsed_s": round(elapsed, 3),
+        "per_s": round(len(times) / elapsed, 1) if elapsed else 0,
+        "resumed": reused,
+    }
+    if cpu_before is not None and cpu_after is not None and times:
+        result["server_cpu_ms_per_handshake"] = round(
+            (cpu_after - cpu_before) / len(times) * 1000, 3
+        )
+    return result
+
+
+async def amain(args):
+    raise_fd_limit()
+    results = {}
+    for key_type in args.key_types:
+        server = LocalServer(key_type=key_type)
+        try:
+            await server.start()
+            for mode in ("full", "resumed"):
+                results.setdefault(key_type, {})[mode] = await run_mode(
+                    server, mode, args.connections, args.concurrency, args.timeout
+                )
+        finally:
+            server.stop()
+    return {
+        "connections": args.connections,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description="Handshakes TLS por segundo por modo")
+    p.add_argument("--connections", type=int, default=1000, help="conexões medidas por modo")
+    p.add_argument("--concurrency", type=int, default=16, help="conexões abertas ao mesmo tempo")
+    p.add_argument(
+        "--key-types",
+        nargs="+",
+        choices=["rsa", "ecdsa"],
+        default=["rsa", "ecdsa"],
+    )
+    p.add_argument("--timeout", type=float, default=30.0)
+    p.add_argument("--output", help="grava o relatório JSON neste arquivo")
+    args = p.parse_args()
+    args.concurrency = max(1, min(args.concurrency, args.connections))
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""Gerador de carga para o servidor de chat.
+
+Simula muitos clientes usando o próprio TLSSocketClient e as mesmas mensagens do
+cliente interativo (publish_key, get_key, send_blob, send_group_blob,
+fetch_blobs), numa mistura configurável. Mede vazão, latência (p50/p99/p999) por
+tipo de requisição, custo do handshake TLS, crescimento de memória do servidor e
+o tempo de fan-out de mensagens de grupo. O resultado sai em JSON com chaves
+ordenadas, para comparar execuções com diff.
+
+Exemplos:
+    python bench/loadgen.py --spawn --clients 2000 --duration 30
+    python bench/loadgen.py --server 127.0.0.1:4433 --cacert cert.pem --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from nacl.public import PrivateKey
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from client import TLSSocketClient, WebSocketClient  # noqa: E402
+
+DEFAULT_MIX = "publish_key=1,get_key=4,send_blob=4,send_group_blob=1,fetch_blobs=2"
+OPS = ("publish_key", "get_key", "send_blob", "send_group_blob", "fetch_blobs")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPS:
+            raise argparse.ArgumentTypeError(f"operação desconhecida: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("a mistura precisa de algum peso positivo")
+    return mix
+
+
+def percentiles(samples):
+    # em milissegundos, pelo método nearest-rank
+    if not samples:
+        return {"count": 0}
+    data = sorted(samples)
+    n = len(data)
+
+    def rank(p):
+        return round(data[min(n - 1, max(0, int(p * n + 0.999999) - 1))] * 1000, 3)
+
+    return {
+        "count": n,
+        "mean_ms": round(sum(data) / n * 1000, 3),
+        "p50_ms": rank(0.50),
+        "p99_ms": rank(0.99),
+        "p999_ms": rank(0.999),
+        "max_ms": round(data[-1] * 1000, 3),
+    }
+
+
+def rss_kb(pid):
+    # RSS do processo e de todos os descendentes (modo --workers); só Linux
+    total = 0
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                todo.extend(int(c) for c in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def raise_fd_limit():
+    # milhares de conexões precisam de mais descritores que o padrão de 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalServer:
+    # servidor descartável num diretório temporário, com certificado gerado por
+    # server/generate_cert.py (key_type "rsa" ou "ecdsa"); extra vai para a linha
+    # de comando do servidor
+    def __init__(self, workers=1, store="memory", log=None, key_type="rsa", extra=()):
+        self.workers = workers
+        self.extra = list(extra)
+        self.key_type = key_type
+        self.store = store
+        self.log = log
+        self.dir = tempfile.TemporaryDirectory(prefix="chat-bench-")
+        self.port = free_port()
+        self.ws_port = free_port()  # gateway WebSocket, com o mesmo estado
+        self.proc = None
+
+    @property
+    def cafile(self):
+        return os.path.join(self.dir.name, "cert.pem")
+
+    async def start(self):
+        subprocess.run(
+            [sys.executable, str(ROOT / "server" / "generate_cert.py"), "--key-type", self.key_type],
+            cwd=self.dir.name,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        out = open(self.log, "w") if self.log else subprocess.DEVNULL
+        self.proc = subprocess.Popen(
+            [
+                sys.executable,
+                str(ROOT / "server" / "server.py"),
+                "cert.pem",
+                "key.pem",
+                "--host", "127.0.0.1",
+                "--port", str(self.port),
+                "--ws-port", str(self.ws_port),
+                "--store", self.store,
+                "--workers", str(self.workers),
+                # a carga vem toda de uma máquina: sem limite de taxa e de conexões
+                "--rate", "0",
+                "--max-connections", "0",
+                *self.extra,
+            ],
+            cwd=self.dir.name,
+            stdout=out,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"o servidor terminou com código {self.proc.returncode}")
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("o servidor não começou a escutar a tempo")
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(2)  # SIGINT, o mesmo que Ctrl+C
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.dir.cleanup()
+
+
+class SimClient:
+    def __init__(self, client_id, host, port, cafile, timeout, binary=True, websocket=False):
+        self.client_id = client_id
+        transport = WebSocketClient if websocket else TLSSocketClient
+        self.conn = transport(host, port, cafile, timeout=timeout, binary=binary)
+        self.conn.on_push = self.on_push
+        self.priv = PrivateKey.generate()
+        self._publish = (None, None)  # (desafio, publish_key com a prova) da conexão
+        self.group_id = None
+        self.on_group = None  # callback(group_id, blob) usado pela medição de fan-out
+
+    def on_push(self, frame):
+        if frame.get("type") != "deliver" or self.on_group is None:
+            return
+        for m in frame.get("messages", []):
+            if m.get("type") == "group":
+                self.on_group(m["group_id"], m["blob"])
+
+    def publish_request(self):
+        # a prova vale para a conexão inteira: calculada uma vez por desafio
+        challenge, msg = self._publish
+        if msg is None or challenge != self.conn.challenge:
+            msg = self.conn.publish_request(self.client_id, self.priv)
+            self._publish = (self.conn.challenge, msg)
+        return msg
+
+    async def connect(self):
+        # só o estabelecimento da conexão: TCP + handshake TLS + negociação
+        start = time.perf_counter()
+        await self.conn._connect()
+        return time.perf_counter() - start
+
+
+class LoadGen:
+    def __init__(self, args, host, port, cafile, server_pid=None):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.cafile = cafile
+        self.server_pid = server_pid
+        self.run_id = os.urandom(3).hex()
+        self.clients = []
+        self.latencies = {op: [] for op in OPS}
+        self.errors = {op: 0 for op in OPS}
+        self.error_reasons = {}
+        self.rng = random.Random(args.seed)
+        self.blob = os.urandom(args.blob_size)
+
+    def record(self, op, started, resp):
+        self.latencies[op].append(time.perf_counter() - started)
+        if resp.get("status") != "ok":
+            self.errors[op] += 1
+            reason = str(resp.get("reason"))
+            self.error_reasons[reason] = self.error_reasons.get(reason, 0) + 1
+
+    async def setup(self):
+        args = self.args
+        self.clients = [
+            SimClient(
+                f"bench-{self.run_id}-{i}",
+                self.host,
+                self.port,
+                self.cafile,
+                args.timeout,
+                binary=not args.json_proto,
+                websocket=args.websocket,
+            )
+            for i in range(args.clients)
+        ]
+        # conexões abertas em levas, para medir o handshake e não o backlog do accept
+        sem = asyncio.Semaphore(args.connect_concurrency)
+        handshakes = []
+
+        async def open_one(sim):
+            async with sem:
+                try:
+                    handshakes.append(await sim.connect())
+                except OSError as e:
+                    reason = f"connect: {e}"
+                    self.error_reasons[reason] = self.error_reasons.get(reason, 0) + 1
+                    return
+                await sim.conn.login(sim.client_id, sim.priv)
+                await sim.conn.send_recv({"type": "subscribe", "client_id": sim.client_id})
+
+        start = time.perf_counter()
+        await asyncio.gather(*(open_one(sim) for sim in self.clients))
+        connect_time = time.perf_counter() - start
+        self.clients = [sim for sim in self.clients if sim.conn.connected]
+        if not self.clients:
+            raise RuntimeError("nenhum cliente conseguiu conectar")
+
+        # grupos de --group-size membros, usados por send_group_blob na mistura
+        size = max(2, args.group_size)
+        for k in range(0, len(self.clients), size):
+            members = self.clients[k : k + size]
+            if len(members) < 2:
+                members[0].group_id = self.clients[0].group_id
+                continue
+            group_id = f"bench-{self.run_id}-g{k // size}"
+            await members[0].conn.send_recv(
+                {
+                    "type": "create_group",
+                    "group_id": group_id,
+                    "members": [m.client_id for m in members],
+                    "admin": members[0].client_id,
+                }
+            )
+            for m in members:
+                m.group_id = group_id
+        return handshakes, connect_time
+
+    def request_for(self, op, sim):
+        if op == "publish_key":
+            return sim.publish_request()
+        if op == "get_key":
+            peer = self.rng.choice(self.clients)
+            return {"type": "get_key", "client_id": peer.client_id}
+        if op == "send_blob":
+            peer = self.rng.choice(self.clients)
+            return {"type": "send_blob", "to": peer.client_id, "from": sim.client_id, "blob": self.blob}
+        if op == "send_group_blob":
+            return {
+                "type": "send_group_blob",
+                "group_id": sim.group_id,
+                "from": sim.client_id,
+                "blob": self.blob,
+            }
+        return {"type": "fetch_blobs", "client_id": sim.client_id}
+
+    async def run_load(self):
+        args = self.args
+        ops = list(args.mix)
+        weights = [args.mix[op] for op in ops]
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(sim):
+            while time.perf_counter() < deadline:
+                op = self.rng.choices(ops, weights)[0]
+                req = self.request_for(op, sim)
+                started = time.perf_counter()
+                resp = await sim.conn.send_recv(req)
+                self.record(op, started, resp)
+                if args.think_time:
+                    await asyncio.sleep(self.rng.expovariate(1 / args.think_time))
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(worker(sim) for sim in self.clients for _ in range(args.inflight))
+        )
+        return time.perf_counter() - start
+
+    async def run_fanout(self):
+        # um membro envia, e mede-se até o push chegar ao primeiro e ao último membro
+        args = self.args
+        members = self.clients[: args.fanout_size]
+        if len(members) < 2 or not args.fanout_rounds:
+            return None
+        group_id = f"bench-{self.run_id}-fanout"
+        sender = members[0]
+        resp = await sender.conn.send_recv(
+            {
+                "type": "create_group",
+                "group_id": group_id,
+                "members": [m.client_id for m in members],
+                "admin": sender.client_id,
+            }
+        )
+        if resp.get("status") != "ok":
+            return {"error": resp.get("reason")}
+
+        expected = len(members) - 1
+        state = {}
+
+        def on_group(gid, blob):
+            if gid != group_id or state.get("marker") not in (blob, None):
+                return
+            state["arrivals"].append(time.perf_counter())
+            if len(state["arrivals"]) == expected:
+                state["done"].set()
+
+        for m in members:
+            m.on_group = on_group
+        first, last, timeouts = [], [], 0
+        for round_no in range(args.fanout_rounds):
+            marker = b"fanout-%d-" % round_no + self.blob
+            state.update(marker=marker, arrivals=[], done=asyncio.Event())
+            started = time.perf_counter()
+            await sender.conn.send_recv(
+                {"type": "send_group_blob", "group_id": group_id, "from": sender.client_id, "blob": marker}
+            )
+            try:
+                await asyncio.wait_for(state["done"].wait(), args.timeout)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                continue
+            first.append(state["arrivals"][0] - started)
+            last.append(state["arrivals"][-1] - started)
+        for m in members:
+            m.on_group = None
+        return {
+            "members": len(members),
+            "rounds": args.fanout_rounds,
+            "timeouts": timeouts,
+            "first_delivery": percentiles(first),
+            "last_delivery": percentiles(last),
+        }
+
+    async def run(self):
+        args = self.args
+        rss_before = rss_kb(self.server_pid) if self.server_pid else None
+        handshakes, connect_time = await self.setup()
+        rss_connected = rss_kb(self.server_pid) if self.server_pid else None
+        elapsed = await self.run_load()
+        rss_after_load = rss_kb(self.server_pid) if self.server_pid else None
+        fanout = await self.run_fanout()
+        await asyncio.gather(*(sim.conn.close() for sim in self.clients))
+
+        total = sum(len(v) for v in self.latencies.values())
+        everything = [x for v in self.latencies.values() for x in v]
+        report = {
+            "config": {
+                "clients": args.clients,
+                "connected": len(self.clients),
+                "duration_s": args.duration,
+                "inflight": args.inflight,
+                "mix": args.mix,
+                "blob_size": args.blob_size,
+                "group_size": args.group_size,
+                "binary": not args.json_proto,
+                "transport": "websocket" if args.websocket else "tls",
+                "seed": args.seed,
+            },
+            "throughput": {
+                "requests": total,
+                "errors": sum(self.errors.values()),
+                "elapsed_s": round(elapsed, 3),
+                "req_per_s": round(total / elapsed, 1) if elapsed else 0,
+            },
+            "latency": {
+                "all": percentiles(everything),
+                **{
+                    op: {**percentiles(self.latencies[op]), "errors": self.errors[op]}
+                    for op in OPS
+                    if op in args.mix
+                },
+            },
+            "tls_handshake": {
+                **percentiles(handshakes),
+                "connect_all_s": round(connect_time, 3),
+                "per_s": round(len(handshakes) / connect_time, 1) if connect_time else 0,
+            },
+            "group_fanout": fanout,
+            "memory_kb": {
+                "server_before": rss_before,
+                "server_connected": rss_connected,
+                "server_after_load": rss_after_load,
+                "server_growth": (
+                    rss_after_load - rss_before if rss_before is not None else None
+                ),
+                "per_client": (
+                    round((rss_connected - rss_before) / len(self.clients), 2)
+                    if rss_before is not None
+                    else None
+                ),
+                "loadgen_maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+            "error_reasons": self.error_reasons,
+        }
+        return report
+
+
+async def amain(args):
+    raise_fd_limit()
+    server = None
+    try:
+        if args.spawn:
+            server = LocalServer(args.workers, args.store, args.server_log, args.key_type)
+            await server.start()
+            # o certificado de generate_cert.py é emitido para "localhost"
+            port = server.ws_port if args.websocket else server.port
+            host, cafile, pid = "localhost", server.cafile, server.proc.pid
+        else:
+            host, port = args.server.rsplit(":", 1)
+            port, cafile, pid = int(port), args.cacert, args.server_pid
+        gen = LoadGen(args, host, port, cafile, pid)
+        return await gen.run()
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Gerador de carga para o servidor de chat")
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument("--server", help="host:porta de um servidor já rodando")
+    target.add_argument(
+        "--spawn", action="store_true", help="sobe um servidor local com certificado novo"
+    )
+    p.add_argument("--cacert", help="certificado do servidor (com --server)")
+    p.add_argument("--server-pid", type=int, help="pid do servidor, para medir memória")
+    p.add_argument("--workers", type=int, default=1, help="--workers do servidor (com --spawn)")
+    p.add_argument("--store", choices=["sqlite", "memory"], default="memory")
+    p.add_argument("--server-log", help="arquivo para a saída do servidor (com --spawn)")
+    p.add_argument(
+        "--key-type", choices=["rsa", "ecdsa"], default="rsa", help="certificado (com --spawn)"
+    )
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--duration", type=float, default=10.0, help="segundos de carga")
+    p.add_argument("--inflight", type=int, default=1, help="requisições em voo por cliente")
+    p.add_argument("--think-time", type=float, default=0.0, help="pausa média entre requisições (s)")
+    p.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    p.add_argument("--blob-size", type=int, default=256)
+    p.add_argument("--group-size", type=int, default=10)
+    p.add_argument("--fanout-size", type=int, default=100)
+    p.add_argument("--fanout-rounds", type=int, default=20)
+    p.add_argument("--connect-concurrency", type=int, default=16)
+    p.add_argument("--timeout", type=float, default=30.0)
+    p.add_argument("--json-proto", action="store_true", help="usa o protocolo JSON por linha")
+    p.add_argument(
+        "--websocket",
+        action="store_true",
+        help="conecta pelo gateway WebSocket (com --server, a porta do --ws-port)",
+    )
+    p.add_argument("--seed", type=int)
+    p.add_argument("--output", help="grava o relatório JSON neste arquivo")
+    return p
+
+
+def main():
+    args = build_parser().parse_args()
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
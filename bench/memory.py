@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Memória por mensagem na fila offline em memória (MemoryStore), com tracemalloc.
+
+Enfileira --messages mensagens de --size bytes de ciphertext e mede quanto a
+fila retém por mensagem em dois formatos: "dict" (o item do jeito que chega ao
+store, um dict por mensagem, como o MemoryStore guardava antes) e "queued" (o
+registro Queued de server/storage.py). Os itens são montados como no servidor:
+no cenário "worker" o remetente é a mesma string da sessão; no "broker" cada
+item sai de um frame do cluster decodificado, com strings novas a cada um. O
+cenário "group" mede o log de um grupo (append_group). O resultado sai em JSON;
+"overhead" é o que sobra por mensagem além do ciphertext.
+
+Exemplo:
+    python bench/memory.py --messages 1000000 --size 100
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "server"))
+from storage import MemoryStore  # noqa: E402
+from wire import decode_frame, encode_frame  # noqa: E402
+
+
+def worker_items(count, size, senders, recipients):
+    # como on_send_blob monta: o remetente é conn.client_id, o mesmo objeto
+    names = [f"user-{i}" for i in range(senders)]
+    for i in range(count):
+        item = {"from": names[i % senders], "blob": os.urandom(size), "meta": {}}
+        yield f"user-{i % recipients}", item
+
+
+def broker_items(count, size, senders, recipients):
+    # o broker recebe {"op": "store", "to", "item"} de um worker pelo cluster e o
+    # decode_body faz json.loads do corpo: strings e dicts novos em cada item. O
+    # frame inteiro só é decodificado uma vez, para conferir o formato (sob o
+    # tracemalloc o decode_frame custa ~10x mais e não muda o que fica retido)
+    sample = {"from": "user-0", "blob": b"x" * size, "meta": {}}
+    frame = encode_frame({"op": "store", "to": "user-0", "item": sample})
+    assert decode_frame(frame[4:])["item"] == sample
+    for i in range(count):
+        item = json.loads(f'{{"from":"user-{i % senders}","meta":{{}}}}')
+        item["blob"] = os.urandom(size)
+        yield f"user-{i % recipients}", item
+
+
+def group_items(count, size, senders, recipients):
+    names = [f"user-{i}" for i in range(senders)]
+    for i in range(count):
+        item = {"from": names[i % senders], "blob": os.urandom(size)}
+        yield "bench", {**item, "group_id": "bench", "type": "group"}
+
+
+class DictStore:
+    # o formato anterior: os dicts dos itens, numa deque por destinatário
+    def __init__(self):
+        self._queues = {}
+
+    def append(self, recipient, item):
+        self._queues.setdefault(recipient, deque()).append(item)
+
+    def append_group(self, group_id, item):
+        self.append(group_id, item)
+
+
+class QueuedStore(MemoryStore):
+    def append_group(self, group_id, item):
+        if group_id not in self._groups:
+            self.add_group(group_id, {"members": [], "admin": None})
+        return super().append_group(group_id, item)
+
+
+SCENARIOS = {"worker": worker_items, "broker": broker_items, "group": group_items}
+
+
+def measure(store_cls, scenario, count, size, senders, recipients):
+    gc.collect()
+    start_mem = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    store = store_cls()
+    append = store.append_group if scenario == "group" else store.append
+    for key, item in SCENARIOS[scenario](count, size, senders, recipients):
+        append(key, item)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - start_mem
+    del store
+    gc.collect()
+    return {
+        "bytes_per_message": round(held / count, 1),
+        "overhead": round(held / count - size, 1),
+        "total_mb": round(held / 2**20, 1),
+        "seconds": round(elapsed, 2),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--messages", type=int, default=1000000)
+    p.add_argument("--size", type=int, default=100, help="bytes de ciphertext por mensagem")
+    p.add_argument("--senders", type=int, default=1000)
+    p.add_argument("--recipients", type=int, default=1000)
+    p.add_argument("--scenario", choices=sorted(SCENARIOS), action="append")
+    p.add_argument("--output", help="grava o JSON neste arquivo")
+    args = p.parse_args()
+
+    tracemalloc.start()
+    report = {"messages": args.messages, "size": args.size, "scenarios": {}}
+    shape = (args.messages, args.size, args.senders, args.recipients)
+    for scenario in args.scenario or list(SCENARIOS):
+        before = measure(DictStore, scenario, *shape)
+        after = measure(QueuedStore, scenario, *shape)
+        saved = before["bytes_per_message"] - after["bytes_per_message"]
+        report["scenarios"][scenario] = {
+            "dict": before,
+            "queued": after,
+            "saved_per_message": round(saved, 1),
+        }
+    tracemalloc.stop()
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""TLS por linha x gateway WebSocket sob a mesma carga.
+
+Roda o loadgen.py duas vezes, com os mesmos clientes, mistura e seed: uma pelo
+socket TLS e outra pelo WebSocket, cada uma contra um servidor local novo (com
+--ws-port), para a segunda não herdar as chaves, filas e memória da primeira.
+Aceita as opções do loadgen.py (sempre com --spawn; o log do servidor, com
+--server-log, ganha o sufixo .tls/.websocket) e imprime os dois relatórios e um
+resumo lado a lado, em JSON.
+
+Exemplo:
+    python bench/transports.py --clients 1000 --duration 20
+"""
+import asyncio
+import json
+import random
+import sys
+from argparse import Namespace
+
+from loadgen import LoadGen, LocalServer, build_parser, raise_fd_limit
+
+
+def summary(report):
+    return {
+        "req_per_s": report["throughput"]["req_per_s"],
+        "errors": report["throughput"]["errors"],
+        "p50_ms": report["latency"]["all"].get("p50_ms"),
+        "p99_ms": report["latency"]["all"].get("p99_ms"),
+        "handshakes_per_s": report["tls_handshake"]["per_s"],
+        "server_kb_per_client": report["memory_kb"]["per_client"],
+    }
+
+
+async def amain(args):
+    raise_fd_limit()
+    reports = {}
+    for name in ("tls", "websocket"):
+        log = f"{args.server_log}.{name}" if args.server_log else None
+        server = LocalServer(args.workers, args.store, log, args.key_type)
+        await server.start()
+        try:
+            port = server.ws_port if name == "websocket" else server.port
+            run_args = Namespace(**{**vars(args), "websocket": name == "websocket"})
+            gen = LoadGen(run_args, "localhost", port, server.cafile, server.proc.pid)
+            reports[name] = await gen.run()
+        finally:
+            server.stop()
+    return {
+        "summary": {name: summary(report) for name, report in reports.items()},
+        "reports": reports,
+    }
+
+
+def main():
+    args = build_parser().parse_args(["--spawn", *sys.argv[1:]])
+    if args.seed is None:
+        # as duas execuções sorteiam a mesma sequência de operações
+        args.seed = random.randrange(2**32)
+
+    report = asyncio.run(amain(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
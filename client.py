@@ -1,13 +1,38 @@
 import argparse
 import asyncio
 import base64
+import itertools
 import json
 import os
 import ssl
+import struct
+import sys
+import threading
 import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from nacl.exceptions import CryptoError
 from nacl.public import Box, PrivateKey, PublicKey
 from nacl.secret import SecretBox
+from websockets.asyncio.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed
+from websockets.protocol import State
+
+from grouptree import KeyTree, MemberKeys, decode_rekey, encode_rekey
+from history import HISTORY_PAGE, open_history
+from wire import (
+    MAX_BATCH,
+    MAX_FRAME,
+    PROTO_BINARY,
+    blob_bytes,
+    decode_frame,
+    decode_json,
+    encode_frame,
+    encode_json,
+    read_frame,
+)
 
 
 def b64(x: bytes) -> str:
@@ -18,138 +43,1404 @@ def ub64(s: str) -> bytes:
     return base64.b64decode(s.encode())
 
 
+def load_identity(path):
+    # a chave privada do client_id: o servidor só aceita o id de novo com a mesma
+    # chave, então ela é gerada uma vez e fica em path, legível só pelo dono
+    try:
+        with open(path, "rb") as f:
+            return PrivateKey(f.read())
+    except FileNotFoundError:
+        priv = PrivateKey.generate()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytes(priv))
+        return priv
+
+
+# Compressão antes de cifrar: só para quem anunciou "zlib" no publish_key (ou grupos
+# em que todos anunciaram), a partir de COMPRESS_MIN bytes e só se ficar menor. O
+# meta da mensagem leva {"z": "zlib", "size": tamanho original}. Atenção: o tamanho
+# do ciphertext passa a depender do conteúdo (repetições encolhem a mensagem).
+COMPRESS_MIN = 512
+MAX_PLAINTEXT = 16 * 1024 * 1024  # limite ao descomprimir (contra "zip bombs")
+
+
+def pack_text(text, compress):
+    # (bytes a cifrar, meta da mensagem)
+    data = text.encode()
+    if compress and len(data) >= COMPRESS_MIN:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            return packed, {"z": "zlib", "size": len(data)}
+    return data, {}
+
+
+def unpack_text(data, meta):
+    if meta and meta.get("z") == "zlib":
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(data, MAX_PLAINTEXT)
+        if inflater.unconsumed_tail:
+            raise ValueError("mensagem descomprimida grande demais")
+    return data.decode()
+
+
+# Recepção em lote: a classificação das mensagens (pelo tipo do envelope ou do meta,
+# sem tentar decifrar) e a gravação no histórico ficam no loop, em ordem; decifrar,
+# descomprimir e recifrar para o histórico vão para um pool de threads em blocos de
+# DECRYPT_CHUNK (o PyNaCl e o zlib soltam o GIL). Lotes pequenos, como os pushes de
+# uma conversa, são abertos no próprio loop. O loop junta no máximo RECEIVE_BATCH
+# mensagens por vez, o que limita quanto tempo a classificação o segura.
+RECEIVE_BATCH = 4096
+DECRYPT_CHUNK = 512
+DECRYPT_INLINE = 64
+DECRYPT_THREADS = min(8, os.cpu_count() or 1)
+
+
+def open_message(box, cipher, meta):
+    # (texto, tipo) de uma mensagem, ou None se não abre
+    if box is None:
+        return None
+    try:
+        pt = box.decrypt(cipher)
+        if meta.get("type") == "file":
+            return pt.decode(), "file"
+        return unpack_text(pt, meta), "text"
+    except Exception:
+        return None
+
+
+def open_batch(jobs, seal=None):
+    # jobs: [(box, cifrado, meta, remetente)]; com seal, cada resultado leva também
+    # a entrada já cifrada para o histórico
+    results = []
+    for box, cipher, meta, sender in jobs:
+        opened = open_message(box, cipher, meta)
+        if opened is not None and seal is not None:
+            opened = (*opened, seal(sender, *opened))
+        results.append(opened)
+    return results
+
+
+async def open_all(jobs, executor=None, seal=None):
+    if executor is None or len(jobs) < DECRYPT_INLINE:
+        return open_batch(jobs, seal)
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(
+        *(
+            loop.run_in_executor(executor, open_batch, jobs[i : i + DECRYPT_CHUNK], seal)
+            for i in range(0, len(jobs), DECRYPT_CHUNK)
+        )
+    )
+    return [result for chunk in chunks for result in chunk]
+
+
+# Anexos: o arquivo vai em chunks de FILE_CHUNK bytes, cada um cifrado com
+# SecretBox(chave do arquivo) junto com o próprio índice (o servidor não consegue
+# trocá-los de lugar). A chave, o nome e o tamanho vão para o destinatário numa
+# mensagem comum (meta {"type": "file"}), cifrada como qualquer outra. Upload e
+# download mantêm até FILE_PARALLEL chunks em voo, e só esses ficam em memória.
+FILE_CHUNK = 256 * 1024
+FILE_PARALLEL = 4
+_INDEX = struct.Struct("!Q")
+FILE_OVERHEAD = _INDEX.size + SecretBox.NONCE_SIZE + SecretBox.MACBYTES
+
+
+def file_chunks(size, chunk=FILE_CHUNK):
+    return max(1, -(-size // chunk))
+
+
+async def _run_limited(jobs, parallel):
+    # roda as corrotinas com no máximo parallel ao mesmo tempo; devolve o
+    # primeiro erro (ou None)
+    sem = asyncio.Semaphore(parallel)
+    errors = []
+
+    async def run(job):
+        async with sem:
+            if not errors:
+                err = await job()
+                if err is not None:
+                    errors.append(err)
+
+    await asyncio.gather(*(run(job) for job in jobs))
+    return errors[0] if errors else None
+
+
+async def upload_file(client, path, to=None, group_id=None, resume=None, parallel=FILE_PARALLEL):
+    # devolve (descritor, erro). O descritor ({file_id, key, name, size, chunk}) é o
+    # que o destinatário precisa para baixar; se o upload falhar no meio, passe-o
+    # em resume para enviar só os chunks que faltam
+    size = os.path.getsize(path)
+    desc = resume
+    if desc is None:
+        resp = await client.send_recv(
+            {
+                "type": "upload_begin",
+                **({"group_id": group_id} if group_id else {"to": to}),
+                "size": size + file_chunks(size) * FILE_OVERHEAD,
+                "chunk_size": FILE_CHUNK + FILE_OVERHEAD,
+            }
+        )
+        if resp.get("status") != "ok":
+            return None, resp.get("reason")
+        desc = {
+            "file_id": resp["file_id"],
+            "key": b64(os.urandom(SecretBox.KEY_SIZE)),
+            "name": os.path.basename(path),
+            "size": size,
+            "chunk": FILE_CHUNK,
+        }
+    box = SecretBox(ub64(desc["key"]))
+    wire_chunk = desc["chunk"] + FILE_OVERHEAD
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            resp = await client.send_recv({"type": "upload_status", "file_id": desc["file_id"]})
+            if resp.get("status") != "ok":
+                return desc, resp.get("reason")
+            if resp["complete"]:
+                return desc, None
+
+            def job(offset):
+                async def send():
+                    index = offset // wire_chunk
+                    data = os.pread(fd, desc["chunk"], index * desc["chunk"])
+                    blob = bytes(box.encrypt(_INDEX.pack(index) + data))
+                    r = await client.send_recv(
+                        {
+                            "type": "upload_chunk",
+                            "file_id": desc["file_id"],
+                            "offset": offset,
+                            "blob": blob,
+                        }
+                    )
+                    return None if r.get("status") == "ok" else r.get("reason")
+
+                return send
+
+            err = await _run_limited([job(o) for o in resp["missing"]], parallel)
+            if err is not None:
+                return desc, err
+    finally:
+        os.close(fd)
+
+
+async def download_file(client, desc, dest, parallel=FILE_PARALLEL):
+    # baixa para dest.part e renomeia no fim; devolve o erro ou None
+    resp = await client.send_recv({"type": "upload_status", "file_id": desc["file_id"]})
+    if resp.get("status") != "ok":
+        return resp.get("reason")
+    if not resp["complete"]:
+        return "o upload deste arquivo ainda não terminou"
+    chunks = file_chunks(desc["size"], desc["chunk"])
+    wire_chunk = resp["chunk_size"]
+    if wire_chunk != desc["chunk"] + FILE_OVERHEAD or file_chunks(resp["size"], wire_chunk) != chunks:
+        return "o arquivo no servidor não corresponde ao anunciado"
+    box = SecretBox(ub64(desc["key"]))
+    tmp = dest + ".part"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    def job(index):
+        async def fetch():
+            r = await client.send_recv(
+                {"type": "download_chunk", "file_id": desc["file_id"], "offset": index * wire_chunk}
+            )
+            if r.get("status") != "ok":
+                return r.get("reason")
+            try:
+                data = box.decrypt(blob_bytes(r["blob"]))
+            except CryptoError:
+                return f"chunk {index} corrompido"
+            expected = min(desc["chunk"], desc["size"] - index * desc["chunk"])
+            if _INDEX.unpack_from(data)[0] != index or len(data) - _INDEX.size != expected:
+                return f"chunk {index} fora de ordem"
+            os.pwrite(fd, memoryview(data)[_INDEX.size :], index * desc["chunk"])
+            return None
+
+        return fetch
+
+    try:
+        err = await _run_limited([job(i) for i in range(chunks)], parallel)
+    finally:
+        os.close(fd)
+    if err is not None:
+        os.unlink(tmp)
+        return err
+    os.replace(tmp, dest)
+    return None
+
+
+class ResumingContext(ssl.SSLContext):
+    # O asyncio não repassa session= ao criar o SSLObject da conexão; este contexto
+    # usa a sessão TLS guardada da conexão anterior, e a reconexão é retomada (sem
+    # a troca de chaves e a assinatura do certificado). Se o servidor não aceitar a
+    # sessão (reiniciou, ticket expirado), o handshake completo acontece sozinho.
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session or self.session
+        )
+
+
 class TLSSocketClient:
-    def __init__(self, host, port, cafile=None):
+    # Uma única conexão TLS persistente, reaproveitada por todas as requisições.
+    # Cada requisição leva um "req_id" e a resposta é casada pelo mesmo id, o que
+    # permite várias requisições em voo (pipelining) sobre o mesmo socket.
+    # Frames sem req_id enviados pelo servidor (push) vão para on_push; on_connect
+    # roda a cada reconexão, para refazer o registro da sessão no servidor.
+    # Com binary=True o framing binário é negociado logo após conectar; se o
+    # servidor não o suportar, a conexão segue no protocolo JSON por linha.
+    # Se o servidor fecha conexões ociosas (idle_timeout no hello), um ping é
+    # enviado quando a conexão fica sem pedidos. Depois de login(), cada nova
+    # conexão abre a sessão (publish_key com a prova do desafio do hello) antes
+    # de on_connect. Com resume=True a sessão TLS de cada conexão é guardada e
+    # usada na próxima (resumed diz se a conexão atual foi retomada).
+    def __init__(
+        self, host, port, cafile=None, timeout=10.0, max_retries=5, binary=True, resume=True
+    ):
         self.host = host
         self.port = port
         self.cafile = cafile
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.binary = binary
+        self.resume = resume
+        self.resumed = False
+        self.proto = "json"
+        self.on_push = None
+        self.on_connect = None
+        self._connected_once = False
+        self._sslctx = None
+        self._reader = None
+        self._writer = None
+        self._recv_task = None
+        self._keepalive_task = None
+        self._last_sent = 0.0
+        self.idle_timeout = None
+        self.identity = None  # (client_id, PrivateKey) da sessão
+        self.features = []  # recursos anunciados no publish_key (ex.: "zlib")
+        self.session = None  # resposta do último publish_key da sessão
+        self.challenge = None  # desafio desta conexão e chave de sessão do servidor
+        self.server_pub = None
+        self._conn_lock = asyncio.Lock()
+        self._last_error = None
+        self._failed_at = 0.0
+        self._ids = itertools.count(1)
+        self._pending = {}  # req_id -> Future
+        self._order = deque()  # req_ids na ordem de envio (servidor sem req_id)
 
-    async def send_recv(self, obj):
-        try:
-            sslctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    def _ssl_context(self):
+        if self._sslctx is None:
+            # o mesmo que ssl.create_default_context(SERVER_AUTH), mas numa classe
+            # que sabe retomar sessões
+            sslctx = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
             if self.cafile:
+                sslctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
                 sslctx.load_verify_locations(self.cafile)
             else:
-                sslctx.check_hostname=False
-                sslctx.verify_mode=ssl.CERT_NONE
+                sslctx.check_hostname = False
+                sslctx.verify_mode = ssl.CERT_NONE
+            self._sslctx = sslctx
+        return self._sslctx
 
-            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=sslctx)
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
 
-            writer.write((json.dumps(obj)+"\n").encode())
-            await writer.drain()
+    async def _connect(self):
+        async with self._conn_lock:
+            if self.connected:
+                return
+            # quem esperou o lock durante uma reconexão que falhou não repete o backoff
+            if self._last_error and time.monotonic() - self._failed_at < 1.0:
+                raise self._last_error
+            delay = 0.2
+            for attempt in range(self.max_retries):
+                try:
+                    self._reader, self._writer = await self._open()
+                    self.proto = await self._negotiate()
+                    self._save_session()
+                    self._recv_task = asyncio.create_task(self._recv_loop())
+                    if self.idle_timeout:
+                        self._keepalive_task = asyncio.create_task(
+                            self._keepalive_loop(self._writer, self.idle_timeout / 3)
+                        )
+                    self._last_error = None
+                    break
+                except ssl.SSLError as e:
+                    # erro de certificado/handshake não se resolve tentando de novo
+                    self._last_error, self._failed_at = e, time.monotonic()
+                    raise
+                except OSError as e:
+                    if attempt == self.max_retries - 1:
+                        self._last_error, self._failed_at = e, time.monotonic()
+                        raise
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+            if self.identity is not None:
+                self.session = await self._request(self.publish_request(*self.identity))
+            if self._connected_once and self.on_connect is not None:
+                await self.on_connect()
+            self._connected_once = True
 
-            line = await reader.readline()
+    async def _open(self):
+        # (reader, writer) de uma conexão nova; subclasses trocam o transporte
+        return await asyncio.open_connection(
+            self.host, self.port, ssl=self._ssl_context(), limit=MAX_FRAME
+        )
 
-            writer.close()
-            await writer.wait_closed()
+    async def _recv(self, reader):
+        # a próxima mensagem decodificada, ou None quando a conexão termina;
+        # ValueError se ela não decodifica
+        if self.proto == PROTO_BINARY:
+            payload = await read_frame(reader)
+            return None if payload is None else decode_frame(payload)
+        line = await reader.readline()
+        if not line:
+            return None
+        return decode_json(line)
+
+    async def _negotiate(self):
+        # roda antes do loop de recepção, então a resposta é lida aqui mesmo
+        proto = PROTO_BINARY if self.binary else "json"
+        self.proto = "json"
+        self._writer.write(self._encode({"type": "hello", "proto": proto}))
+        await self._writer.drain()
+        try:
+            resp = await asyncio.wait_for(self._recv(self._reader), self.timeout)
+        except ValueError:
+            return "json"
+        if resp is None:
+            raise ConnectionResetError("conexão encerrada durante a negociação")
+        ok = resp.get("status") == "ok"
+        self.idle_timeout = resp.get("idle_timeout") if ok else None
+        self.challenge = blob_bytes(resp["challenge"]) if ok and "challenge" in resp else None
+        self.server_pub = blob_bytes(resp["server_pub"]) if self.challenge else None
+        if resp.get("status") == "ok" and resp.get("proto") == PROTO_BINARY:
+            return PROTO_BINARY
+        return "json"
+
+    def _save_session(self):
+        # no TLS 1.3 o ticket chega depois do handshake; depois da resposta do
+        # hello ele já foi lido
+        sslobj = self._writer.get_extra_info("ssl_object")
+        if sslobj is None:
+            return
+        self.resumed = sslobj.session_reused
+        if self.resume and sslobj.session is not None:
+            self._sslctx.session = sslobj.session
+
+    def _encode(self, obj):
+        if self.proto == PROTO_BINARY:
+            return encode_frame(obj)
+        return encode_json(obj)
+
+    async def _recv_loop(self):
+        reader = self._reader
+        binary = self.proto == PROTO_BINARY
+        try:
+            while True:
+                try:
+                    resp = await self._recv(reader)
+                except ValueError:
+                    # no binário o stream não se recupera de um frame inválido
+                    if binary:
+                        raise
+                    resp = {
+                        "status": "error",
+                        "reason": "O servidor enviou uma resposta inválida.",
+                    }
+                if resp is None:
+                    break
+                self._dispatch(resp)
+        except (OSError, ssl.SSLError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self._reader is reader:
+                self._drop_connection("A conexão com o servidor foi encerrada.")
+
+    def publish_request(self, client_id, priv):
+        # publish_key com a prova de posse da chave: o desafio desta conexão cifrado
+        # com Box(priv, chave de sessão do servidor). Servidores sem desafio não a pedem
+        msg = {"type": "publish_key", "client_id": client_id, "pubkey": b64(bytes(priv.public_key))}
+        if self.features:
+            msg["features"] = self.features
+        if self.challenge is not None:
+            msg["proof"] = Box(priv, PublicKey(self.server_pub)).encrypt(self.challenge)
+        return msg
+
+    async def login(self, client_id, priv):
+        # abre a sessão; as reconexões seguintes a refazem sozinhas
+        self.identity = (client_id, priv)
+        if self.connected:
+            self.session = await self.send_recv(self.publish_request(client_id, priv))
+            return self.session
+        try:
+            await self._connect()
+        except ConnectionRefusedError:
+            return {"status": "error", "reason": "A conexão foi recusada. O servidor está offline?"}
+        except (OSError, ssl.SSLError) as e:
+            return {"status": "error", "reason": f"Erro de conexão: {e}"}
+        return self.session
+
+    async def _keepalive_loop(self, writer, interval):
+        # termina sozinho quando esta conexão cai ou é trocada por outra
+        while self._writer is writer:
+            await asyncio.sleep(interval)
+            if self._writer is writer and time.monotonic() - self._last_sent >= interval:
+                await self.send_recv({"type": "ping"})
+
+    def _dispatch(self, resp):
+        rid = resp.pop("req_id", None)
+        if rid is None and "status" not in resp:
+            if self.on_push is not None:
+                self.on_push(resp)
+            return
+        if rid is None:
+            # servidor antigo: respostas chegam na mesma ordem dos pedidos
+            while self._order and self._order[0] not in self._pending:
+                self._order.popleft()
+            if not self._order:
+                return
+            rid = self._order.popleft()
+        fut = self._pending.pop(rid, None)
+        if fut is not None and not fut.done():
+            fut.set_result(resp)
 
-            if not line:
-                return {"status": "error", "reason": "Nenhuma resposta recebida do servidor."}
+    def _drop_connection(self, reason):
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+        pending, self._pending = self._pending, {}
+        self._order.clear()
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_result({"status": "error", "reason": reason})
 
-            return json.loads(line.decode())
-        except json.JSONDecodeError:
-            return {"status": "error", "reason": "O servidor enviou uma resposta inválida."}
+    async def send_recv(self, obj):
+        try:
+            if not self.connected:
+                await self._connect()
         except ConnectionRefusedError:
             return {"status": "error", "reason": "A conexão foi recusada. O servidor está offline?"}
         except Exception as e:
+            self._drop_connection(f"Erro de conexão: {e}")
+            return {"status": "error", "reason": f"Erro de conexão: {e}"}
+        return await self._request(obj)
+
+    async def _request(self, obj):
+        # na conexão atual, sem reconectar (usado também dentro de _connect)
+        rid = None
+        try:
+            if not self.connected:
+                raise ConnectionResetError("conexão encerrada")
+            rid = next(self._ids)
+            fut = asyncio.get_running_loop().create_future()
+            self._pending[rid] = fut
+            self._order.append(rid)
+
+            self._last_sent = time.monotonic()
+            self._writer.write(self._encode({**obj, "req_id": rid}))
+            await self._writer.drain()
+
+            return await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(rid, None)
+            return {"status": "error", "reason": "Nenhuma resposta recebida do servidor."}
+        except Exception as e:
+            self._drop_connection(f"Erro de conexão: {e}")
             return {"status": "error", "reason": f"Erro de conexão: {e}"}
 
+    async def close(self):
+        if self._recv_task is not None:
+            self._recv_task.cancel()
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+        writer = self._writer
+        self._drop_connection("Cliente encerrado.")
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
 
-async def interactive(server_host, server_port, cacert, client_id):
-    client_id = client_id.strip().strip('"')
-    client = TLSSocketClient(server_host, server_port, cacert)
-    priv = PrivateKey.generate()
-    pub = bytes(priv.public_key)
+class _WSStream:
+    # A conexão WebSocket com a parte da interface de StreamReader/StreamWriter que
+    # o TLSSocketClient usa. write() só enfileira; drain() envia, em ordem.
+    def __init__(self, ws):
+        self.ws = ws
+        self.text = True  # mensagens de texto (json) ou binárias (bin1)
+        self._out = deque()
+
+    def write(self, data):
+        self._out.append((data, self.text))
+
+    async def drain(self):
+        while self._out:
+            data, text = self._out.popleft()
+            await self.ws.send(data, text=text)
+
+    def is_closing(self):
+        return self.ws.state is not State.OPEN
+
+    def close(self):
+        self.ws.transport.close()
+
+    async def wait_closed(self):
+        await self.ws.wait_closed()
+
+    def get_extra_info(self, name, default=None):
+        return self.ws.transport.get_extra_info(name, default)
+
+
+class WebSocketClient(TLSSocketClient):
+    # O mesmo cliente (pipelining por req_id, push, sessão, reconexão) sobre um
+    # WebSocket (wss://) com permessage-deflate: cada pedido é uma mensagem, de
+    # texto no modo json ou binária com o frame bin1 sem o prefixo de tamanho. O
+    # ping/pong do WebSocket mantém a conexão viva através de balanceadores.
+    PING = 20.0
+
+    async def _open(self):
+        ws = await ws_connect(
+            f"wss://{self.host}:{self.port}/",
+            ssl=self._ssl_context(),
+            compression="deflate",
+            max_size=MAX_FRAME,
+            ping_interval=self.PING,
+            ping_timeout=self.PING,
+            open_timeout=self.timeout,
+        )
+        stream = _WSStream(ws)
+        return stream, stream
+
+    def _encode(self, obj):
+        if self.proto == PROTO_BINARY:
+            self._writer.text = False
+            return memoryview(encode_frame(obj))[4:]
+        self._writer.text = True
+        return encode_json(obj)[:-1]
+
+    async def _recv(self, reader):
+        try:
+            message = await reader.ws.recv()
+        except ConnectionClosed:
+            return None
+        if isinstance(message, str):
+            return decode_json(message)
+        return decode_frame(message)
+
+
+class KeyCache:
+    # Chaves públicas dos pares e Boxes já calculados, com despejo LRU. O Box é
+    # indexado pela chave pública: o acordo X25519 é feito uma vez por chave, e
+    # decifrar histórico ou enviar de novo para o mesmo par só usa cripto simétrica.
+    def __init__(self, priv, maxsize=1024):
+        self.priv = priv
+        self.maxsize = maxsize
+        self._peers = OrderedDict()  # peer_id -> base64 pubkey
+        self._boxes = OrderedDict()  # base64 pubkey -> Box
+
+    def get(self, peer_id):
+        pub = self._peers.get(peer_id)
+        if pub is not None:
+            self._peers.move_to_end(peer_id)
+        return pub
 
-    # publica chave
-    resp = await client.send_recv(
-        {"type": "publish_key", "client_id": client_id, "pubkey": b64(pub)}
+    def put(self, peer_id, pub_b64):
+        self._peers[peer_id] = pub_b64
+        self._peers.move_to_end(peer_id)
+        if len(self._peers) > self.maxsize:
+            self._peers.popitem(last=False)
+
+    def invalidate(self, peer_id):
+        pub = self._peers.pop(peer_id, None)
+        if pub is not None:
+            self._boxes.pop(pub, None)
+
+    def box(self, pub_b64):
+        box = self._boxes.get(pub_b64)
+        if box is None:
+            box = self._boxes[pub_b64] = Box(self.priv, PublicKey(ub64(pub_b64)))
+            if len(self._boxes) > self.maxsize:
+                self._boxes.popitem(last=False)
+        else:
+            self._boxes.move_to_end(pub_b64)
+        return box
+
+
+class Outbox:
+    # Fila de envio: cada mensagem posta vira um pedido em pipeline na conexão, com
+    # até max_inflight sem resposta, e a UI não espera o round trip. Os pedidos saem
+    # na ordem em que foram postos; a resposta de cada um chega depois, por
+    # on_ack(tag, resposta).
+    def __init__(self, client, max_inflight=64, max_batch=MAX_BATCH):
+        self.client = client
+        self.max_batch = max_batch  # 1: um send_blob por mensagem, sem juntar
+        self.on_ack = None
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._inflight = set()
+        self._task = None
+
+    def put(self, payload, tag=None):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._queue.put_nowait((payload, tag))
+
+    async def _run(self):
+        held = None  # o próximo da fila, tirado ao montar o lote anterior
+        while True:
+            if held is None:
+                held = await self._queue.get()
+            batch, held = [held], None
+            await self._slots.acquire()
+            # mensagens privadas que esperam juntas na fila vão num send_blobs só
+            # (até max_batch), sem passar nada que foi posto antes na frente
+            if batch[0][0].get("type") == "send_blob":
+                while not self._queue.empty() and len(batch) < self.max_batch:
+                    item = self._queue.get_nowait()
+                    if item[0].get("type") != "send_blob":
+                        held = item
+                        break
+                    batch.append(item)
+            # a tarefa escreve o pedido assim que roda, antes da próxima da fila
+            task = asyncio.create_task(self._send(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _send(self, batch):
+        try:
+            if len(batch) == 1:
+                payload, tag = batch[0]
+                acks = [(tag, await self.client.send_recv(payload))]
+            else:
+                messages = [
+                    {"to": payload["to"], "blob": payload["blob"], "meta": payload.get("meta", {})}
+                    for payload, _ in batch
+                ]
+                resp = await self.client.send_recv({"type": "send_blobs", "messages": messages})
+                # um erro do lote inteiro (limite de taxa, conexão) vale para cada mensagem
+                results = resp.get("results") if resp.get("status") == "ok" else None
+                acks = [(tag, resp) for _, tag in batch]
+                if results is not None:
+                    acks = [(tag, result) for (_, tag), result in zip(batch, results)]
+        finally:
+            self._slots.release()
+        if self.on_ack is not None:
+            for tag, resp in acks:
+                self.on_ack(tag, resp)
+
+    async def flush(self):
+        # espera tudo o que já foi posto ser enviado e respondido
+        await self._queue.join()
+        # as terminadas saem do conjunto só pelo done-callback, que roda depois: um
+        # gather delas voltaria sem ceder ao loop e este while não sairia mais
+        while pending := {task for task in self._inflight if not task.done()}:
+            await asyncio.wait(pending)
+
+    async def close(self, timeout=5.0):
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self._task is not None:
+            self._task.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+
+
+class Console:
+    # Camada de UI: uma thread lê o stdin e entrega as linhas ao event loop por uma
+    # fila, então a leitura nunca segura a rede. Avisos que chegam enquanto o
+    # usuário está num prompt são impressos numa linha própria e o prompt é
+    # reescrito embaixo deles.
+    def __init__(self):
+        self._lines = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._prompt = None
+        self._eof = False
+        threading.Thread(target=self._read_stdin, daemon=True).start()
+
+    def _read_stdin(self):
+        for line in sys.stdin:
+            self._loop.call_soon_threadsafe(self._lines.put_nowait, line.rstrip("\n"))
+        self._loop.call_soon_threadsafe(self._lines.put_nowait, None)
+
+    async def input(self, prompt=""):
+        # EOFError no fim do stdin, como input()
+        if self._eof:
+            raise EOFError
+        self._prompt = prompt
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        try:
+            line = await self._lines.get()
+        finally:
+            self._prompt = None
+        if line is None:
+            self._eof = True
+            raise EOFError
+        return line
+
+    def show(self, text):
+        if self._prompt is None:
+            print(text)
+            return
+        sys.stdout.write(f"\r\033[K{text}\n{self._prompt}")
+        sys.stdout.flush()
+
+
+# mensagens de grupo que chegam antes da chave do grupo esperam decifradas aqui
+# (no máximo tantas por grupo; as mais antigas são descartadas)
+MAX_PENDING_GROUP = 1000
+
+
+# uma mensagem recebida (ou enviada), já decifrada: peer é a conversa (o par ou o
+# grupo), kind é "text" ou "file" (text com o descritor do anexo em JSON)
+Message = namedtuple("Message", "peer sender text kind ts group")
+
+
+class ChatClient:
+    # Cliente sem UI: sessão, chaves, grupos, recepção em lote e envios em pipeline.
+    # O interactive() é uma UI por cima dele; bots e integrações o usam direto:
+    #   chat = ChatClient(host, port, cacert, "bot", priv=load_identity("bot.key"))
+    #   await chat.connect()
+    #   await chat.send("alice", "oi")      # vai para a outbox e volta na hora
+    #   async for msg in chat: ...          # Message, na ordem de chegada
+    #   await chat.close()
+    # Ganchos: on_message(msg) (padrão: a fila do iterador), on_notice(texto) para
+    # avisos (chave trocada, entrada num grupo) e on_ack(tag, resposta) de cada
+    # envio. Com history (um HistoryStore), o que chega e o que sai é gravado nele.
+    # priv é a chave de identidade (load_identity); sem ela, uma nova, que só serve
+    # para um client_id ainda não registrado no servidor.
+    def __init__(
+        self,
+        host,
+        port,
+        cacert,
+        client_id,
+        compress=True,
+        history=None,
+        websocket=False,
+        max_inflight=64,
+        priv=None,
+    ):
+        transport = WebSocketClient if websocket else TLSSocketClient
+        self.client = transport(host, port, cacert)
+        self.client_id = client_id
+        self.compress = compress
+        if compress:
+            self.client.features = ["zlib"]
+        self.priv = priv or PrivateKey.generate()
+        self.pub = bytes(self.priv.public_key)
+        self.keys = KeyCache(self.priv)
+        self.peer_features = {}  # peer_id -> recursos anunciados (vêm com a chave pública)
+        # group_id -> { "keys": KeyTree (admin) ou MemberKeys, "pending": deque das que
+        # chegaram sem chave, "compress" }
+        self.groups = {}
+        self.history = history
+        self.outbox = Outbox(self.client, max_inflight)
+        self.outbox.on_ack = self._on_ack
+        self._incoming = asyncio.Queue()  # Message para o iterador
+        self._inbox = asyncio.Queue()  # lotes de mensagens recebidas, para o _receive_loop
+        self._pool = ThreadPoolExecutor(DECRYPT_THREADS, thread_name_prefix="decrypt")
+        self._tasks = []
+        self.on_message = self._incoming.put_nowait
+        self.on_notice = None
+        self.on_ack = None
+
+    # --- sessão ---
+    async def connect(self):
+        # publica a chave, abre a sessão e se inscreve para receber por push (sem
+        # push, busca a cada segundo). Devolve a resposta do publish_key
+        resp = await self.client.login(self.client_id, self.priv)
+        if resp.get("status") != "ok":
+            return resp
+        self.client.on_push = self._on_push
+        self.client.on_connect = self._subscribe  # a sessão o TLSSocketClient já refez
+        self._tasks.append(asyncio.create_task(self._receive_loop()))
+        if (await self._subscribe()).get("status") != "ok":
+            self._tasks.append(asyncio.create_task(self._poll_loop()))
+        return resp
+
+    async def flush(self):
+        # espera a resposta de tudo o que já foi enviado
+        await self.outbox.flush()
+
+    async def close(self):
+        await self.outbox.close()
+        await self.client.close()
+        # o que já foi recebido (e retirado do servidor) ainda é entregue
+        try:
+            await asyncio.wait_for(self._inbox.join(), 10)
+        except asyncio.TimeoutError:
+            pass
+        for task in self._tasks:
+            task.cancel()
+        self._pool.shutdown(wait=False)
+        self._incoming.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self._incoming.get()
+        if msg is None:
+            self._incoming.put_nowait(None)  # outros iteradores também terminam
+            raise StopAsyncIteration
+        return msg
+
+    def _notify(self, text):
+        if self.on_notice is not None:
+            self.on_notice(text)
+
+    def _on_ack(self, tag, resp):
+        if self.on_ack is not None:
+            self.on_ack(tag, resp)
+
+    # --- chaves ---
+    async def peer_box(self, peer):
+        # Box do par, consultando o servidor só na primeira vez (ou após key_update)
+        pub_b64 = self.keys.get(peer)
+        if pub_b64 is None:
+            resp = await self.client.send_recv({"type": "get_key", "client_id": peer})
+            if resp.get("status") != "ok":
+                return None, resp
+            pub_b64 = resp["pubkey"]
+            self.keys.put(peer, pub_b64)
+            self.peer_features[peer] = resp.get("features", [])
+        return self.keys.box(pub_b64), None
+
+    async def fetch_keys(self, peers):
+        # chaves públicas que faltam no cache, num get_keys por lote de MAX_BATCH;
+        # devolve {peer: motivo} das que não vieram
+        failed = {}
+        unknown = [p for p in peers if self.keys.get(p) is None]
+        for i in range(0, len(unknown), MAX_BATCH):
+            chunk = unknown[i : i + MAX_BATCH]
+            resp = await self.client.send_recv({"type": "get_keys", "client_ids": chunk})
+            if resp.get("status") != "ok":
+                failed.update(dict.fromkeys(chunk, resp.get("reason")))
+                continue
+            for peer, pub_b64 in resp.get("keys", {}).items():
+                self.keys.put(peer, pub_b64)
+                self.peer_features[peer] = resp.get("features", {}).get(peer, [])
+            failed.update(dict.fromkeys(resp.get("missing", []), "não encontrado"))
+        return failed
+
+    # --- envio ---
+    def _seal(self, peer, text, kind, group):
+        # registra no histórico o que foi enviado; devolve a Message
+        msg = Message(peer, self.client_id, text, kind, time.time(), group)
+        if self.history is not None:
+            self.history.add(peer, self.client_id, text, kind, msg.ts, group)
+        return msg
+
+    async def send(self, peer, text, kind="text", tag=None):
+        # mensagem privada em pipeline: volta assim que entra na outbox e a resposta
+        # chega depois em on_ack(tag, resposta). Devolve (Message, None), ou (None,
+        # resposta de erro) se a chave do par não veio
+        box, err = await self.peer_box(peer)
+        if box is None:
+            return None, err
+        if kind == "file":
+            data, meta = text.encode(), {"type": "file"}
+        else:
+            zlib_ok = self.compress and "zlib" in self.peer_features.get(peer, ())
+            data, meta = pack_text(text, zlib_ok)
+        envelope = {"sender_pub": b64(self.pub), "blob": b64(box.encrypt(data))}
+        payload = {
+            "type": "send_blob",
+            "to": peer,
+            "from": self.client_id,
+            "blob": json.dumps(envelope).encode(),
+            "meta": meta,
+        }
+        self.outbox.put(payload, (peer, text) if tag is None else tag)
+        return self._seal(peer, text, kind, False), None
+
+    async def send_group(self, group_id, text, kind="text", tag=None):
+        # como send, para um grupo do qual já temos a chave
+        group = self.groups.get(group_id)
+        if group is None or group["keys"] is None:
+            return None, {"status": "error", "reason": "sem a chave do grupo"}
+        if kind == "file":
+            data, meta = text.encode(), {"type": "file"}
+        else:
+            data, meta = pack_text(text, group.get("compress"))
+        # a época pode mudar no meio da conversa (troca de chave)
+        group_keys = group["keys"]
+        if group_keys.epoch:
+            meta = {**meta, "epoch": group_keys.epoch}
+        payload = {
+            "type": "send_group_blob",
+            "group_id": group_id,
+            "from": self.client_id,
+            "blob": bytes(group_keys.box().encrypt(data)),
+        }
+        if meta:
+            payload["meta"] = meta
+        self.outbox.put(payload, (group_id, text) if tag is None else tag)
+        return self._seal(group_id, text, kind, True), None
+
+    # --- grupos ---
+    def _group_entry(self, group_id):
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self.groups[group_id] = {
+                "keys": None,  # Chave será recebida depois
+                "pending": deque(maxlen=MAX_PENDING_GROUP),
+            }
+        return group
+
+    def _group_compress(self, members):
+        # o grupo usa compressão só se todos os membros a entendem
+        return self.compress and all(
+            "zlib" in self.peer_features.get(m, ()) for m in members if m != self.client_id
+        )
+
+    async def _send_welcomes(self, group_id, members):
+        # o caminho da folha de cada membro na árvore do grupo, cifrado com Box
+        # para ele; os envelopes vão em send_blobs (em lotes de MAX_BATCH).
+        # Devolve ([quem recebeu], {membro: motivo})
+        group = self.groups[group_id]
+        sent, failed = [], {}
+        envelopes = []
+        for member in members:
+            peer_pub_b64 = self.keys.get(member)
+            if peer_pub_b64 is None:
+                continue
+            welcome = json.dumps(group["keys"].welcome(member)).encode()
+            envelope = {
+                "type": "group_key_distribution",
+                "scheme": "lkh",
+                "group_id": group_id,
+                "sender_pub": b64(self.pub),
+                "key_blob": b64(self.keys.box(peer_pub_b64).encrypt(welcome)),
+                "features": ["zlib"] if group["compress"] else [],
+            }
+            envelopes.append({"to": member, "blob": json.dumps(envelope).encode()})
+
+        for i in range(0, len(envelopes), MAX_BATCH):
+            chunk = envelopes[i : i + MAX_BATCH]
+            resp = await self.client.send_recv(
+                {"type": "send_blobs", "from": self.client_id, "messages": chunk}
+            )
+            if resp.get("status") != "ok":
+                failed.update({entry["to"]: resp.get("reason") for entry in chunk})
+                continue
+            for entry, result in zip(chunk, resp.get("results", [])):
+                if result.get("status") == "ok":
+                    sent.append(entry["to"])
+                else:
+                    failed[entry["to"]] = result.get("reason")
+        return sent, failed
+
+    async def create_group(self, group_id, members):
+        # cria o grupo (com este cliente como admin) e manda a cada membro o seu
+        # caminho na árvore de chaves. Devolve a resposta do servidor com "sent"
+        # (quem recebeu a chave) e "failed" ({membro: motivo})
+        members = list(dict.fromkeys([*members, self.client_id]))
+        resp = await self.client.send_recv(
+            {"type": "create_group", "group_id": group_id, "members": members}
+        )
+        if resp.get("status") != "ok":
+            return resp
+        # a árvore de chaves do grupo fica com o admin
+        self.groups[group_id] = {
+            "keys": KeyTree(self.client_id, members),
+            "pending": deque(maxlen=MAX_PENDING_GROUP),
+        }
+        if self.history is not None:
+            self.history.touch(group_id, group=True)
+        others = [m for m in members if m != self.client_id]
+        failed = await self.fetch_keys(others)
+        self.groups[group_id]["compress"] = self._group_compress(others)
+        sent, not_sent = await self._send_welcomes(group_id, others)
+        return {**resp, "sent": sent, "failed": {**failed, **not_sent}}
+
+    async def add_members(self, group_id, members):
+        return await self._change_members(group_id, members, "add_members")
+
+    async def remove_members(self, group_id, members):
+        return await self._change_members(group_id, members, "remove_members")
+
+    async def _change_members(self, group_id, members, op):
+        # só o admin, com a árvore criada nesta sessão. A troca de chave vai numa
+        # única mensagem de grupo, antes dos welcomes: o que quem entrou mandar já
+        # chega a todos com a chave nova
+        tree = self.groups.get(group_id, {}).get("keys")
+        if not isinstance(tree, KeyTree):
+            # a árvore não é guardada entre sessões
+            return {"status": "error", "reason": "só o admin que criou o grupo nesta sessão"}
+        resp = await self.client.send_recv(
+            {"type": op, "group_id": group_id, "members": list(dict.fromkeys(members))}
+        )
+        if resp.get("status") != "ok":
+            return resp
+        added, removed = resp["added"], resp["removed"]
+        if not added and not removed:
+            return resp
+        failed = {}
+        if added:
+            failed = await self.fetch_keys(added)
+            rekey = tree.add(added)
+        else:
+            rekey = tree.remove(removed)
+        group = self.groups[group_id]
+        group["compress"] = self._group_compress(tree.leaves)
+        rekey["features"] = ["zlib"] if group["compress"] else []
+        sent_rekey = await self.client.send_recv(
+            {
+                "type": "send_group_blob",
+                "group_id": group_id,
+                "from": self.client_id,
+                "blob": encode_rekey(rekey),
+                "meta": {"type": "rekey"},
+            }
+        )
+        sent, not_sent = await self._send_welcomes(group_id, added)
+        return {
+            **resp,
+            "updates": len(rekey["updates"]),
+            "rekey": sent_rekey,
+            "sent": sent,
+            "failed": {**failed, **not_sent},
+        }
+
+    # --- recepção ---
+    def _on_push(self, frame):
+        if frame.get("type") == "deliver":
+            self._inbox.put_nowait(frame.get("messages", []))
+        elif frame.get("type") == "key_update":
+            peer = frame.get("client_id")
+            self.keys.invalidate(peer)
+            if frame.get("pubkey"):
+                self.keys.put(peer, frame["pubkey"])
+                self.peer_features[peer] = frame.get("features", [])
+            self._notify(f"[CHAVE] A chave pública de {peer} mudou.")
+
+    async def _subscribe(self):
+        resp = await self.client.send_recv({"type": "subscribe", "client_id": self.client_id})
+        if resp.get("status") == "ok":
+            self._inbox.put_nowait(resp.get("messages", []))
+        return resp
+
+    async def _poll_loop(self):
+        # fallback para servidores sem push
+        while True:
+            try:
+                # em páginas, para não receber um backlog enorme num frame só
+                while True:
+                    response = await self.client.send_recv(
+                        {"type": "fetch_blobs", "client_id": self.client_id, "limit": 500}
+                    )
+                    if response.get("status") != "ok":
+                        break
+                    self._inbox.put_nowait(response.get("messages", []))
+                    if not response.get("more"):
+                        break
+            except Exception as e:
+                self._notify(f"Erro no polling: {e}")
+            await asyncio.sleep(1)
+
+    async def _receive_loop(self):
+        # um consumidor só: lotes (pushes, subscribe, páginas do fetch) são
+        # aplicados na ordem de chegada, juntando o que já estiver esperando
+        inbox = self._inbox
+        while True:
+            messages = list(await inbox.get())
+            batches = 1
+            while not inbox.empty() and len(messages) < RECEIVE_BATCH:
+                messages.extend(inbox.get_nowait())
+                batches += 1
+            try:
+                await self._handle_messages(messages)
+            except Exception as e:
+                self._notify(f"Erro ao processar mensagens recebidas: {e}")
+            finally:
+                for _ in range(batches):
+                    inbox.task_done()
+
+    def _apply_rekey(self, m, group):
+        # troca de chaves do grupo: só vale se vier do admin; a que já está no
+        # welcome de quem acabou de entrar é ignorada
+        group_keys = group["keys"]
+        if m["from"] != group_keys.admin or isinstance(group_keys, KeyTree):
+            return
+        try:
+            rekey = decode_rekey(blob_bytes(m["blob"]))
+        except ValueError:
+            return
+        if rekey["epoch"] <= group_keys.epoch:
+            return
+        if not group_keys.apply(rekey):
+            self._notify(
+                f"[GRUPO] Não foi possível aplicar a troca de chave de '{m['group_id']}';"
+                " peça ao admin para adicionar você de novo."
+            )
+            return
+        group["compress"] = self.compress and "zlib" in rekey.get("features", [])
+
+    def _group_job(self, m, group, jobs, received):
+        meta = m.get("meta") or {}
+        if meta.get("type") == "rekey":
+            self._apply_rekey(m, group)
+            return
+        # a caixa é escolhida aqui, em ordem: uma troca de chave mais adiante no
+        # mesmo lote não muda a das mensagens anteriores
+        box = group["keys"].box(meta.get("epoch", 0))
+        jobs.append((box, blob_bytes(m["blob"]), meta, m["from"]))
+        received.append(m)
+
+    def _join_group(self, m, env, jobs, received):
+        try:
+            group_key = self.keys.box(env["sender_pub"]).decrypt(ub64(env["key_blob"]))
+            if env.get("scheme") == "lkh":
+                group_keys = MemberKeys(json.loads(group_key))
+            else:
+                # cliente antigo: uma chave só, como uma árvore de um nó
+                welcome = {"keys": {"0:0": group_key.hex()}}
+                group_keys = MemberKeys(
+                    {**welcome, "admin": m["from"], "epoch": 0, "depth": 0, "leaf": 0}
+                )
+        except Exception:
+            return  # chave de grupo que não conseguimos abrir
+        group_id = env["group_id"]
+        group = self._group_entry(group_id)
+        group["keys"] = group_keys
+        group["compress"] = self.compress and "zlib" in env.get("features", [])
+        if self.history is not None:
+            self.history.touch(group_id, group=True)
+        self._notify(f"[GRUPO] Você foi adicionado ao grupo '{group_id}' e recebeu a chave.")
+        # o que chegou antes da chave agora pode ser lido
+        while group["pending"]:
+            self._group_job(group["pending"].popleft(), group, jobs, received)
+
+    async def _handle_messages(self, messages):
+        jobs = []  # (caixa, cifrado, meta, remetente), abertos depois em lote
+        received = []  # a mensagem de cada job
+        for m in messages:
+            if m.get("type") == "group":
+                group = self._group_entry(m["group_id"])
+                if group["keys"] is None:
+                    group["pending"].append({**m, "ts": time.time()})
+                    continue
+                self._group_job(m, group, jobs, received)
+                continue
+            # Mensagem privada
+            try:
+                env = json.loads(blob_bytes(m["blob"]))
+            except ValueError:
+                env = {}
+            if env.get("type") == "group_key_distribution":
+                # Não vira uma mensagem visível
+                self._join_group(m, env, jobs, received)
+                continue
+            try:
+                box, cipher = self.keys.box(env["sender_pub"]), ub64(env["blob"])
+            except Exception:
+                box, cipher = None, b""
+            jobs.append((box, cipher, m.get("meta") or {}, m["from"]))
+            received.append(m)
+
+        history = self.history
+        results = await open_all(jobs, self._pool, history.seal if history is not None else None)
+        for m, result in zip(received, results):
+            group = m.get("type") == "group"
+            peer = m["group_id"] if group else m["from"]
+            ts = m.get("ts") or time.time()
+            body = None
+            if result is None:
+                text = "<erro ao decifrar mensagem de grupo>" if group else "<erro ao decifrar>"
+                kind = "text"
+            elif history is not None:
+                text, kind, body = result
+            else:
+                text, kind = result
+            if history is not None:
+                history.add(peer, m["from"], text, kind, ts, group, body)
+            self.on_message(Message(peer, m["from"], text, kind, ts, group))
+
+
+async def interactive(
+    server_host,
+    server_port,
+    cacert,
+    client_id,
+    compress=True,
+    history_path=None,
+    passphrase=None,
+    websocket=False,
+    key_path=None,
+):
+    client_id = client_id.strip().strip('"')
+    # as mensagens são decifradas ao chegar e vão para o histórico em disco; em
+    # memória só ficam as chaves dos grupos e os contadores
+    history = open_history(history_path, passphrase)
+    priv = load_identity(key_path or f"key-{client_id}.key")
+    chat = ChatClient(
+        server_host, server_port, cacert, client_id, compress, history, websocket, priv=priv
     )
+    client = chat.client
+    groups = chat.groups
+
+    # publica chave e abre a sessão da conexão
+    resp = await chat.connect()
     if resp.get("status") != "ok":
         print("Erro ao publicar chave:", resp)
+        history.close()
         return
     print(f"[+] Chave pública publicada para {client_id}")
 
-    conversations = {}  # peer_id -> [ (timestamp, sender, mensagem) ]
-    groups = {}  # group_id -> { "key": bytes, "history": [] }
     new_msgs = {}  # peer_id -> int (novas mensagens)
+    current = {"peer": None}  # conversa aberta: o que chega dela é mostrado na hora
+    files = {}  # file_id -> descritor de anexo (enviado ou recebido)
+    uploads = {}  # (caminho, peer_id) -> descritor de upload interrompido
 
-    async def ainput(prompt=""):
-        return await asyncio.to_thread(input, prompt)
+    # a UI lê o teclado e imprime; os envios das conversas vão pela outbox e as
+    # confirmações chegam fora de banda (só as falhas são mostradas)
+    console = Console()
+    ainput = console.input
+    notify = console.show
 
-    async def poll_blobs():
+    def on_ack(tag, resp):
+        if resp.get("status") != "ok":
+            peer, text = tag
+            notify(f"[!] Não enviada para {peer}: {text!r} ({resp.get('reason')})")
+
+    def on_message(msg):
+        if current["peer"] == msg.peer:
+            notify(format_entry(msg.ts, msg.sender, msg.text, msg.kind))
+        else:
+            new_msgs[msg.peer] = new_msgs.get(msg.peer, 0) + 1
+
+    chat.on_ack = on_ack
+    chat.on_message = on_message
+    chat.on_notice = notify
+
+    def format_entry(ts, sender, text, kind):
+        stamp = time.strftime("%H:%M:%S", time.localtime(ts))
+        if kind == "file":
+            desc = json.loads(text)
+            files[desc["file_id"]] = desc
+            return (
+                f"[{stamp}] {sender}: [arquivo] {desc['name']} ({desc['size']} bytes)"
+                f" — /baixar {desc['file_id']}"
+            )
+        return f"[{stamp}] {sender}: {text}"
+
+    def label(text, kind):
+        # como a mensagem aparece nos avisos de falha de envio
+        if kind == "file":
+            return f"[arquivo] {json.loads(text)['name']}"
+        return text
+
+    def show_history(peer, before=None):
+        # uma página do histórico em disco; devolve o cursor da página anterior
+        entries, cursor = history.page(peer, HISTORY_PAGE, before)
+        if before is not None:
+            print("--- mensagens anteriores ---")
+        for entry in entries:
+            print(format_entry(*entry))
+        if cursor is not None:
+            print("(/mais mostra mensagens anteriores)")
+        return cursor
+
+    def show_key_results(resp):
+        for member in resp.get("sent", []):
+            print(f"  - Chave enviada para {member}")
+        for member, reason in resp.get("failed", {}).items():
+            print(f"  - Erro ao enviar chave para {member}: {reason}")
+
+    async def history_flush_loop(interval):
+        # agrupa as escritas do histórico num commit por intervalo
         while True:
-            try:
-                response = await client.send_recv(
-                    {"type": "fetch_blobs", "client_id": client_id}
-                )
-                if response.get("status") == "ok":
-                    for m in response.get("messages", []):
-                        if m.get("type") == "group":
-                            group_id = m["group_id"]
-                            if group_id not in groups:
-                                groups[group_id] = {
-                                    "key": None,
-                                    "history": [],
-                                }  # Chave será recebida depois
-                            groups[group_id]["history"].append(("received_group", m))
-                            new_msgs[group_id] = new_msgs.get(group_id, 0) + 1
-                        else:  # Mensagem privada
-                            # Descriptografar a chave do grupo se for uma
-                            try:
-                                env = json.loads(base64.b64decode(m["blob"]).decode())
-                                if env.get("type") == "group_key_distribution":
-                                    peer_pub_b64 = env["sender_pub"]
-                                    peer_pub = PublicKey(ub64(peer_pub_b64))
-                                    box = Box(priv, peer_pub)
-                                    group_key = box.decrypt(ub64(env["key_blob"]))
-                                    group_id = env["group_id"]
-                                    if group_id not in groups:
-                                        groups[group_id] = {"history": []}
-                                    groups[group_id]["key"] = group_key
-                                    print(
-                                        f"\n[GRUPO] Você foi adicionado ao grupo '{group_id}' e recebeu a chave."
-                                    )
-                                    continue  # Não armazena a chave como uma mensagem visível
-                            except:  # noqa: S110
-                                pass  # Não era uma chave de grupo
-
-                            peer = m["from"]
-                            if peer not in conversations:
-                                conversations[peer] = []
-                            conversations[peer].append(("received", m))
-                            new_msgs[peer] = new_msgs.get(peer, 0) + 1
-            except Exception as e:
-                print(f"Erro no polling: {e}")
-            await asyncio.sleep(1)
+            await asyncio.sleep(interval)
+            history.flush()
+
+    async def send_file(path, peer, target):
+        # target é {"to": peer} ou {"group_id": peer}; um upload que falhou no
+        # meio é retomado quando o mesmo arquivo é enviado de novo ao mesmo par
+        try:
+            desc, err = await upload_file(client, path, resume=uploads.get((path, peer)), **target)
+        except OSError as e:
+            print("Erro ao ler arquivo:", e)
+            return None
+        if err is not None:
+            if desc is not None:
+                uploads[(path, peer)] = desc
+            print(f"Erro ao enviar arquivo: {err} (/arquivo de novo retoma o envio)")
+            return None
+        uploads.pop((path, peer), None)
+        files[desc["file_id"]] = desc
+        return desc
 
-    poll_task = asyncio.create_task(poll_blobs())
+    async def fetch_file(file_id):
+        desc = files.get(file_id)
+        if desc is None:
+            print("Arquivo desconhecido nesta sessão.")
+            return
+        os.makedirs("downloads", exist_ok=True)
+        dest = os.path.join("downloads", os.path.basename(desc["name"]) or file_id)
+        print(f"Baixando {desc['name']} ({desc['size']} bytes)...")
+        err = await download_file(client, desc, dest)
+        if err is not None:
+            print("Erro ao baixar arquivo:", err)
+        else:
+            print(f"Arquivo salvo em {dest}")
+
+    flush_task = asyncio.create_task(history_flush_loop(1.0))
 
     def show_menu():
         print("\nComandos disponíveis:")
-        print(" - Listar (mostra usuários e grupos)")
+        print(" - Listar [online] [prefixo] (mostra usuários e grupos)")
         print(" - Iniciar chat <cliente>")
         print(" - Criar grupo <nome_grupo> com <membro1> <membro2> ...")
+        print(" - Adicionar|Remover <grupo> <membro1> <membro2> ... (admin do grupo)")
         print(" - Conversas (entra em chats privados ou de grupo)")
         print(" - Sair")
 
     show_menu()
 
     while True:
-        line = await ainput(">> ")
+        try:
+            line = await ainput(">> ")
+        except EOFError:
+            line = "sair"
         if not line:
             continue
         parts = line.strip().split(" ", 3)
         cmd = parts[0].lower()
 
         if cmd=="listar":
+            # listar [online] [prefixo]: uma página por vez, seguindo next_cursor
+            args = line.strip().split()[1:]
+            query = {"type": "list_all", "client_id": client_id}
+            if args and args[0].lower() == "online":
+                query["online"] = True
+                args = args[1:]
+            if args:
+                query["prefix"] = args[0]
             try:
-                resp = await client.send_recv({"type":"list_all","client_id":client_id})
-                if resp.get("status")=="ok":
-                    print("Clientes disponíveis:", resp.get("clients",[]))
-                    print("Grupos disponíveis:", resp.get("groups",[]))
-                else:
-                    print(f"Erro ao listar: {resp.get('reason', 'causa desconhecida')}")
+                while True:
+                    resp = await client.send_recv(query)
+                    if resp.get("status") != "ok":
+                        print(f"Erro ao listar: {resp.get('reason', 'causa desconhecida')}")
+                        break
+                    if "groups" in resp:
+                        print("Grupos disponíveis:", resp["groups"])
+                    print("Clientes disponíveis:", resp.get("clients", []))
+                    if not resp.get("next_cursor"):
+                        break
+                    more = await ainput("Mais? (s/n) ")
+                    if (more or "").strip().lower() != "s":
+                        break
+                    query["cursor"] = resp["next_cursor"]
             except Exception as e:
                 print("Erro:", e)
 
@@ -165,62 +1456,46 @@ async def interactive(server_host, server_port, cacert, client_id):
                     print("Erro: Você precisa especificar pelo menos um membro para o grupo.")
                     continue
 
-                members.append(client_id)
-
             except (ValueError, IndexError):
                 print("Formato de comando inválido. Use: criar grupo <nome> com <membro1> <membro2>...")
                 continue
 
-            # gerar chave simétrica para o grupo
-            group_key = os.urandom(SecretBox.KEY_SIZE)
-            groups[group_id] = {"key": group_key, "history": []}
-
-            # informar o servidor sobre o novo grupo
-            await client.send_recv(
-                {
-                    "type": "create_group",
-                    "group_id": group_id,
-                    "members": members,
-                    "admin": client_id,
-                }
-            )
-
-            # distribuir a chave para cada membro
             print(f"[GRUPO] Distribuindo chave para o grupo '{group_id}'...")
-            for member in members:
-                if member == client_id:
-                    continue
-
-                # pegar chave pública do membro
-                resp = await client.send_recv({"type": "get_key", "client_id": member})
-                if resp.get("status") != "ok":
-                    print(f"  - Erro ao obter chave de {member}: {resp.get('reason')}")
-                    continue
+            resp = await chat.create_group(group_id, members)
+            if resp.get("status") != "ok":
+                print(f"Erro ao criar grupo: {resp.get('reason')}")
+                continue
+            show_key_results(resp)
 
-                peer_pub = PublicKey(ub64(resp["pubkey"]))
-                box = Box(priv, peer_pub)
-
-                # cifrar a chave do grupo para este membro
-                key_blob = box.encrypt(group_key)
-
-                # envelopar e enviar
-                envelope = {
-                    "type": "group_key_distribution",
-                    "group_id": group_id,
-                    "sender_pub": b64(pub),
-                    "key_blob": b64(key_blob),
-                }
-                payload = {
-                    "type": "send_blob",
-                    "to": member,
-                    "from": client_id,
-                    "blob": b64(json.dumps(envelope).encode()),
-                }
-                await client.send_recv(payload)
-                print(f"  - Chave enviada para {member}")
+        elif cmd in ("adicionar", "remover"):
+            # adicionar|remover <grupo> <membro1> <membro2> ...: só o admin
+            args = line.strip().split()[1:]
+            if len(args) < 2:
+                print(f"Uso: {cmd} <grupo> <membro1> <membro2> ...")
+                continue
+            group_id, changed = args[0], args[1:]
+            if cmd == "adicionar":
+                resp = await chat.add_members(group_id, changed)
+            else:
+                resp = await chat.remove_members(group_id, changed)
+            if resp.get("status") != "ok":
+                print(f"Erro ao mudar membros: {resp.get('reason')}")
+                continue
+            if not resp["added"] and not resp["removed"]:
+                print("Nada a mudar.")
+                continue
+            if resp["rekey"].get("status") != "ok":
+                print(f"Erro ao enviar a troca de chave: {resp['rekey'].get('reason')}")
+            print(
+                f"[GRUPO] {len(resp['added'])} entraram e {len(resp['removed'])} saíram de"
+                f" '{group_id}' (troca de chave com {resp['updates']} cifragens)"
+            )
+            show_key_results(resp)
 
         elif cmd == "conversas":
-            active_convs = list(conversations.keys()) + list(groups.keys())
+            # conversas de sessões anteriores vêm do histórico
+            known = history.conversations()
+            active_convs = list(dict.fromkeys([*known, *groups]))
             if not active_convs:
                 print("Nenhuma conversa ativa.")
                 continue
@@ -229,109 +1504,79 @@ async def interactive(server_host, server_port, cacert, client_id):
             for peer in active_convs:
                 count = new_msgs.get(peer, 0)
                 msg_info = f" ({count} novas)" if count else ""
-                conv_type = "[grupo]" if peer in groups else "[privado]"
+                conv_type = "[grupo]" if peer in groups or known.get(peer) else "[privado]"
                 print(f" - {peer}{msg_info} {conv_type}")
 
-            peer_choice = (
-                await ainput("Entrar em qual conversa (ou Enter para voltar)? ")
-            ).strip()
+            try:
+                peer_choice = (
+                    await ainput("Entrar em qual conversa (ou Enter para voltar)? ")
+                ).strip()
+            except EOFError:
+                peer_choice = ""
             if not peer_choice or peer_choice not in active_convs:
                 continue
 
             peer = peer_choice
             new_msgs[peer] = 0
+            is_group = peer in groups or known.get(peer)
 
-            # --- Lógica de Chat em Grupo ---
-            if peer in groups:
-                group = groups[peer]
-                if not group.get("key"):
+            if is_group:
+                group = groups.get(peer)
+                if group is None or group["keys"] is None:
+                    # a chave do grupo não é guardada: dá para reler o histórico,
+                    # mas enviar só depois de receber a chave nesta sessão
                     print("Aguardando recebimento da chave deste grupo.")
+                    show_history(peer)
                     continue
+                title, target = f"Conversa em Grupo: {peer}", {"group_id": peer}
+            else:
+                box, err = await chat.peer_box(peer)
+                if box is None:
+                    print("Não foi possível obter chave do peer:", err)
+                    continue
+                title, target = f"Conversa com {peer}", {"to": peer}
+            print(
+                f"=== {title} === (digite /quit para sair,"
+                " /arquivo <caminho> para enviar e /baixar <id> para baixar anexos)"
+            )
 
-                group_box = SecretBox(group["key"])
-                print(f"=== Conversa em Grupo: {peer} === (digite /quit para sair)")
-
-                # Mostrar histórico do grupo
-                for entry in group["history"]:
-                    ts = time.strftime("%H:%M:%S")
-                    if entry[0] == "received_group":
-                        m = entry[1]
-                        try:
-                            pt = group_box.decrypt(ub64(m["blob"]))
-                            print(f"[{ts}] {m['from']}: {pt.decode()}")
-                        except:
-                            print(
-                                f"[{ts}] {m['from']}: <erro ao decifrar mensagem de grupo>"
-                            )
-                    else:
-                        ts, sender, msg = entry
-                        print(f"[{ts}] {sender}: {msg}")
-
-                # Loop de chat
-                while True:
-                    text = await ainput("")
-                    if text.strip() == "/quit":
-                        print(f"Saindo da conversa com {peer}.\n")
-                        show_menu()
-                        break
-
-                    ts = time.strftime("%H:%M:%S")
-                    cipher = group_box.encrypt(text.encode())
-                    payload = {
-                        "type": "send_group_blob",
-                        "group_id": peer,
-                        "from": client_id,
-                        "blob": b64(cipher),
-                    }
-                    await client.send_recv(payload)
-                    group["history"].append((ts, client_id, text))
-                    print(f"[{ts}] {client_id}: {text}")
-                continue  # Volta para o loop principal
-
-            # --- Lógica de Chat Privado (existente) ---
-            resp = await client.send_recv({"type": "get_key", "client_id": peer})
-            if resp.get("status") != "ok":
-                print("Não foi possível obter chave do peer:", resp)
-                continue
-            peer_pub = PublicKey(ub64(resp["pubkey"]))
-            box = Box(priv, peer_pub)
-            print(f"=== Conversa com {peer} === (digite /quit para sair)")
-
-            for entry in conversations[peer]:
-                ts = time.strftime("%H:%M:%S")
-                if entry[0] == "received":
-                    m = entry[1]
-                    env = json.loads(base64.b64decode(m["blob"]).decode())
-                    cipher = ub64(env["blob"])
-                    sender_pub = PublicKey(ub64(env["sender_pub"]))
-                    msg_box = Box(priv, sender_pub)
-                    try:
-                        pt = msg_box.decrypt(cipher)
-                        print(f"[{ts}] {m['from']}: {pt.decode()}")
-                    except:
-                        print(f"[{ts}] {m['from']}: <erro ao decifrar>")
-                else:
-                    ts, sender, msg = entry
-                    print(f"[{ts}] {sender}: {msg}")
+            # a última página do histórico
+            cursor = show_history(peer)
+            current["peer"] = peer
 
             while True:
-                text = await ainput("")
+                try:
+                    text = await ainput("")
+                except EOFError:
+                    text = "/quit"
                 if text.strip() == "/quit":
+                    current["peer"] = None
                     print(f"Saindo da conversa com {peer}.\n")
                     show_menu()
                     break
-                ts = time.strftime("%H:%M:%S")
-                cipher = box.encrypt(text.encode())
-                envelope = {"sender_pub": b64(pub), "blob": b64(cipher)}
-                payload = {
-                    "type": "send_blob",
-                    "to": peer,
-                    "from": client_id,
-                    "blob": b64(json.dumps(envelope).encode()),
-                }
-                await client.send_recv(payload)
-                conversations[peer].append((ts, client_id, text))
-                print(f"[{ts}] {client_id}: {text}")
+                if text.strip() == "/mais":
+                    if cursor is not None:
+                        cursor = show_history(peer, cursor)
+                    continue
+                if text.startswith("/baixar "):
+                    await fetch_file(text[len("/baixar ") :].strip())
+                    continue
+                kind = "text"
+                if text.startswith("/arquivo "):
+                    desc = await send_file(text[len("/arquivo ") :].strip(), peer, target)
+                    if desc is None:
+                        continue
+                    text, kind = json.dumps(desc), "file"
+                tag = (peer, label(text, kind))
+                if is_group:
+                    msg, err = await chat.send_group(peer, text, kind, tag)
+                else:
+                    # a chave vem do cache; muda só se o servidor avisou troca de chave do par
+                    msg, err = await chat.send(peer, text, kind, tag)
+                if msg is None:
+                    print("Não foi possível enviar:", err)
+                    continue
+                print(format_entry(msg.ts, msg.sender, msg.text, msg.kind))
 
         elif cmd == "iniciar":
             if len(parts) < 3 or parts[1].lower() != "chat":
@@ -341,13 +1586,14 @@ async def interactive(server_host, server_port, cacert, client_id):
             if peer == client_id:
                 print("Não é possível iniciar chat consigo mesmo.")
                 continue
-            if peer not in conversations:
-                conversations[peer] = []
+            history.touch(peer)
             print(f"Conversa com {peer} criada. Use 'Conversas' para entrar nela.")
 
         elif cmd == "sair":
             print("Encerrando cliente...")
-            poll_task.cancel()
+            await chat.close()
+            flush_task.cancel()
+            history.close()
             break
         else:
             print("Comando desconhecido.")
@@ -356,9 +1602,43 @@ async def interactive(server_host, server_port, cacert, client_id):
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
-    p.add_argument("--server", required=True)
+    p.add_argument(
+        "--server", required=True, help="host:porta, ou wss://host:porta para o gateway WebSocket"
+    )
     p.add_argument("--cacert")
     p.add_argument("--id", required=True)
+    p.add_argument(
+        "--no-compress",
+        action="store_true",
+        help="não comprime mensagens longas antes de cifrar",
+    )
+    p.add_argument(
+        "--history",
+        help="arquivo do histórico cifrado (padrão: history-<id>.db; a chave fica em"
+        " <arquivo>.key, ou vem da passphrase em CHAT_HISTORY_PASSPHRASE)",
+    )
+    p.add_argument(
+        "--no-history", action="store_true", help="histórico só em memória, perdido ao sair"
+    )
+    p.add_argument(
+        "--key",
+        help="chave privada do id (padrão: key-<id>.key, criada na primeira vez; o servidor"
+        " só aceita o id de volta com ela)",
+    )
     args = p.parse_args()
-    host, port = args.server.split(":")
-    asyncio.run(interactive(host, int(port), args.cacert, args.id))
+    websocket = args.server.startswith("wss://")
+    host, port = args.server.removeprefix("wss://").rstrip("/").rsplit(":", 1)
+    history_path = None if args.no_history else args.history or f"history-{args.id}.db"
+    asyncio.run(
+        interactive(
+            host,
+            int(port),
+            args.cacert,
+            args.id,
+            not args.no_compress,
+            history_path,
+            os.environ.get("CHAT_HISTORY_PASSPHRASE"),
+            websocket,
+            args.key,
+        )
+    )
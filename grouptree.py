@@ -0,0 +1,170 @@
+import json
+import os
+from collections import OrderedDict
+
+from nacl.exceptions import CryptoError
+from nacl.secret import SecretBox
+
+# Chaves de grupo numa árvore binária (LKH, "logical key hierarchy"): cada membro
+# ocupa uma folha e conhece as chaves do caminho da sua folha até a raiz; a chave
+# da raiz cifra as mensagens do grupo. Quando alguém entra ou sai, o admin troca
+# só as chaves dos ancestrais das folhas afetadas e cifra cada chave nova com as
+# chaves dos dois filhos: uma única mensagem de grupo com ~2·log2(N) cifragens
+# simétricas, em vez de um Box.encrypt e um blob por membro.
+#
+# Nós são "nível:posição"; as folhas ficam no nível 0 e o pai de (l, p) é
+# (l+1, p//2). A árvore cresce pondo uma raiz nova acima da antiga (que vira o
+# filho esquerdo), então o id de um nó nunca muda. Cada troca avança a época; a
+# mensagem de grupo leva a época da chave com que foi cifrada no meta.
+#   KeyTree(admin, members)         do admin: todas as chaves
+#       add(members) / remove(members) -> rekey (dict a mandar ao grupo)
+#       welcome(member) -> dict a mandar, cifrado com Box, a quem entrou
+#   MemberKeys(welcome)             de cada membro: só o caminho da sua folha
+#       apply(rekey) -> True/False  False se a época não é a seguinte ou
+#       a troca não abre com as nossas chaves
+#   .epoch, .box(epoch) -> SecretBox da raiz naquela época (ou None)
+KEEP_EPOCHS = 8  # chaves de raiz antigas mantidas para mensagens atrasadas
+
+
+def node_id(level, pos):
+    return f"{level}:{pos}"
+
+
+def path(leaf, depth):
+    return [node_id(level, leaf >> level) for level in range(depth + 1)]
+
+
+class GroupKeys:
+    def __init__(self, admin, epoch=0):
+        self.admin = admin
+        self.epoch = epoch
+        self._roots = OrderedDict()  # época -> SecretBox da raiz
+
+    def _set_root(self, key):
+        self._roots[self.epoch] = SecretBox(key)
+        while len(self._roots) > KEEP_EPOCHS:
+            self._roots.popitem(last=False)
+
+    def box(self, epoch=None):
+        return self._roots.get(self.epoch if epoch is None else epoch)
+
+
+class KeyTree(GroupKeys):
+    def __init__(self, admin, members):
+        # members inclui o admin
+        super().__init__(admin)
+        self.depth = 0
+        self.keys = {}  # nó -> chave, só de nós com alguma folha ocupada abaixo
+        self.leaves = {}  # membro -> posição da folha
+        self._count = {}  # nó -> folhas ocupadas abaixo dele
+        self._free = []  # folhas liberadas, reaproveitadas antes de crescer
+        self._next = 0
+        self._change(added=members)
+
+    def _assign(self, member):
+        if self._free:
+            leaf = self._free.pop()
+        else:
+            leaf = self._next
+            self._next += 1
+            while leaf >= 1 << self.depth:
+                # a raiz nova fica acima da antiga e herda as folhas dela
+                root = node_id(self.depth, 0)
+                self._count[node_id(self.depth + 1, 0)] = self._count.get(root, 0)
+                self.depth += 1
+        self.leaves[member] = leaf
+        return leaf
+
+    def _change(self, added=(), removed=()):
+        joined = set()
+        touched = set()
+        for member in removed:
+            leaf = self.leaves.pop(member)
+            self._free.append(leaf)
+            for node in path(leaf, self.depth):
+                self._count[node] -= 1
+                touched.add(node)
+        for member in added:
+            leaf = self._assign(member)
+            for node in path(leaf, self.depth):
+                self._count[node] = self._count.get(node, 0) + 1
+                touched.add(node)
+            self.keys[node_id(0, leaf)] = os.urandom(SecretBox.KEY_SIZE)
+            joined.add(node_id(0, leaf))
+        # a raiz muda a cada troca (o admin tem folha, então ela nunca fica vazia)
+        touched.add(node_id(self.depth, 0))
+        updates = []
+        for node in sorted(touched, key=lambda n: int(n.split(":")[0])):
+            level, pos = map(int, node.split(":"))
+            if level == 0 and node in joined:
+                continue
+            if not self._count.get(node):
+                # ninguém abaixo: a chave sai da árvore em vez de ser trocada
+                self.keys.pop(node, None)
+                self._count.pop(node, None)
+                continue
+            key = self.keys[node] = os.urandom(SecretBox.KEY_SIZE)
+            for child in (node_id(level - 1, 2 * pos), node_id(level - 1, 2 * pos + 1)):
+                # quem entrou recebe o caminho inteiro no welcome
+                if level and child in self.keys and child not in joined:
+                    updates.append([node, child, SecretBox(self.keys[child]).encrypt(key)])
+        if self._roots:
+            self.epoch += 1
+        self._set_root(self.keys[node_id(self.depth, 0)])
+        return {"epoch": self.epoch, "depth": self.depth, "updates": updates}
+
+    def add(self, members):
+        return self._change(added=[m for m in dict.fromkeys(members) if m not in self.leaves])
+
+    def remove(self, members):
+        gone = [m for m in dict.fromkeys(members) if m in self.leaves and m != self.admin]
+        return self._change(removed=gone)
+
+    def welcome(self, member):
+        leaf = self.leaves[member]
+        return {
+            "admin": self.admin,
+            "epoch": self.epoch,
+            "depth": self.depth,
+            "leaf": leaf,
+            "keys": {node: self.keys[node].hex() for node in path(leaf, self.depth)},
+        }
+
+
+class MemberKeys(GroupKeys):
+    def __init__(self, welcome):
+        super().__init__(welcome["admin"], welcome["epoch"])
+        self.depth = welcome["depth"]
+        self.leaf = welcome["leaf"]
+        self.keys = {node: bytes.fromhex(key) for node, key in welcome["keys"].items()}
+        self._set_root(self.keys[node_id(self.depth, 0)])
+
+    def apply(self, rekey):
+        if rekey["epoch"] != self.epoch + 1:
+            return False
+        keys = dict(self.keys)
+        for node, under, cipher in rekey["updates"]:
+            key = keys.get(under)
+            if key is not None:
+                try:
+                    keys[node] = SecretBox(key).decrypt(cipher)
+                except CryptoError:
+                    return False  # não é a nossa árvore (saímos do grupo?)
+        self.keys = keys
+        self.depth = rekey["depth"]
+        self.epoch = rekey["epoch"]
+        self._set_root(self.keys[node_id(self.depth, 0)])
+        return True
+
+
+def encode_rekey(rekey):
+    updates = [[node, under, cipher.hex()] for node, under, cipher in rekey["updates"]]
+    return json.dumps({**rekey, "updates": updates}).encode()
+
+
+def decode_rekey(data):
+    rekey = json.loads(data)
+    rekey["updates"] = [
+        [node, under, bytes.fromhex(cipher)] for node, under, cipher in rekey["updates"]
+    ]
+    return rekey
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from nacl.pwhash import argon2id
+from nacl.secret import SecretBox
+from nacl.utils import random as random_bytes
+
+# Histórico local das conversas, em SQLite e cifrado em repouso com SecretBox. As
+# mensagens são gravadas já decifradas da chave de transporte (uma vez, quando
+# chegam ou são enviadas) e recifradas com a chave do histórico; o cliente não
+# guarda o histórico em memória e lê só a página que vai mostrar.
+#   add(peer, sender, text, kind="text", ts=None, group=False, body=None)
+#   seal(sender, text, kind) -> body   cifra uma entrada; pode rodar em outra
+#       thread, e o body vai depois para add (lotes grandes de mensagens)
+#   page(peer, limit, before=None) -> ([(ts, sender, text, kind)], cursor)
+#       as limit entradas mais recentes anteriores a before, da mais velha para a
+#       mais nova; cursor é o before da página anterior (None se não há mais)
+#   conversations() -> {peer: é_grupo}
+#   flush() / close()
+#
+# O nome do par não vai em claro para o disco: o índice usa uma tag (BLAKE2b com
+# chave) e o nome fica cifrado na tabela de conversas. Só o horário de cada
+# mensagem fica em claro, para ordenar e paginar.
+HISTORY_PAGE = 20
+
+
+class HistoryStore:
+    def __init__(self, path, key, batch_size=256):
+        self.batch_size = batch_size
+        self._box = SecretBox(key)
+        self._tag_key = hashlib.blake2b(b"history-index", key=key).digest()
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                tag BLOB PRIMARY KEY,
+                name BLOB NOT NULL,
+                is_group INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                tag BLOB NOT NULL,
+                ts REAL NOT NULL,
+                body BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_tag ON messages (tag, id);
+            """
+        )
+        # poucas conversas, muitas mensagens: só os nomes ficam em memória
+        self._peers = {}  # peer -> tag
+        self._groups = {}  # peer -> é_grupo
+        for tag, name, is_group in self._db.execute(
+            "SELECT tag, name, is_group FROM conversations"
+        ):
+            try:
+                peer = self._box.decrypt(name).decode()
+            except Exception:
+                continue  # linha de outra chave: ignorada
+            self._peers[peer] = tag
+            self._groups[peer] = bool(is_group)
+        self._dirty = 0
+        self._db.execute("BEGIN")
+
+    def _tag(self, peer, group):
+        tag = self._peers.get(peer)
+        if tag is None:
+            tag = hashlib.blake2b(peer.encode(), key=self._tag_key, digest_size=16).digest()
+            self._db.execute(
+                "INSERT OR IGNORE INTO conversations (tag, name, is_group) VALUES (?, ?, ?)",
+                (tag, self._box.encrypt(peer.encode()), int(group)),
+            )
+            self._peers[peer] = tag
+            self._groups[peer] = group
+        return tag
+
+    def seal(self, sender, text, kind="text"):
+        return self._box.encrypt(json.dumps([sender, text, kind]).encode())
+
+    def add(self, peer, sender, text, kind="text", ts=None, group=False, body=None):
+        if body is None:
+            body = self.seal(sender, text, kind)
+        self._db.execute(
+            "INSERT INTO messages (tag, ts, body) VALUES (?, ?, ?)",
+            (self._tag(peer, group), time.time() if ts is None else ts, body),
+        )
+        self._dirty += 1
+        if self._dirty >= self.batch_size:
+            self.flush()
+
+    def page(self, peer, limit=HISTORY_PAGE, before=None):
+        tag = self._peers.get(peer)
+        if tag is None:
+            return [], None
+        rows = self._db.execute(
+            "SELECT id, ts, body FROM messages WHERE tag = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (tag, before if before is not None else 2**63 - 1, limit + 1),
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        entries = []
+        for _, ts, body in reversed(rows):
+            sender, text, kind = json.loads(self._box.decrypt(body))
+            entries.append((ts, sender, text, kind))
+        return entries, rows[-1][0] if more else None
+
+    def conversations(self):
+        return dict(self._groups)
+
+    def touch(self, peer, group=False):
+        # conversa sem mensagens ainda (iniciar chat, grupo recém-criado)
+        self._tag(peer, group)
+        self._dirty += 1
+
+    def flush(self):
+        if not self._dirty:
+            return
+        self._db.execute("COMMIT")
+        self._dirty = 0
+        self._db.execute("BEGIN")
+
+    def close(self):
+        self._db.execute("COMMIT")
+        self._db.close()
+
+
+def history_key(path, passphrase=None):
+    # com passphrase a chave é derivada com Argon2id (o sal fica em path.salt);
+    # sem ela, uma chave aleatória em path.key, legível só pelo dono
+    if passphrase is not None:
+        salt_path = path + ".salt"
+        if os.path.exists(salt_path):
+            with open(salt_path, "rb") as f:
+                salt = f.read()
+        else:
+            salt = random_bytes(argon2id.SALTBYTES)
+            with open(salt_path, "wb") as f:
+                f.write(salt)
+        return argon2id.kdf(SecretBox.KEY_SIZE, passphrase.encode(), salt)
+    key_path = path + ".key"
+    try:
+        with open(key_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        key = random_bytes(SecretBox.KEY_SIZE)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        return key
+
+
+def open_history(path=None, passphrase=None):
+    # path None: histórico só desta sessão, em memória
+    if path is None:
+        return HistoryStore(":memory:", random_bytes(SecretBox.KEY_SIZE))
+    return HistoryStore(path, history_key(path, passphrase))
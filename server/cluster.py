@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+
+from wire import FrameError, decode_frame, encode_frame, read_frame
+
+log = logging.getLogger("cluster")
+
+# Comunicação entre os workers (--workers N) e o processo mestre, que faz o papel
+# de broker local via socket Unix. Os frames usam o mesmo framing binário do
+# protocolo dos clientes (wire.py), então o ciphertext passa sem base64.
+#
+# Mensagens têm um campo "op". Pedidos que esperam resposta levam "rid", e a
+# resposta volta com o mesmo "rid"; o resto é fire-and-forget nos dois sentidos.
+
+
+class ClusterLink:
+    # lado do worker
+    def __init__(self, path, worker_id, on_message):
+        self.path = path
+        self.worker_id = worker_id
+        self.on_message = on_message
+        self.ready = None
+        self.closed = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self._pending = {}  # rid -> Future
+
+    async def connect(self, retries=50):
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        self.closed = loop.create_future()
+        for attempt in range(retries):
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == retries - 1:
+                    raise
+                await asyncio.sleep(0.1)
+        asyncio.create_task(self._recv_loop(reader))
+        self.send({"op": "hello", "worker": self.worker_id})
+        # o broker manda o estado replicado (chaves, grupos) e então "ready"
+        await self.ready
+
+    def send(self, msg):
+        self._writer.write(encode_frame(msg))
+
+    async def request(self, msg):
+        rid = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        self.send({**msg, "rid": rid})
+        return await fut
+
+    async def _recv_loop(self, reader):
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                msg = decode_frame(payload)
+                rid = msg.pop("rid", None)
+                if rid is not None:
+                    fut = self._pending.pop(rid, None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(msg)
+                elif msg.get("op") == "ready":
+                    self.ready.set_result(True)
+                else:
+                    self.on_message(msg)
+        except (OSError, FrameError, asyncio.IncompleteReadError) as e:
+            log.error("[CLUSTER] Conexão com o broker caiu: %s", e)
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_result({"status": "error", "reason": "broker indisponível"})
+            if not self.ready.done():
+                self.ready.set_exception(ConnectionError("broker indisponível"))
+            if not self.closed.done():
+                self.closed.set_result(True)
+
+
+class Broker:
+    # lado do mestre; handler(worker_id, msg) roda no event loop e devolve a
+    # resposta (dict) ou None
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        self.workers = {}  # worker_id -> writer
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self.workers.values()):
+            writer.close()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._server.wait_closed(), 2)
+
+    def send_to(self, worker_id, msg):
+        writer = self.workers.get(worker_id)
+        if writer is not None and not writer.is_closing():
+            writer.write(encode_frame(msg))
+
+    def broadcast(self, msg, exclude=None):
+        frame = encode_frame(msg)
+        for worker_id, writer in self.workers.items():
+            if worker_id != exclude and not writer.is_closing():
+                writer.write(frame)
+
+    async def _handle(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                msg = decode_frame(payload)
+                if msg.get("op") == "hello":
+                    worker_id = msg["worker"]
+                    self.workers[worker_id] = writer
+                rid = msg.pop("rid", None)
+                try:
+                    reply = self.handler(worker_id, msg)
+                except Exception:
+                    log.exception("[CLUSTER] Erro tratando %s do worker %s", msg.get("op"), worker_id)
+                    reply = {"status": "error", "reason": "erro no broker"}
+                if reply is not None and rid is not None:
+                    writer.write(encode_frame({**reply, "rid": rid}))
+                await writer.drain()
+        except (OSError, FrameError, asyncio.IncompleteReadError) as e:
+            log.warning("[CLUSTER] Worker %s desconectou: %s", worker_id, e)
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.handler(worker_id, {"op": "worker_down"})
+            writer.close()
@@ -0,0 +1,56 @@
+import bisect
+
+# Índice ordenado de client_ids para o list_all: paginação por cursor (o último id
+# devolvido) e busca por prefixo em O(log n + página), sem percorrer nem copiar
+# o diretório inteiro a cada "Listar".
+
+
+class ClientIndex:
+    def __init__(self, ids=()):
+        self._ids = sorted(set(ids))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, client_id):
+        i = bisect.bisect_left(self._ids, client_id)
+        return i < len(self._ids) and self._ids[i] == client_id
+
+    def add(self, client_id):
+        i = bisect.bisect_left(self._ids, client_id)
+        if i == len(self._ids) or self._ids[i] != client_id:
+            self._ids.insert(i, client_id)
+
+    def update(self, ids):
+        # carga em bloco (estado inicial de um worker): uma ordenação só
+        new = set(ids).difference(self._ids)
+        if len(new) > 64:
+            self._ids = sorted(self._ids + list(new))
+        else:
+            for client_id in new:
+                self.add(client_id)
+
+    def discard(self, client_id):
+        i = bisect.bisect_left(self._ids, client_id)
+        if i < len(self._ids) and self._ids[i] == client_id:
+            del self._ids[i]
+
+    def page(self, prefix="", cursor=None, limit=100, exclude=None):
+        # até limit ids com o prefixo, depois de cursor; devolve também o cursor
+        # da próxima página (None se acabou)
+        ids = self._ids
+        start = bisect.bisect_left(ids, prefix)
+        if cursor is not None and cursor >= prefix:
+            start = max(start, bisect.bisect_right(ids, cursor))
+        out = []
+        i = start
+        while i < len(ids) and len(out) < limit:
+            client_id = ids[i]
+            if not client_id.startswith(prefix):
+                return out, None
+            if client_id != exclude:
+                out.append(client_id)
+            i += 1
+        if i < len(ids) and ids[i].startswith(prefix) and out:
+            return out, out[-1]
+        return out, None
@@ -0,0 +1,119 @@
+import json
+import os
+import re
+import secrets
+import shutil
+import time
+
+# Anexos grandes fora da fila BLOBS: cada arquivo é um diretório com meta.json e
+# um arquivo por chunk (o índice é o nome), gravado com rename atômico. O servidor
+# não entende o conteúdo: os chunks já chegam cifrados pelo cliente. Como o estado
+# está só no disco, o upload pode ser retomado depois de cair a conexão (ou de o
+# servidor reiniciar) e, com --workers, qualquer worker atende qualquer arquivo.
+#   create(owner, readers, size, chunk_size) -> file_id
+#   info(file_id) -> {"owner", "readers", "size", "chunk_size", "chunks", "created"} | None
+#   write_chunk(file_id, index, data) / read_chunk(file_id, index) -> bytes | None
+#   missing(file_id, limit) -> [índices ainda não recebidos]
+#   sweep() -> quantos arquivos expirados foram apagados
+
+GiB = 1024 * 1024 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+FILE_ID = re.compile(r"[0-9a-f]{32}")  # o id vira nome de diretório
+
+
+class FileSpool:
+    def __init__(self, root, max_size=1 * GiB, ttl=7 * 24 * 3600, cache_size=1024):
+        self.root = root
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._info = {}  # file_id -> meta (imutável depois do create)
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, file_id, name=""):
+        return os.path.join(self.root, file_id, name)
+
+    def create(self, owner, readers, size, chunk_size):
+        file_id = secrets.token_hex(16)
+        info = {
+            "owner": owner,
+            "readers": sorted(set(readers) - {owner}),
+            "size": size,
+            "chunk_size": chunk_size,
+            "chunks": max(1, -(-size // chunk_size)),
+            "created": time.time(),
+        }
+        os.makedirs(self._path(file_id))
+        self._write(self._path(file_id, "meta.json"), json.dumps(info).encode())
+        self._remember(file_id, info)
+        return file_id
+
+    def info(self, file_id):
+        info = self._info.get(file_id)
+        if info is None and FILE_ID.fullmatch(file_id):
+            try:
+                with open(self._path(file_id, "meta.json"), "rb") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._remember(file_id, info)
+        return info
+
+    def _remember(self, file_id, info):
+        if len(self._info) >= self.cache_size:
+            self._info.pop(next(iter(self._info)))
+        self._info[file_id] = info
+
+    def chunk_length(self, info, index):
+        # todos os chunks têm chunk_size bytes, menos o último
+        if index == info["chunks"] - 1:
+            return info["size"] - index * info["chunk_size"]
+        return info["chunk_size"]
+
+    def write_chunk(self, file_id, index, data):
+        self._write(self._path(file_id, str(index)), data)
+
+    def read_chunk(self, file_id, index):
+        try:
+            with open(self._path(file_id, str(index)), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def missing(self, file_id, limit=None):
+        info = self.info(file_id)
+        try:
+            have = {name for name in os.listdir(self._path(file_id)) if name.isdigit()}
+        except FileNotFoundError:
+            have = set()
+        out = []
+        for index in range(info["chunks"]):
+            if str(index) not in have:
+                out.append(index)
+                if limit is not None and len(out) >= limit:
+                    break
+        return out
+
+    def _write(self, path, data):
+        # o chunk só aparece com o nome final quando está inteiro no disco
+        tmp = f"{path}.{secrets.token_hex(4)}.part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def sweep(self):
+        # uploads completos ou não, apagados ttl segundos depois de criados
+        if not self.ttl:
+            return 0
+        deadline = time.time() - self.ttl
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not FILE_ID.fullmatch(entry.name):
+                continue
+            info = self.info(entry.name)
+            created = info["created"] if info else entry.stat().st_mtime
+            if created < deadline:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self._info.pop(entry.name, None)
+                removed += 1
+        return removed
@@ -1,3 +1,4 @@
+import argparse
 import ssl
 import tempfile
 import pathlib
@@ -5,10 +6,22 @@ from datetime import datetime, timedelta
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 
-# === Gerar chave privada RSA ===
-key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+p = argparse.ArgumentParser(description="Gera cert.pem e key.pem autoassinados")
+p.add_argument(
+    "--key-type",
+    choices=["rsa", "ecdsa"],
+    default="rsa",
+    help="ecdsa usa P-256: handshakes bem mais baratos para o servidor que RSA-2048",
+)
+args = p.parse_args()
+
+# === Gerar chave privada (RSA-2048 ou ECDSA P-256) ===
+if args.key_type == "ecdsa":
+    key = ec.generate_private_key(ec.SECP256R1())
+else:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
 key_bytes = key.private_bytes(
     encoding=serialization.Encoding.PEM,
     format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+log = logging.getLogger("keystore")
+
+# Diretório de chaves públicas: snapshot JSON (pubkeys.json) + journal append-only
+# (pubkeys.json.journal, uma linha ["client_id", "pubkey"] por atualização).
+# As escritas são agrupadas e feitas numa thread dedicada, fora do event loop;
+# quando o journal cresce demais, um novo snapshot é gravado num arquivo
+# temporário, renomeado atomicamente, e o journal é truncado.
+
+
+class KeyStore:
+    def __init__(self, path, snapshot_every=10000):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.snapshot_every = snapshot_every
+        self.keys = {}  # client_id -> base64 pubkey
+        self._batch = []
+        self._journal_len = 0
+        self._failing = False  # a última escrita falhou (já logado)
+        self._torn = False  # a última linha do journal pode ter ficado pela metade
+        # uma única thread: journal e snapshot nunca se intercalam
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def load(self):
+        if self.path.exists():
+            try:
+                with self.path.open("r") as f:
+                    self.keys = json.load(f)
+            except Exception as e:
+                log.error("erro ao ler %s, criando novo: %s", self.path.name, e)
+                self.keys = {}
+        else:
+            self._write_snapshot({})
+            log.info("✅ Arquivo %s criado vazio.", self.path.name)
+        if self.journal_path.exists():
+            with self.journal_path.open("r") as f:
+                for line in f:
+                    try:
+                        cid, pub = json.loads(line)
+                    except ValueError:
+                        continue  # linha incompleta (queda ou falha durante a escrita)
+                    self.keys[cid] = pub
+                    self._journal_len += 1
+        return self.keys
+
+    def set(self, client_id, pubkey_b64):
+        if self.keys.get(client_id) == pubkey_b64:
+            return
+        self.keys[client_id] = pubkey_b64
+        self._batch.append((client_id, pubkey_b64))
+
+    async def flush(self):
+        # uma escrita que falha (disco cheio, permissão) não derruba o run(): o lote
+        # volta para a fila e o snapshot é tentado de novo na próxima volta
+        loop = asyncio.get_running_loop()
+        failed = False
+        for fn, *args in self._submit():
+            try:
+                await loop.run_in_executor(self._executor, fn, *args)
+            except Exception:
+                if not self._failing:
+                    log.exception("erro ao gravar %s; tentando de novo", self.path.name)
+                failed = self._failing = True
+                if fn == self._append_journal:
+                    self._batch[:0] = args[0]
+                    self._journal_len = max(0, self._journal_len - len(args[0]))
+                else:
+                    self._journal_len = max(self._journal_len, self.snapshot_every)
+        if self._failing and not failed:
+            log.warning("gravação de %s voltou ao normal", self.path.name)
+            self._failing = False
+
+    def _submit(self):
+        jobs = []
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._journal_len += len(batch)
+            jobs.append((self._append_journal, batch))
+        if self._journal_len >= self.snapshot_every:
+            # a cópia é tirada no event loop: tudo que já foi para o journal está nela
+            self._journal_len = 0
+            jobs.append((self._write_snapshot, dict(self.keys), True))
+        return jobs
+
+    async def run(self, interval=0.1):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def close(self):
+        for job in self._submit():
+            self._executor.submit(*job)
+        self._executor.shutdown(wait=True)
+
+    def _append_journal(self, batch):
+        # depois de uma escrita que falhou, o lote começa numa linha nova: a anterior
+        # pode ter ficado pela metade (o load() pula linhas inválidas)
+        torn, self._torn = self._torn, True
+        with self.journal_path.open("a") as f:
+            if torn:
+                f.write("\n")
+            f.writelines(json.dumps([cid, pub]) + "\n" for cid, pub in batch)
+            f.flush()
+            os.fsync(f.fileno())
+        self._torn = False
+
+    def _write_snapshot(self, keys, truncate_journal=False):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump(keys, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if truncate_journal:
+            with self.journal_path.open("w"):
+                pass
+            self._torn = False
@@ -0,0 +1,80 @@
+import time
+
+# Limites por conexão e por cliente contra clientes lentos ou abusivos: quantas
+# conexões, tamanho máximo de mensagem, taxa de envio (token bucket), tempo ocioso
+# e quanto de saída pode ficar acumulado esperando um leitor lento.
+# Em todos, 0 desliga o limite.
+
+MiB = 1024 * 1024
+
+
+class Limits:
+    def __init__(
+        self,
+        max_connections=10000,
+        max_message=16 * MiB,
+        rate=100.0,
+        burst=200,
+        idle_timeout=300.0,
+        write_high_water=1 * MiB,
+        max_write_buffer=16 * MiB,
+    ):
+        self.max_connections = max_connections
+        self.max_message = max_message  # frame binário ou linha JSON (com o base64)
+        self.rate = rate  # mensagens por segundo por cliente, em média
+        self.burst = burst  # rajada aceita acima da média
+        self.idle_timeout = idle_timeout  # segundos sem nenhum pedido do cliente
+        self.write_high_water = write_high_water  # acima disso a resposta espera o drain
+        self.max_write_buffer = max_write_buffer  # acima disso o push desconecta o leitor
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n, now):
+        # um lote maior que a rajada é aceito com o balde cheio, e o esvazia
+        n = min(n, self.burst)
+        self.refill(now)
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class RateLimiter:
+    # um balde por chave (client_id); baldes que já encheram de novo são
+    # descartados quando o dicionário cresce, porque recriá-los dá no mesmo
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def allow(self, key, n=1):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket.take(n, now)
+
+    def _prune(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+        # todos ativos: sai o quarto mais antigo (ordem de criação)
+        if len(self.buckets) >= self.max_keys:
+            for key in list(self.buckets)[: self.max_keys // 4]:
+                del self.buckets[key]
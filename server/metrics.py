@@ -0,0 +1,240 @@
+import bisect
+import contextlib
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+# Instrumentação do servidor: contadores por tipo de mensagem, histogramas de
+# latência, bytes trafegados e gauges (conexões, fila offline). snapshot() vira a
+# resposta do comando "stats"; render() gera o formato texto do Prometheus.
+#
+# O log também fica aqui: o handler só enfileira o registro (QueueHandler) e uma
+# thread (LogWriter) formata e escreve no stdout em lotes, então o event loop
+# nunca bloqueia no terminal. Linhas emitidas a cada mensagem levam
+# extra=PER_MESSAGE e passam pela amostragem de --log-sample. A fila tem limite
+# (LOG_QUEUE): com o terminal mais lento que o servidor, as linhas que não cabem
+# são descartadas e contadas, e o LogWriter avisa quantas foram.
+
+PER_MESSAGE = {"per_message": True}
+LOG_QUEUE = 10000  # registros esperando a thread de escrita
+
+# limites dos buckets do histograma, em segundos
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1.0 or not getattr(record, "per_message", False):
+            return True
+        return random.random() < self.rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # o registro não sai do processo: a formatação fica para a thread de escrita
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    # esvazia a fila em lotes: uma escrita e um flush por lote, não por linha
+    def __init__(self, records, stream, formatter, handler):
+        super().__init__(name="log-writer", daemon=True)
+        self.records = records
+        self.stream = stream
+        self.formatter = formatter
+        self.handler = handler
+        self.reported = 0  # descartes já avisados
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            with contextlib.suppress(queue.Empty):
+                while len(batch) < 1024:
+                    batch.append(self.records.get_nowait())
+            done = None in batch
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record) + "\n")
+                except Exception:
+                    lines.append(f"<erro ao formatar log: {record.msg!r}>\n")
+            dropped = self.handler.dropped
+            if dropped > self.reported:
+                lines.append(f"<{dropped - self.reported} linhas de log descartadas: fila cheia>\n")
+                self.reported = dropped
+            with contextlib.suppress(OSError, ValueError):
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            if done:
+                return
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+
+def setup_logging(level="INFO", sample=1.0, prefix=""):
+    # chamado em cada processo depois do fork: a thread de escrita não é herdada
+    # cada LogRecord consultaria thread, processo e task do asyncio; nada disso vai
+    # para o formato, e o custo é pago em toda linha dentro do event loop
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging.logAsyncioTasks = False
+    records = queue.Queue(LOG_QUEUE)
+    handler = _QueueHandler(records)
+    handler.addFilter(SampleFilter(sample))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    formatter = logging.Formatter(f"%(asctime)s %(levelname)s {prefix}%(message)s")
+    writer = LogWriter(records, sys.stdout, formatter, handler)
+    writer.start()
+    return writer
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # o último é o +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # estimativa pelo limite superior do bucket (a resolução dos BUCKETS)
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}  # (type, status) -> n
+        self.latency = {}  # type -> Histogram
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.limited = {}  # limite atingido -> n (conexões, taxa, ociosidade...)
+        # mensagens comprimidas pelo cliente antes de cifrar: tamanho declarado do
+        # original e bytes que de fato trafegaram/ficaram na fila
+        self.compressed_messages = 0
+        self.compressed_plain_bytes = 0
+        self.compressed_wire_bytes = 0
+
+    def limit(self, reason):
+        self.limited[reason] = self.limited.get(reason, 0) + 1
+
+    def compressed(self, plain_size, wire_size):
+        self.compressed_messages += 1
+        self.compressed_plain_bytes += plain_size
+        self.compressed_wire_bytes += wire_size
+
+    def observe(self, mtype, status, seconds):
+        mtype = mtype or "invalid"
+        key = (mtype, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        hist = self.latency.get(mtype)
+        if hist is None:
+            hist = self.latency[mtype] = Histogram()
+        hist.observe(seconds)
+
+    def snapshot(self, gauges):
+        requests = {}
+        for (mtype, status), n in sorted(self.requests.items()):
+            requests.setdefault(mtype, {})[status] = n
+        latency = {
+            mtype: {
+                "count": hist.count,
+                "mean_ms": round(hist.sum / hist.count * 1000, 3) if hist.count else 0.0,
+                "p50_ms": hist.quantile(0.5) * 1000,
+                "p99_ms": hist.quantile(0.99) * 1000,
+            }
+            for mtype, hist in sorted(self.latency.items())
+        }
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": requests,
+            "latency": latency,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "limited": dict(sorted(self.limited.items())),
+            "compression": {
+                "messages": self.compressed_messages,
+                "plain_bytes": self.compressed_plain_bytes,
+                "wire_bytes": self.compressed_wire_bytes,
+                "saved_bytes": self.compressed_plain_bytes - self.compressed_wire_bytes,
+            },
+            **gauges,
+        }
+
+    def render(self, gauges, labels=None):
+        # formato texto do Prometheus (exposition format 0.0.4)
+        extra = "".join(f',{k}="{v}"' for k, v in (labels or {}).items())
+        plain = "{" + extra[1:] + "}" if extra else ""
+        lines = [
+            "# TYPE chat_requests_total counter",
+            *(
+                f'chat_requests_total{{type="{mtype}",status="{status}"{extra}}} {n}'
+                for (mtype, status), n in sorted(self.requests.items())
+            ),
+            "# TYPE chat_request_duration_seconds histogram",
+        ]
+        for mtype, hist in sorted(self.latency.items()):
+            cumulative = 0
+            for bound, n in zip((*BUCKETS, "+Inf"), hist.counts):
+                cumulative += n
+                lines.append(
+                    f'chat_request_duration_seconds_bucket{{type="{mtype}",le="{bound}"{extra}}} {cumulative}'
+                )
+            lines.append(f'chat_request_duration_seconds_sum{{type="{mtype}"{extra}}} {hist.sum}')
+            lines.append(f'chat_request_duration_seconds_count{{type="{mtype}"{extra}}} {hist.count}')
+        lines += [
+            "# TYPE chat_received_bytes_total counter",
+            f"chat_received_bytes_total{plain} {self.bytes_in}",
+            "# TYPE chat_sent_bytes_total counter",
+            f"chat_sent_bytes_total{plain} {self.bytes_out}",
+            "# TYPE chat_compressed_messages_total counter",
+            f"chat_compressed_messages_total{plain} {self.compressed_messages}",
+            "# TYPE chat_compression_saved_bytes_total counter",
+            f"chat_compression_saved_bytes_total{plain} "
+            f"{self.compressed_plain_bytes - self.compressed_wire_bytes}",
+            "# TYPE chat_limited_total counter",
+            *(
+                f'chat_limited_total{{reason="{reason}"{extra}}} {n}'
+                for reason, n in sorted(self.limited.items())
+            ),
+        ]
+        for name, value in sorted(gauges.items()):
+            if isinstance(value, (int, float)):
+                lines += [f"# TYPE chat_{name} gauge", f"chat_{name}{plain} {value}"]
+        return "\n".join(lines) + "\n"
@@ -1,231 +1,1836 @@
 #!/usr/bin/env python3
 import asyncio
+import base64
+import binascii
 import builtins
 import contextlib
-import json
+import hmac
+import logging
+import os
+import signal
 import ssl
+import sys
+import tempfile
+import time
 from argparse import ArgumentParser
 from pathlib import Path
 
+from nacl.exceptions import CryptoError
+from nacl.public import Box, PrivateKey, PublicKey
+from websockets.asyncio.server import serve as ws_serve
+from websockets.exceptions import ConnectionClosed
+from websockets.protocol import State
+
+from directory import ClientIndex
+from files import MAX_CHUNK, FileSpool
+from keystore import KeyStore
+from limits import Limits, RateLimiter
+from metrics import PER_MESSAGE, Metrics, setup_logging
+from storage import MemoryStore, open_store
+
+# wire.py fica na raiz do repositório e é compartilhado com o cliente
+sys.path.insert(1, str(Path(__file__).resolve().parent.parent))
+from wire import (  # noqa: E402
+    HEADER_FIELDS,
+    FRAME_CHUNK,
+    MAX_BATCH,
+    MAX_FRAME,
+    PROTO_BINARY,
+    FrameError,
+    FrameReader,
+    decode_body,
+    decode_header,
+    decode_json,
+    encode_frame,
+    encode_json,
+)
+from cluster import Broker, ClusterLink  # noqa: E402
+
+log = logging.getLogger("server")
+# a biblioteca registra cada conexão WebSocket aberta/fechada em INFO
+logging.getLogger("websockets").setLevel(logging.WARNING)
+
 PUBKEYS_FILE = Path("pubkeys.json")
-PUBLIC_KEYS = {}  # client_id -> base64 pubkey
-BLOBS = {}  # recipient_id -> [ {from, blob(base64), meta} ]
-ACTIVE_CLIENTS = {}  # client_id -> {reader, writer}
+KEYSTORE = KeyStore(PUBKEYS_FILE)
+PUBLIC_KEYS = KEYSTORE.keys  # client_id -> base64 pubkey
+FEATURES = {}  # client_id -> recursos anunciados no publish_key (ex.: "zlib"); só em memória
+BLOBS = MemoryStore()  # fila offline: recipient_id -> [Queued(from, blob, meta)]
+ACTIVE_CLIENTS = {}  # client_id -> Connection inscrita/registrada
+DIRECTORY = ClientIndex()  # client_ids com chave publicada, ordenados (list_all)
+ONLINE = ClientIndex()  # client_ids conectados: ACTIVE_CLIENTS, ou PRESENCE no mestre
+LIST_PAGE = 100  # tamanho padrão da página do list_all
+# o backlog do subscribe sai em páginas de até SUBSCRIBE_PAGE mensagens e PAGE_BYTES
+# de blob, para nenhuma resposta passar de MAX_FRAME
+SUBSCRIBE_PAGE = 500
+PAGE_BYTES = 4 * 1024 * 1024
 GROUPS = {}  # group_id -> { "members": [client_id], "admin": client_id }
+MEMBER_GROUPS = {}  # client_id -> {group_id} (índice reverso de GROUPS)
+CONNECTIONS = set()  # Connection de todas as conexões abertas
+KEY_WATCHERS = {}  # client_id -> {Connection} que pediram essa chave (recebem key_update)
+METRICS = Metrics()
+FILES = None  # FileSpool dos anexos (chunks em disco, fora de BLOBS)
+LIMITS = Limits()
+# par de chaves só para os desafios de sessão (nunca cifra mensagens); o desafio de
+# cada conexão vai na resposta do hello
+SESSION_KEY = PrivateKey.generate()
+SESSION_PUB = bytes(SESSION_KEY.public_key)
+SEND_RATE = RateLimiter(LIMITS.rate, LIMITS.burst)  # client_id -> token bucket
+# contexto TLS do servidor, criado antes do fork: os workers herdam a mesma chave
+# de tickets e retomam sessões abertas em qualquer um deles
+TLS = None
+TLS_TICKETS = 1  # tickets de sessão por handshake TLS 1.3 (o cliente guarda só um)
 
+# --workers N: cada worker tem réplicas de PUBLIC_KEYS/GROUPS e fala com o broker
+# (processo mestre), que é o único dono do KEYSTORE, da fila BLOBS e da presença
+CLUSTER = None  # ClusterLink, nos workers
+BROKER = None  # Broker, no mestre
+PRESENCE = {}  # client_id -> worker_id (só no mestre)
 
-# --- Inicialização do JSON ---
+
+# --- Inicialização do diretório de chaves (snapshot + journal) ---
 def init_pubkeys():
-    global PUBLIC_KEYS
-    if PUBKEYS_FILE.exists():
-        with PUBKEYS_FILE.open("r") as f:
-            try:
-                PUBLIC_KEYS = json.load(f)
-            except Exception as e:
-                print("erro ao ler pubkeys.json, criando novo:", e)
-                PUBLIC_KEYS = {}
+    global PUBLIC_KEYS, DIRECTORY
+    PUBLIC_KEYS = KEYSTORE.load()
+    DIRECTORY = ClientIndex(PUBLIC_KEYS)
+
+
+# --- Registra nova chave; a escrita em disco é feita em lote fora do event loop ---
+def store_pubkey(client_id, pubkey_b64, features=()):
+    if PUBLIC_KEYS.get(client_id) != pubkey_b64:
+        notify_key_change(client_id, pubkey_b64, features)
+    DIRECTORY.add(client_id)
+    set_features(client_id, features)
+    if CLUSTER is not None:
+        # o mestre persiste e replica a chave para os outros workers
+        PUBLIC_KEYS[client_id] = pubkey_b64
+        CLUSTER.send(
+            {"op": "key", "client_id": client_id, "pubkey": pubkey_b64, "features": features}
+        )
     else:
-        PUBLIC_KEYS = {}
-        with PUBKEYS_FILE.open("w") as f:
-            json.dump(PUBLIC_KEYS, f, indent=2)
-        print("✅ Arquivo pubkeys.json criado vazio.")
+        KEYSTORE.set(client_id, pubkey_b64)
+    log.info("[+] Nova chave pública recebida de %s: %s", client_id, pubkey_b64, extra=PER_MESSAGE)
+
+
+def set_features(client_id, features):
+    if features:
+        FEATURES[client_id] = list(features)
+    else:
+        FEATURES.pop(client_id, None)
+
+
+# quem consultou a chave de um cliente guarda o Box calculado com ela; se a chave
+# muda, avisa por push para o cache do cliente ser invalidado
+def watch_key(conn, client_id):
+    KEY_WATCHERS.setdefault(client_id, set()).add(conn)
+    conn.watching.add(client_id)
+
+
+def unwatch_keys(conn):
+    for client_id in conn.watching:
+        watchers = KEY_WATCHERS.get(client_id)
+        if watchers is not None:
+            watchers.discard(conn)
+            if not watchers:
+                del KEY_WATCHERS[client_id]
+    conn.watching.clear()
+
+
+def notify_key_change(client_id, pubkey_b64, features=()):
+    frame = {
+        "type": "key_update",
+        "client_id": client_id,
+        "pubkey": pubkey_b64,
+        "features": list(features),
+    }
+    for conn in KEY_WATCHERS.get(client_id, ()):
+        if not conn.is_closing():
+            conn.write(frame)
+
+
+# --- Conexão: framing JSON por linha ou binário (negociado com "hello") ---
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = FrameReader(reader, max_size=LIMITS.max_message or MAX_FRAME)
+        self.addr = writer.get_extra_info("peername")
+        self.init_state()
+        if LIMITS.write_high_water:
+            # acima disso o drain das respostas espera: o cliente que não lê deixa
+            # de ser atendido em vez de acumular saída no servidor
+            writer.transport.set_write_buffer_limits(high=LIMITS.write_high_water)
+
+    def init_state(self):
+        # sessão: identidade provada no publish_key e usada por todos os handlers
+        # no lugar de client_id/from das mensagens
+        self.client_id = None
+        self.pubkey = None
+        self.challenge = os.urandom(32)
+        self.proto = "json"
+        self.subscribed = False
+        self.done = False  # disconnect: encerra depois da resposta
+        self.watching = set()  # client_ids cujas chaves esta conexão consultou
+        self.req_type = None  # pedido em andamento, para as métricas de latência
+        self.req_start = 0.0
+        self.last_active = time.perf_counter()  # início do último pedido (ociosidade)
+        self.idle_timeout = LIMITS.idle_timeout
+
+    def encode(self, obj):
+        if self.proto == PROTO_BINARY:
+            return encode_frame(obj)
+        return encode_json(obj)
+
+    def write(self, obj):
+        self.write_raw(self.encode(obj))
+
+    def write_raw(self, data):
+        METRICS.bytes_out += len(data)
+        self.writer.write(data)
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        # sem tentar mandar o que está no buffer: para quem parou de ler
+        self.writer.transport.abort()
+
+    async def shutdown(self):
+        # fim da conexão: espera a saída pendente sair por até CLOSE_TIMEOUT
+        self.writer.close()
+        try:
+            await asyncio.wait_for(self.writer.wait_closed(), CLOSE_TIMEOUT)
+        except BaseException:
+            # leitor parado (ou servidor encerrando): descarta a saída pendente
+            self.writer.transport.abort()
+
+    def backlogged(self):
+        # saída pendente além do máximo: o leitor não acompanha o que recebe
+        limit = LIMITS.max_write_buffer
+        return bool(limit) and self.writer.transport.get_write_buffer_size() > limit
+
+    @property
+    def rate_key(self):
+        return self.client_id or self.addr
 
+    async def read(self):
+        # (cabeçalho, corpo ainda não decodificado), ou (None, None) quando o
+        # cliente fechou. No modo json a linha inteira é o cabeçalho e não há corpo.
+        # ValueError se a mensagem não decodifica
+        if self.proto == PROTO_BINARY:
+            payload = await self.frames.read()
+            if payload is None:
+                return None, None
+            METRICS.bytes_in += len(payload) + 4
+            header, pos = decode_header(payload)
+            return header, (payload, pos)
+        line = await self.frames.readline()
+        if not line:
+            return None, None
+        METRICS.bytes_in += len(line)
+        msg = decode_json(line)
+        if not isinstance(msg, dict):
+            raise ValueError("a mensagem deve ser um objeto JSON")
+        return msg, None
 
-# --- Atualiza JSON ao receber nova chave ---
-def store_pubkey(client_id, pubkey_b64):
-    global PUBLIC_KEYS
-    PUBLIC_KEYS[client_id] = pubkey_b64
-    with PUBKEYS_FILE.open("w") as f:
-        json.dump(PUBLIC_KEYS, f, indent=2)
-    print(f"[+] Nova chave pública recebida de {client_id}: {pubkey_b64}")
+    def decode_body(self, header, body):
+        if body is None:
+            return header
+        msg = decode_body(*body)
+        msg.update(header)
+        return msg
+
+    def begin(self, mtype):
+        self.req_type = mtype
+        self.req_start = self.last_active = time.perf_counter()
+
+    def finish(self, status):
+        METRICS.observe(self.req_type, status, time.perf_counter() - self.req_start)
+
+
+# --- Conexão WebSocket: mesma sessão e mesmos handlers, outro transporte ---
+# Cada mensagem do WebSocket é um pedido: texto com um objeto JSON, ou binário com
+# o payload de um frame bin1 (sem o u32 de tamanho, que o WebSocket já dá). As
+# respostas seguem o proto negociado no hello. O WebSocket mantém a conexão viva
+# com ping/pong e não há idle_timeout: um cliente parado continua conectado.
+# write() continua síncrono: os envios passam por uma fila com uma tarefa que os
+# entrega em ordem, e os bytes na fila fazem o papel do buffer de escrita do TCP.
+WS_PING = 20.0  # intervalo do ping do servidor e prazo para o pong
+
+
+class WSConnection(Connection):
+    def __init__(self, ws):
+        self.ws = ws
+        self.addr = ws.remote_address
+        self.init_state()
+        self.idle_timeout = None
+        self._queue = asyncio.Queue()
+        self._queued = 0  # bytes na fila de saída
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = False
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def encode(self, obj):
+        if self.proto == PROTO_BINARY:
+            return memoryview(encode_frame(obj))[4:]
+        return encode_json(obj)[:-1]
+
+    def write_raw(self, data):
+        if self._closed:
+            return
+        METRICS.bytes_out += len(data)
+        self._queue.put_nowait((data, self.proto != PROTO_BINARY))
+        self._queued += len(data)
+        if LIMITS.write_high_water and self._queued > LIMITS.write_high_water:
+            self._writable.clear()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                data, text = await self._queue.get()
+                await self.ws.send(data, text=text)
+                self._queued -= len(data)
+                if self._queued <= LIMITS.write_high_water:
+                    self._writable.set()
+        except ConnectionClosed:
+            pass
+        finally:
+            self._closed = True
+            self._writable.set()
+
+    def is_closing(self):
+        return self._closed or self.ws.state is not State.OPEN
+
+    async def drain(self):
+        await self._writable.wait()
+
+    def close(self):
+        # sem esperar a fila: usado com leitores lentos e conexões ociosas
+        self._closed = True
+        self._sender.cancel()
+        self.ws.transport.close()
+
+    def abort(self):
+        self._closed = True
+        self._sender.cancel()
+        self.ws.transport.abort()
+
+    async def shutdown(self):
+        # o que já está na fila sai antes do close do WebSocket (feito pela
+        # biblioteca quando o handler retorna)
+        if not self._closed:
+            with contextlib.suppress(BaseException):
+                await asyncio.wait_for(self._flush(), CLOSE_TIMEOUT)
+        self._sender.cancel()
+
+    async def _flush(self):
+        while self._queued and not self._closed:
+            await asyncio.sleep(0.01)
+
+    def backlogged(self):
+        limit = LIMITS.max_write_buffer
+        return bool(limit) and self._queued > limit
+
+    async def read(self):
+        try:
+            message = await self.ws.recv()
+        except ConnectionClosed:
+            return None, None
+        METRICS.bytes_in += len(message)
+        if isinstance(message, str):
+            msg = decode_json(message)
+            if not isinstance(msg, dict):
+                raise ValueError("a mensagem deve ser um objeto JSON")
+            return msg, None
+        header, pos = decode_header(message)
+        return header, (message, pos)
+
+
+def as_blob(value):
+    # o ciphertext é guardado e repassado em bytes; no modo json ele chega em base64
+    if isinstance(value, bytes):
+        return value
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        return None
 
 
 # --- Funções auxiliares ---
-async def send_ok(writer, payload):
+# req_id é devolvido na resposta para o cliente casar pedidos em pipeline
+async def send_ok(conn, payload, req_id=None):
     obj = {"status": "ok", **payload}
-    writer.write((json.dumps(obj) + "\n").encode())
-    await writer.drain()
+    if req_id is not None:
+        obj["req_id"] = req_id
+    conn.finish("ok")
+    conn.write(obj)
+    await conn.drain()
 
 
-async def send_error(writer, reason):
+async def send_error(conn, reason, req_id=None):
     obj = {"status": "error", "reason": reason}
-    writer.write((json.dumps(obj) + "\n").encode())
-    await writer.drain()
+    if req_id is not None:
+        obj["req_id"] = req_id
+    conn.finish("error")
+    conn.write(obj)
+    await conn.drain()
 
 
-# --- Handler de conexões ---
-async def handle_reader(reader, writer):
-    addr = writer.get_extra_info("peername")
-    client_id = None
+# --- Grupos ---
+def register_group(group_id, group):
+    GROUPS[group_id] = group
+    for member in group["members"]:
+        MEMBER_GROUPS.setdefault(member, set()).add(group_id)
+
+
+def apply_members(group_id, added, removed):
+    # idempotente: no cluster o worker de origem recebe também o broadcast.
+    # Devolve (quem de fato entrou, quem de fato saiu)
+    group = GROUPS[group_id]
+    current = set(group["members"])
+    added = [m for m in dict.fromkeys(added) if m not in current]
+    removed = [m for m in dict.fromkeys(removed) if m in current and m != group["admin"]]
+    if removed:
+        gone = set(removed)
+        group["members"] = [m for m in group["members"] if m not in gone]
+    group["members"].extend(added)
+    for member in added:
+        MEMBER_GROUPS.setdefault(member, set()).add(group_id)
+    for member in removed:
+        groups = MEMBER_GROUPS.get(member)
+        if groups is not None:
+            groups.discard(group_id)
+            if not groups:
+                del MEMBER_GROUPS[member]
+    return added, removed
+
+
+def init_groups():
+    for group_id, group in BLOBS.load_groups().items():
+        register_group(group_id, group)
+
+
+def fetch_pending(client_id, limit=None, max_bytes=None):
+    # fila direta do destinatário + o que ele ainda não leu nos logs dos seus grupos.
+    # Com limit, lê no máximo limit entradas, e com max_bytes para antes de passar
+    # de max_bytes de blob (a primeira mensagem sempre vem); more indica que ficou
+    # algo para trás (cada fetch confirma o que devolveu, então a próxima página
+    # começa dali)
+    items = BLOBS.fetch(client_id, limit, max_bytes)
+    if BLOBS.pending(client_id):
+        return items, True
+    read = len(items)
+    size = sum(len(item["blob"]) for item in items)
+    for group_id in MEMBER_GROUPS.get(client_id, ()):
+        if (limit is not None and read >= limit) or (
+            max_bytes is not None and size >= max_bytes
+        ):
+            return items, True
+        page = BLOBS.fetch_group(
+            group_id,
+            client_id,
+            None if limit is None else limit - read,
+            None if max_bytes is None else max_bytes - size,
+        )
+        read += len(page)
+        size += sum(len(item["blob"]) for item in page)
+        items.extend(item for item in page if item["from"] != client_id)
+        if BLOBS.group_pending(group_id, client_id):
+            return items, True
+    return items, False
+
+
+# --- Presença ---
+def set_active(client_id, conn):
+    ACTIVE_CLIENTS[client_id] = conn
+    ONLINE.add(client_id)
+
+
+def drop_active(client_id):
+    del ACTIVE_CLIENTS[client_id]
+    ONLINE.discard(client_id)
+
+
+def go_offline(conn):
+    # a conexão deixa de ser a do cliente: aqui e, no cluster, no broker. Também
+    # vale para quem caiu no meio do backlog do subscribe, antes de inscrito: o
+    # broker já o marcou como presente neste worker
+    client_id = conn.client_id
+    if ACTIVE_CLIENTS.get(client_id) is not conn:
+        return False
+    drop_active(client_id)
+    if CLUSTER is not None:
+        CLUSTER.send({"op": "offline", "client_id": client_id})
+    return True
+
+
+# --- Entrega por push ---
+def push_message(messages):
+    return {"type": "deliver", "messages": messages}
+
+
+def online_conn(client_id):
+    conn = ACTIVE_CLIENTS.get(client_id)
+    if conn is None or not conn.subscribed or conn.is_closing():
+        return None
+    if conn.backlogged():
+        # push não espera drain: um consumidor lento é desconectado, e o que
+        # vier para ele fica na fila offline até a próxima inscrição. abort, e não
+        # close: o close tentaria esvaziar o buffer que ele não está lendo, e o
+        # socket e o buffer ficariam vivos até o TCP desistir
+        log.warning("[LIMITE] %s não está lendo as mensagens, desconectando", client_id)
+        METRICS.limit("slow_consumer")
+        conn.abort()
+        return None
+    return conn
+
+
+def store_offline(recipient, item):
+    if not BLOBS.append(recipient, item):
+        log.warning("[FILA] Cota de mensagens offline de %s esgotada, descartando", recipient)
+        return None
+    return False
+
+
+async def deliver(recipient, item):
+    # entrega direto a quem está inscrito; só cai na fila BLOBS se estiver offline.
+    # não aguarda drain: um destinatário lento não pode travar o remetente
+    conn = online_conn(recipient)
+    if conn is not None:
+        conn.write(push_message([item]))
+        return True
+    if CLUSTER is not None:
+        # pode estar conectado em outro worker; o broker decide
+        resp = await CLUSTER.request({"op": "deliver", "to": recipient, "item": item})
+        return resp.get("result")
+    return store_offline(recipient, item)
+
+
+def push_group(item, members):
+    # escreve o push para os membros conectados neste processo e devolve quais
+    # receberam (o remetente conta como recebido, mas não recebe o frame)
+    frames = {}  # (transporte, proto) -> frame já serializado
+    delivered = []
+    for member in members:
+        member_conn = online_conn(member)
+        if member_conn is None:
+            continue
+        if member != item["from"]:
+            kind = (type(member_conn), member_conn.proto)
+            frame = frames.get(kind)
+            if frame is None:
+                frame = frames[kind] = member_conn.encode(push_message([item]))
+            member_conn.write_raw(frame)
+        delivered.append(member)
+    return delivered
+
+
+async def deliver_group(group_id, item):
+    # a mensagem é gravada uma única vez no log do grupo; quem está online
+    # recebe por push e tem o cursor avançado, quem está offline lê do log
+    # no próximo fetch. Devolve o seq no log, ou None se não foi gravada (erro
+    # no cluster)
+    if CLUSTER is not None:
+        resp = await CLUSTER.request(
+            {"op": "group_send", "group_id": group_id, "item": item}
+        )
+        return resp.get("seq")
+    seq = BLOBS.append_group(group_id, item)
+    if seq is None:
+        return None
+    for member in push_group(item, GROUPS[group_id]["members"]):
+        BLOBS.ack_group(group_id, member, seq + 1)
+    return seq
+
+
+async def take_pending(client_id, subscribe=False, limit=None, max_bytes=None):
+    if CLUSTER is not None:
+        op = "subscribe" if subscribe else "fetch"
+        resp = await CLUSTER.request(
+            {"op": op, "client_id": client_id, "limit": limit, "max_bytes": max_bytes}
+        )
+        return resp.get("messages", []), resp.get("more", False)
+    return fetch_pending(client_id, limit, max_bytes)
+
+
+# --- Broker (mestre) e mensagens vindas dele (workers) ---
+def send_groups(worker, chunk=10000):
+    # os grupos para um worker novo, em frames de até chunk membros. Um grupo maior
+    # vai em partes: o primeiro bloco o cria e os outros entram como group_members
+    groups, size = {}, 0
+    for group_id, group in GROUPS.items():
+        members = group["members"]
+        groups[group_id] = {**group, "members": members[:chunk]}
+        size += min(len(members), chunk) + 1
+        if size >= chunk or len(members) > chunk:
+            BROKER.send_to(worker, {"op": "groups", "groups": groups})
+            groups, size = {}, 0
+        for i in range(chunk, len(members), chunk):
+            BROKER.send_to(
+                worker,
+                {
+                    "op": "group_members",
+                    "group_id": group_id,
+                    "added": members[i : i + chunk],
+                    "removed": [],
+                },
+            )
+    if groups:
+        BROKER.send_to(worker, {"op": "groups", "groups": groups})
+
+
+def on_worker_message(worker, msg):
+    op = msg.get("op")
+    if op == "hello":
+        # estado inicial do worker, em blocos para não gerar frames gigantes
+        keys = list(PUBLIC_KEYS.items())
+        for i in range(0, len(keys), 10000):
+            chunk = dict(keys[i : i + 10000])
+            features = {cid: FEATURES[cid] for cid in chunk if cid in FEATURES}
+            BROKER.send_to(worker, {"op": "keys", "keys": chunk, "features": features})
+        send_groups(worker)
+        BROKER.send_to(worker, {"op": "ready"})
+    elif op == "key":
+        KEYSTORE.set(msg["client_id"], msg["pubkey"])
+        DIRECTORY.add(msg["client_id"])
+        set_features(msg["client_id"], msg.get("features"))
+        # o worker de origem já aplicou a chave; o eco chegaria depois de uma
+        # troca mais nova feita lá e a desfaria
+        BROKER.broadcast(msg, exclude=worker)
+    elif op == "create_group":
+        group_id = msg["group_id"]
+        if group_id in GROUPS:
+            return {"status": "error", "reason": "grupo já existe"}
+        BLOBS.add_group(group_id, msg["group"])
+        register_group(group_id, msg["group"])
+        BROKER.broadcast({"op": "group", "group_id": group_id, "group": msg["group"]})
+        return {"status": "ok"}
+    elif op == "group_members":
+        group_id = msg["group_id"]
+        if group_id not in GROUPS:
+            return {"status": "error", "reason": "grupo não encontrado"}
+        added, removed = apply_members(group_id, msg["added"], msg["removed"])
+        BLOBS.update_members(group_id, GROUPS[group_id], added, removed)
+        # só a diferença vai aos workers, não a lista inteira de membros
+        BROKER.broadcast(
+            {"op": "group_members", "group_id": group_id, "added": added, "removed": removed}
+        )
+        return {"status": "ok", "added": added, "removed": removed}
+    elif op == "subscribe":
+        # marcar presença e drenar a fila no mesmo passo: nada escapa entre os dois
+        PRESENCE[msg["client_id"]] = worker
+        ONLINE.add(msg["client_id"])
+        items, more = fetch_pending(msg["client_id"], msg.get("limit"), msg.get("max_bytes"))
+        return {"messages": items, "more": more}
+    elif op == "fetch":
+        items, more = fetch_pending(msg["client_id"], msg.get("limit"), msg.get("max_bytes"))
+        return {"messages": items, "more": more}
+    elif op == "offline":
+        if PRESENCE.get(msg["client_id"]) == worker:
+            del PRESENCE[msg["client_id"]]
+            ONLINE.discard(msg["client_id"])
+    elif op == "worker_down":
+        for cid in [c for c, w in PRESENCE.items() if w == worker]:
+            del PRESENCE[cid]
+            ONLINE.discard(cid)
+    elif op == "deliver":
+        target = PRESENCE.get(msg["to"])
+        if target is not None:
+            BROKER.send_to(target, msg)
+            return {"result": True}
+        return {"result": store_offline(msg["to"], msg["item"])}
+    elif op == "store":
+        store_offline(msg["to"], msg["item"])
+    elif op == "group_send":
+        group_id, item = msg["group_id"], msg["item"]
+        seq = BLOBS.append_group(group_id, item)
+        if seq is None:
+            return {"seq": None}
+        by_worker = {}
+        for member in GROUPS[group_id]["members"]:
+            target = PRESENCE.get(member)
+            if target is not None:
+                by_worker.setdefault(target, []).append(member)
+        for target, members in by_worker.items():
+            BROKER.send_to(
+                target,
+                {
+                    "op": "group_deliver",
+                    "group_id": group_id,
+                    "item": item,
+                    "seq": seq,
+                    "members": members,
+                },
+            )
+        return {"seq": seq}
+    elif op == "group_ack":
+        for member in msg["members"]:
+            BLOBS.ack_group(msg["group_id"], member, msg["next_seq"])
+    elif op == "stats":
+        return {"store": {**BLOBS.stats(), "online_clients": len(PRESENCE)}}
+    elif op == "list_online":
+        clients, next_cursor = ONLINE.page(
+            msg["prefix"], msg["cursor"], msg["limit"], msg["exclude"]
+        )
+        return {"clients": clients, "next_cursor": next_cursor}
+    return None
+
+
+def on_broker_message(msg):
+    op = msg.get("op")
+    if op == "keys":
+        PUBLIC_KEYS.update(msg["keys"])
+        DIRECTORY.update(msg["keys"])
+        FEATURES.update(msg.get("features", {}))
+    elif op == "key":
+        features = msg.get("features") or ()
+        if PUBLIC_KEYS.get(msg["client_id"]) != msg["pubkey"]:
+            notify_key_change(msg["client_id"], msg["pubkey"], features)
+        PUBLIC_KEYS[msg["client_id"]] = msg["pubkey"]
+        DIRECTORY.add(msg["client_id"])
+        set_features(msg["client_id"], features)
+    elif op == "groups":
+        for group_id, group in msg["groups"].items():
+            register_group(group_id, group)
+    elif op == "group":
+        register_group(msg["group_id"], msg["group"])
+    elif op == "group_members":
+        if msg["group_id"] in GROUPS:
+            apply_members(msg["group_id"], msg["added"], msg["removed"])
+    elif op == "deliver":
+        conn = online_conn(msg["to"])
+        if conn is not None:
+            conn.write(push_message([msg["item"]]))
+        else:
+            # desconectou enquanto a mensagem vinha: volta para a fila offline
+            CLUSTER.send({"op": "store", "to": msg["to"], "item": msg["item"]})
+    elif op == "group_deliver":
+        # só confirma quem de fato recebeu; quem caiu lê do log depois
+        delivered = push_group(msg["item"], msg["members"])
+        CLUSTER.send(
+            {
+                "op": "group_ack",
+                "group_id": msg["group_id"],
+                "members": delivered,
+                "next_seq": msg["seq"] + 1,
+            }
+        )
+
+
+# --- Métricas ---
+async def gauges():
+    values = {
+        "connections": len(CONNECTIONS),
+        "websocket_connections": sum(isinstance(c, WSConnection) for c in CONNECTIONS),
+        "active_clients": len(ACTIVE_CLIENTS),
+        "subscribed_clients": sum(1 for c in ACTIVE_CLIENTS.values() if c.subscribed),
+        "public_keys": len(PUBLIC_KEYS),
+        "groups": len(GROUPS),
+    }
+    if CLUSTER is not None:
+        # a fila offline mora no mestre
+        resp = await CLUSTER.request({"op": "stats"})
+        values.update(resp.get("store", {}))
+    else:
+        values.update(BLOBS.stats())
+    return values
+
+
+async def handle_metrics(reader, writer):
+    # HTTP mínimo para o Prometheus: qualquer GET recebe as métricas
     try:
-        while True:
-            line = await reader.readline()
-            if not line:
-                break
-            try:
-                msg = json.loads(line.decode())
-            except Exception as e:
-                await send_error(writer, f"invalid json: {e}")
-                continue
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        labels = {"worker": CLUSTER.worker_id} if CLUSTER is not None else None
+        body = METRICS.render(await gauges(), labels).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body)
+        )
+        writer.write(body)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
-            mtype = msg.get("type")
 
-            if mtype == "publish_key":
-                cid = msg.get("client_id")
-                pub = msg.get("pubkey")
-                if not cid or not pub:
-                    await send_error(writer, "publish_key requer client_id e pubkey")
-                    continue
+# --- Despacho das mensagens ---
+# Cada tipo tem um handler registrado com @handles, junto com o esquema dos campos:
+# required (obrigatórios e não vazios) e optional, nome -> tipo(s) aceito(s).
+# check(conn, msg) roda antes de decodificar o corpo, só com o cabeçalho de
+# roteamento (from/to/group_id no modo binário), e pode recusar o pedido sem tocar
+# no blob. Com session=True (o padrão) o pedido exige sessão aberta por publish_key;
+# o remetente é sempre conn.client_id, e client_id/from/admin das mensagens (que
+# clientes antigos ainda mandam) são ignorados.
+BLOB = (str, bytes)  # bytes no modo binário, base64 no modo json
+RATE_LIMITED = "limite de envio excedido, tente mais tarde"
+NO_SESSION = "sessão não autenticada: envie publish_key com a prova do hello"
+MAX_FEATURES = 16  # recursos aceitos por publish_key
+CLOSE_TIMEOUT = 10  # segundos para a saída pendente sair depois do close
+HANDLERS = {}  # type -> Handler
 
-                store_pubkey(cid, pub)
 
-                if cid not in ACTIVE_CLIENTS:
-                    print(f"[+] Novo cliente registrado: {cid} ({addr})")
-                    ACTIVE_CLIENTS[cid] = {"reader": reader, "writer": writer}
+def _join(names):
+    names = list(names)
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " e " + names[-1]
 
-                client_id = cid
-                await send_ok(writer, {"message": "key stored", "client_id": cid})
 
-            elif mtype == "get_key":
-                cid = msg.get("client_id")
-                if not cid:
-                    await send_error(writer, "get_key requer client_id")
-                    continue
+class Handler:
+    def __init__(self, mtype, fn, required, optional, check, rate_limited, session):
+        self.mtype = mtype
+        self.fn = fn
+        self.required = required
+        self.optional = optional
+        self.check = check
+        self.rate_limited = rate_limited  # consome do token bucket do remetente
+        self.session = session  # exige sessão autenticada (publish_key)
+        self.missing_reason = f"{mtype} requer {_join(required)}" if required else None
+        self.header_required = [f for f in required if f in HEADER_FIELDS]
 
-                pub = PUBLIC_KEYS.get(cid)
-
-                if not pub:
-                    await send_error(writer, "não encontrado")
-                else:
-                    print(f"[INFO] Enviando chave pública de {cid}")
-                    await send_ok(writer, {"client_id": cid, "pubkey": pub})
-
-            elif mtype == "send_blob":
-                to = msg.get("to")
-                frm = msg.get("from")
-                blob = msg.get("blob")
-                meta = msg.get("meta", {})
-                if not to or not frm or not blob:
-                    await send_error(writer, "send_blob requer to, from e blob")
-                    continue
-                BLOBS.setdefault(to, []).append(
-                    {"from": frm, "blob": blob, "meta": meta}
-                )
+    def validate_header(self, conn, header):
+        # só os campos que vêm no cabeçalho e o check; o resto é validado
+        # depois de decodificar o corpo
+        for name in self.header_required:
+            value = header.get(name)
+            if not value:
+                return self.missing_reason
+            if not isinstance(value, self.required[name]):
+                return f"{name} inválido"
+        if self.check is not None:
+            return self.check(conn, header)
+        return None
 
-                # log do transporte da mensagem cifrada
-                print(
-                    f"[TRANSPORTE] Mensagem cifrada recebida de {frm} -> {to}: {blob}"
-                )
-                await send_ok(writer, {"message": "stored"})
-
-            elif mtype == "create_group":
-                group_id = msg.get("group_id")
-                members = msg.get("members")
-                admin = msg.get("admin")
-                if not group_id or not members or not admin:
-                    await send_error(
-                        writer, "create_group requer group_id, members e admin"
-                    )
-                    continue
-                if group_id in GROUPS:
-                    await send_error(writer, "grupo já existe")
-                    continue
+    def validate(self, conn, msg, run_check=False):
+        for name, kind in self.required.items():
+            value = msg.get(name)
+            if not value:
+                return self.missing_reason
+            if not isinstance(value, kind):
+                return f"{name} inválido"
+        for name, kind in self.optional.items():
+            value = msg.get(name)
+            if value is not None and not isinstance(value, kind):
+                return f"{name} inválido"
+        if run_check and self.check is not None:
+            return self.check(conn, msg)
+        return None
 
-                GROUPS[group_id] = {"members": members, "admin": admin}
-                print(
-                    f"[GRUPO] Novo grupo criado: {group_id} por {admin} com membros {members}"
-                )
-                await send_ok(writer, {"message": "group created"})
-
-            elif mtype == "send_group_blob":
-                group_id = msg.get("group_id")
-                frm = msg.get("from")
-                blob = msg.get("blob")
-                if not group_id or not frm or not blob:
-                    await send_error(
-                        writer, "send_group_blob requer group_id, from e blob"
-                    )
-                    continue
-                if group_id not in GROUPS:
-                    await send_error(writer, "grupo não encontrado")
-                    continue
 
-                group = GROUPS[group_id]
-                if frm not in group["members"]:
-                    await send_error(writer, "você não é membro deste grupo")
-                    continue
+def handles(
+    mtype, required=None, optional=None, check=None, rate_limited=False, session=True
+):
+    def register(fn):
+        HANDLERS[mtype] = Handler(
+            mtype, fn, required or {}, optional or {}, check, rate_limited, session
+        )
+        return fn
+
+    return register
+
+
+def check_proof(conn, pubkey_b64, proof):
+    # o cliente cifra o desafio da conexão com Box(privada dele, SESSION_PUB): só
+    # quem tem a privada da chave publicada chega ao mesmo segredo compartilhado
+    if proof is None:
+        return "publish_key requer proof (o desafio do hello cifrado com a chave)"
+    try:
+        box = Box(SESSION_KEY, PublicKey(base64.b64decode(pubkey_b64, validate=True)))
+        answer = box.decrypt(as_blob(proof))
+    except (binascii.Error, TypeError, ValueError, CryptoError):
+        return "prova de posse da chave inválida"
+    if not hmac.compare_digest(answer, conn.challenge):
+        return "prova de posse da chave inválida"
+    return None
+
 
-                print(
-                    f"[GRUPO TRANSPORTE] Mensagem recebida de {frm} para o grupo {group_id}"
+@handles(
+    "publish_key",
+    required={"client_id": str, "pubkey": str},
+    optional={"proof": BLOB, "old_proof": BLOB, "features": list},
+    session=False,
+)
+async def on_publish_key(conn, msg, rid):
+    cid = msg["client_id"]
+    pubkey = msg["pubkey"]
+    features = [f for f in msg.get("features", ())[:MAX_FEATURES] if isinstance(f, str)]
+    if conn.client_id is not None and conn.client_id != cid:
+        await send_error(conn, f"a sessão desta conexão já é de {conn.client_id}", rid)
+        return
+    if pubkey != conn.pubkey:
+        # sessão nova ou troca de chave; republicar a mesma chave não precisa de prova
+        reason = check_proof(conn, pubkey, msg.get("proof"))
+        stored = PUBLIC_KEYS.get(cid)
+        if reason is None and stored not in (None, pubkey, conn.pubkey):
+            # o id já tem outra chave: a nova só entra com a prova da registrada, nesta
+            # conexão (old_proof, ou a sessão já aberta com ela). Sem isso, qualquer um
+            # tomaria o id publicando uma chave sua
+            if msg.get("old_proof") is None:
+                reason = (
+                    f"{cid} já tem outra chave: a troca requer old_proof "
+                    "(o desafio cifrado com ela)"
                 )
+            else:
+                reason = check_proof(conn, stored, msg["old_proof"])
+        if reason is not None:
+            await send_error(conn, reason, rid)
+            return
+        store_pubkey(cid, pubkey, features)
+    elif features != FEATURES.get(cid, []):
+        store_pubkey(cid, pubkey, features)
 
-                # distribuir a mensagem para todos os outros membros do grupo
-                for member in group["members"]:
-                    if member != frm:
-                        BLOBS.setdefault(member, []).append(
-                            {
-                                "from": frm,
-                                "blob": blob,
-                                "group_id": group_id,
-                                "type": "group",
-                            }
-                        )
-                # enviar confirmação de que a mensagem foi armazenada para o grupo
-                await send_ok(writer, {"message": "stored for group"})
-
-            elif mtype == "fetch_blobs":
-                cid = msg.get("client_id")
-                if not cid:
-                    await send_error(writer, "fetch_blobs requer client_id")
-                    continue
-                items = BLOBS.pop(cid, [])
-                await send_ok(writer, {"messages": items})
-
-            elif mtype == "list_all":
-                requester = msg.get("client_id")
-                clients = [c for c in PUBLIC_KEYS if c != requester]
-                await send_ok(writer, {"clients": clients})
-
-            # --- NOVO: desconexão explícita ---
-            elif mtype == "disconnect":
-                cid = msg.get("client_id")
-                if cid and cid in ACTIVE_CLIENTS:
-                    del ACTIVE_CLIENTS[cid]
-                    print(f"[+] Cliente desconectado: {cid}")
-                await send_ok(writer, {"message": "disconnected"})
+    if cid not in ACTIVE_CLIENTS:
+        log.info("[+] Novo cliente registrado: %s (%s)", cid, conn.addr, extra=PER_MESSAGE)
+    # a conexão é persistente: sempre aponta para o socket mais recente
+    set_active(cid, conn)
+
+    conn.client_id = cid
+    conn.pubkey = pubkey
+    await send_ok(conn, {"message": "key stored", "client_id": cid}, rid)
+
+
+@handles("get_key", required={"client_id": str})
+async def on_get_key(conn, msg, rid):
+    cid = msg["client_id"]
+    pub = PUBLIC_KEYS.get(cid)
+    watch_key(conn, cid)
+
+    if not pub:
+        await send_error(conn, "não encontrado", rid)
+    else:
+        log.info("[INFO] Enviando chave pública de %s", cid, extra=PER_MESSAGE)
+        await send_ok(
+            conn, {"client_id": cid, "pubkey": pub, "features": FEATURES.get(cid, [])}, rid
+        )
+
+
+@handles("get_keys", required={"client_ids": list})
+async def on_get_keys(conn, msg, rid):
+    cids = msg["client_ids"]
+    if not all(isinstance(c, str) for c in cids):
+        await send_error(conn, "get_keys requer client_ids", rid)
+        return
+    if len(cids) > MAX_BATCH:
+        await send_error(conn, f"no máximo {MAX_BATCH} client_ids por pedido", rid)
+        return
+    keys = {}
+    features = {}
+    missing = []
+    for cid in cids:
+        pub = PUBLIC_KEYS.get(cid)
+        watch_key(conn, cid)
+        if pub:
+            keys[cid] = pub
+            if cid in FEATURES:
+                features[cid] = FEATURES[cid]
+        else:
+            missing.append(cid)
+    log.info("[INFO] Enviando %d chaves públicas", len(keys), extra=PER_MESSAGE)
+    await send_ok(conn, {"keys": keys, "features": features, "missing": missing}, rid)
+
+
+def count_compressed(meta, blob):
+    # o conteúdo é opaco; o cliente declara em meta que comprimiu antes de cifrar e
+    # o tamanho original, e isso entra nas métricas de economia
+    size = meta.get("size") if meta.get("z") else None
+    if isinstance(size, int) and size > 0:
+        METRICS.compressed(size, len(blob))
+
+
+@handles(
+    "send_blob",
+    required={"to": str, "blob": BLOB},
+    optional={"meta": dict},
+    rate_limited=True,
+)
+async def on_send_blob(conn, msg, rid):
+    to = msg["to"]
+    frm = conn.client_id
+    blob = as_blob(msg["blob"])
+    if blob is None:
+        await send_error(conn, "blob inválido", rid)
+        return
+    meta = msg.get("meta", {})
+    count_compressed(meta, blob)
+    if await deliver(to, {"from": frm, "blob": blob, "meta": meta}) is None:
+        await send_error(conn, "fila do destinatário cheia", rid)
+        return
+
+    # log do transporte da mensagem cifrada
+    # o tamanho, não o ciphertext: o log não cresce com o payload.
+    # Com --log-level DEBUG o ciphertext continua visível
+    log.info(
+        "[TRANSPORTE] Mensagem cifrada recebida de %s -> %s (%d bytes)",
+        frm,
+        to,
+        len(blob),
+        extra=PER_MESSAGE,
+    )
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[TRANSPORTE] %s", base64.b64encode(blob).decode(), extra=PER_MESSAGE)
+    await send_ok(conn, {"message": "stored"}, rid)
+
+
+@handles("send_blobs", required={"messages": list})
+async def on_send_blobs(conn, msg, rid):
+    frm = conn.client_id
+    batch = msg["messages"]
+    if len(batch) > MAX_BATCH:
+        await send_error(conn, f"no máximo {MAX_BATCH} mensagens por pedido", rid)
+        return
+    # cada mensagem do lote conta como um envio
+    if not SEND_RATE.allow(conn.rate_key, len(batch)):
+        METRICS.limit("rate")
+        await send_error(conn, RATE_LIMITED, rid)
+        return
+    # um resultado por mensagem, na mesma ordem: uma falha não derruba o lote.
+    # As entregas correm juntas (no cluster, cada uma pode ir ao broker)
+    results = [None] * len(batch)
+    pending = {}
+    for i, entry in enumerate(batch):
+        to = entry.get("to") if isinstance(entry, dict) else None
+        blob = None
+        if isinstance(to, str) and to and entry.get("blob"):
+            blob = as_blob(entry["blob"])
+        if blob is None:
+            results[i] = {"status": "error", "reason": "mensagem requer to e blob válidos"}
+            continue
+        meta = entry.get("meta", {})
+        if not isinstance(meta, dict):
+            results[i] = {"status": "error", "reason": "meta inválido"}
+            continue
+        count_compressed(meta, blob)
+        pending[i] = deliver(to, {"from": frm, "blob": blob, "meta": meta})
+    outcomes = await asyncio.gather(*pending.values())
+    for i, outcome in zip(pending, outcomes):
+        if outcome is None:
+            results[i] = {"status": "error", "reason": "fila do destinatário cheia"}
+        else:
+            results[i] = {"status": "ok"}
+    log.info(
+        "[TRANSPORTE] Lote de %d mensagens cifradas recebido de %s",
+        len(batch),
+        frm,
+        extra=PER_MESSAGE,
+    )
+    await send_ok(conn, {"results": results}, rid)
+
+
+@handles(
+    "create_group",
+    required={"group_id": str, "members": list},
+    check=lambda conn, msg: "grupo já existe" if msg["group_id"] in GROUPS else None,
+)
+async def on_create_group(conn, msg, rid):
+    group_id = msg["group_id"]
+    members = msg["members"]
+    admin = conn.client_id
+    if not all(isinstance(m, str) and m for m in members):
+        await send_error(conn, "members deve ser uma lista de client_ids", rid)
+        return
+    if len(members) > MAX_BATCH:
+        await send_error(conn, f"no máximo {MAX_BATCH} membros por pedido", rid)
+        return
+    # o admin é sempre membro: senão criaria um grupo em que não pode escrever
+    members = list(dict.fromkeys([*members, admin]))
+
+    group = {"members": members, "admin": admin}
+    if CLUSTER is not None:
+        resp = await CLUSTER.request(
+            {"op": "create_group", "group_id": group_id, "group": group}
+        )
+        if resp.get("status") != "ok":
+            await send_error(conn, resp.get("reason", "erro no cluster"), rid)
+            return
+    else:
+        BLOBS.add_group(group_id, group)
+    register_group(group_id, group)
+    log.info(
+        "[GRUPO] Novo grupo criado: %s por %s com %d membros",
+        group_id,
+        admin,
+        len(members),
+    )
+    log.debug("[GRUPO] Membros de %s: %s", group_id, members)
+    await send_ok(conn, {"message": "group created"}, rid)
+
+
+def check_group_admin(conn, msg):
+    group = GROUPS.get(msg["group_id"])
+    if group is None:
+        return "grupo não encontrado"
+    if group["admin"] != conn.client_id:
+        return "só o admin do grupo muda os membros"
+    return None
+
+
+async def change_members(conn, msg, rid, added=(), removed=()):
+    group_id = msg["group_id"]
+    members = msg["members"]
+    if not all(isinstance(m, str) and m for m in members):
+        await send_error(conn, "members deve ser uma lista de client_ids", rid)
+        return
+    if len(members) > MAX_BATCH:
+        await send_error(conn, f"no máximo {MAX_BATCH} membros por pedido", rid)
+        return
+    if CLUSTER is not None:
+        resp = await CLUSTER.request(
+            {"op": "group_members", "group_id": group_id, "added": added, "removed": removed}
+        )
+        if resp.get("status") != "ok":
+            await send_error(conn, resp.get("reason", "erro no cluster"), rid)
+            return
+        added, removed = resp["added"], resp["removed"]
+        apply_members(group_id, added, removed)
+    else:
+        added, removed = apply_members(group_id, added, removed)
+        BLOBS.update_members(group_id, GROUPS[group_id], added, removed)
+    log.info(
+        "[GRUPO] %s: %d membros entraram e %d saíram (agora %d)",
+        group_id,
+        len(added),
+        len(removed),
+        len(GROUPS[group_id]["members"]),
+    )
+    payload = {"added": added, "removed": removed, "members": len(GROUPS[group_id]["members"])}
+    await send_ok(conn, payload, rid)
+
+
+# mudanças de membros: só o admin. A troca da chave do grupo é do cliente; quem
+# entra passa a ler o log do grupo a partir daqui, e quem sai para de receber
+# na hora, inclusive a mensagem de troca de chave que vem depois
+@handles(
+    "add_members", required={"group_id": str, "members": list}, check=check_group_admin
+)
+async def on_add_members(conn, msg, rid):
+    await change_members(conn, msg, rid, added=msg["members"])
+
+
+@handles(
+    "remove_members", required={"group_id": str, "members": list}, check=check_group_admin
+)
+async def on_remove_members(conn, msg, rid):
+    await change_members(conn, msg, rid, removed=msg["members"])
+
+
+def check_group_sender(conn, msg):
+    # o grupo vem no cabeçalho e o remetente é a sessão: quem não é membro é
+    # recusado sem decodificar o blob
+    group_id = msg["group_id"]
+    if group_id not in GROUPS:
+        return "grupo não encontrado"
+    if group_id not in MEMBER_GROUPS.get(conn.client_id, ()):
+        return "você não é membro deste grupo"
+    return None
+
+
+@handles(
+    "send_group_blob",
+    required={"group_id": str, "blob": BLOB},
+    optional={"meta": dict},
+    check=check_group_sender,
+    rate_limited=True,
+)
+async def on_send_group_blob(conn, msg, rid):
+    group_id = msg["group_id"]
+    frm = conn.client_id
+    blob = as_blob(msg["blob"])
+    if blob is None:
+        await send_error(conn, "blob inválido", rid)
+        return
+
+    log.info(
+        "[GRUPO TRANSPORTE] Mensagem recebida de %s para o grupo %s (%d bytes)",
+        frm,
+        group_id,
+        len(blob),
+        extra=PER_MESSAGE,
+    )
+
+    item = {"from": frm, "blob": blob, "group_id": group_id, "type": "group"}
+    meta = msg.get("meta")
+    if meta:
+        count_compressed(meta, blob)
+        item["meta"] = meta
+    if await deliver_group(group_id, item) is None:
+        await send_error(conn, "não foi possível gravar a mensagem do grupo", rid)
+        return
+    # enviar confirmação de que a mensagem foi armazenada para o grupo
+    await send_ok(conn, {"message": "stored for group"}, rid)
+
+
+# --- Anexos: upload em chunks cifrados, gravados em disco por FILES ---
+def check_file_target(conn, msg):
+    if bool(msg.get("to")) == bool(msg.get("group_id")):
+        return "upload_begin requer to ou group_id"
+    if msg.get("group_id"):
+        return check_group_sender(conn, msg)
+    return None
+
+
+@handles(
+    "upload_begin",
+    required={"size": int, "chunk_size": int},
+    optional={"to": str, "group_id": str},
+    check=check_file_target,
+    rate_limited=True,
+)
+async def on_upload_begin(conn, msg, rid):
+    size, chunk_size = msg["size"], msg["chunk_size"]
+    if not 0 < chunk_size <= MAX_CHUNK:
+        await send_error(conn, f"chunk_size deve estar entre 1 e {MAX_CHUNK}", rid)
+        return
+    if not 0 < size <= FILES.max_size:
+        await send_error(conn, f"size deve estar entre 1 e {FILES.max_size}", rid)
+        return
+    group_id = msg.get("group_id")
+    readers = GROUPS[group_id]["members"] if group_id else [msg["to"]]
+    file_id = FILES.create(conn.client_id, readers, size, chunk_size)
+    log.info(
+        "[ARQUIVO] Upload %s de %s (%d bytes) para %s",
+        file_id,
+        conn.client_id,
+        size,
+        group_id or msg["to"],
+        extra=PER_MESSAGE,
+    )
+    await send_ok(conn, {"file_id": file_id, "chunk_size": chunk_size}, rid)
+
+
+def file_for(conn, file_id, upload=False):
+    # só o dono envia chunks; dono e destinatários consultam e baixam
+    info = FILES.info(file_id)
+    if info is None:
+        return None
+    if info["owner"] == conn.client_id or (not upload and conn.client_id in info["readers"]):
+        return info
+    return None
+
+
+def chunk_index(info, offset):
+    index, rest = divmod(offset, info["chunk_size"])
+    if rest or not 0 <= index < info["chunks"]:
+        return None
+    return index
+
+
+@handles("upload_chunk", required={"file_id": str, "blob": BLOB}, optional={"offset": int})
+async def on_upload_chunk(conn, msg, rid):
+    # o offset é do arquivo cifrado; reenviar um chunk (retomada) o substitui
+    file_id = msg["file_id"]
+    info = file_for(conn, file_id, upload=True)
+    if info is None:
+        await send_error(conn, "arquivo não encontrado", rid)
+        return
+    index = chunk_index(info, msg.get("offset", 0))
+    if index is None:
+        await send_error(conn, "offset inválido", rid)
+        return
+    blob = as_blob(msg["blob"])
+    if blob is None or len(blob) != FILES.chunk_length(info, index):
+        await send_error(conn, "tamanho do chunk inválido", rid)
+        return
+    await asyncio.to_thread(FILES.write_chunk, file_id, index, blob)
+    await send_ok(conn, {"file_id": file_id, "offset": msg.get("offset", 0)}, rid)
+
+
+@handles("upload_status", required={"file_id": str})
+async def on_upload_status(conn, msg, rid):
+    # offsets ainda não recebidos (até MAX_BATCH): por onde retomar o upload
+    file_id = msg["file_id"]
+    info = file_for(conn, file_id)
+    if info is None:
+        await send_error(conn, "arquivo não encontrado", rid)
+        return
+    missing = await asyncio.to_thread(FILES.missing, file_id, MAX_BATCH)
+    payload = {
+        "file_id": file_id,
+        "size": info["size"],
+        "chunk_size": info["chunk_size"],
+        "missing": [index * info["chunk_size"] for index in missing],
+        "complete": not missing,
+    }
+    await send_ok(conn, payload, rid)
+
+
+@handles("download_chunk", required={"file_id": str}, optional={"offset": int})
+async def on_download_chunk(conn, msg, rid):
+    # um chunk por pedido: o cliente baixa vários em paralelo pelo req_id
+    file_id = msg["file_id"]
+    info = file_for(conn, file_id)
+    if info is None:
+        await send_error(conn, "arquivo não encontrado", rid)
+        return
+    offset = msg.get("offset", 0)
+    index = chunk_index(info, offset)
+    if index is None:
+        await send_error(conn, "offset inválido", rid)
+        return
+    blob = await asyncio.to_thread(FILES.read_chunk, file_id, index)
+    if blob is None:
+        await send_error(conn, "chunk ainda não recebido", rid)
+        return
+    await send_ok(conn, {"file_id": file_id, "offset": offset, "blob": blob}, rid)
+
+
+@handles("fetch_blobs", optional={"limit": int})
+async def on_fetch_blobs(conn, msg, rid):
+    limit = msg.get("limit")
+    if limit is not None and limit < 1:
+        await send_error(conn, "limit deve ser um inteiro positivo", rid)
+        return
+    # mesma paginação do subscribe: a resposta nunca passa de MAX_FRAME, e o
+    # resto fica para o próximo pedido ("more")
+    limit = min(limit or SUBSCRIBE_PAGE, SUBSCRIBE_PAGE)
+    items, more = await take_pending(conn.client_id, limit=limit, max_bytes=PAGE_BYTES)
+    await send_ok(conn, {"messages": items, "more": more}, rid)
+
+
+@handles("hello", optional={"proto": str}, session=False)
+async def on_hello(conn, msg, rid):
+    proto = msg.get("proto", "json")
+    if proto not in ("json", PROTO_BINARY):
+        await send_error(conn, "protocolo não suportado", rid)
+        return
+    # a resposta ainda sai no framing atual; depois dela, troca. idle_timeout
+    # avisa o cliente de que precisa mandar ping quando não tiver o que pedir;
+    # challenge e server_pub são o desafio da sessão (ver check_proof)
+    payload = {"proto": proto, "challenge": conn.challenge, "server_pub": SESSION_PUB}
+    if conn.idle_timeout:
+        payload["idle_timeout"] = conn.idle_timeout
+    await send_ok(conn, payload, rid)
+    conn.proto = proto
+
+
+@handles("ping", session=False)
+async def on_ping(conn, msg, rid):
+    await send_ok(conn, {"message": "pong"}, rid)
+
+
+@handles("subscribe")
+async def on_subscribe(conn, msg, rid):
+    cid = conn.client_id
+    # o que ficou na fila enquanto o cliente estava offline vai em páginas: as
+    # primeiras como push, antes da resposta (na ordem, esperando o drain), e a
+    # última na resposta. Até lá a conexão não recebe push, então o que chega
+    # nesse meio tempo cai na fila e vem numa das páginas seguintes
+    set_active(cid, conn)
+    items, more = await take_pending(cid, subscribe=True, limit=SUBSCRIBE_PAGE, max_bytes=PAGE_BYTES)
+    while more:
+        if items:
+            conn.write(push_message(items))
+            await conn.drain()
+        items, more = await take_pending(cid, limit=SUBSCRIBE_PAGE, max_bytes=PAGE_BYTES)
+    # a partir daqui as mensagens chegam por push nesta conexão
+    conn.subscribed = True
+    await send_ok(conn, {"message": "subscribed", "messages": items}, rid)
+    if CLUSTER is not None:
+        # o broker pode ter mandado algo entre a última página e a inscrição; o
+        # worker devolveu à fila (ver "deliver" em on_broker_message)
+        more = True
+        while more:
+            items, more = await take_pending(cid, limit=SUBSCRIBE_PAGE, max_bytes=PAGE_BYTES)
+            if items:
+                conn.write(push_message(items))
+                await conn.drain()
+
+
+@handles(
+    "list_all",
+    optional={"prefix": str, "cursor": str, "limit": int, "online": bool},
+)
+async def on_list_all(conn, msg, rid):
+    # uma página de clientes (por prefixo, opcionalmente só os online), a partir
+    # de cursor; a próxima página começa em next_cursor. Na primeira página vão
+    # também os grupos de que o requester é membro
+    requester = conn.client_id
+    limit = msg.get("limit", LIST_PAGE)
+    if limit < 1:
+        await send_error(conn, "limit deve ser um inteiro positivo", rid)
+        return
+    query = {
+        "prefix": msg.get("prefix", ""),
+        "cursor": msg.get("cursor"),
+        "limit": min(limit, MAX_BATCH),
+        "exclude": requester,
+    }
+    if msg.get("online") and CLUSTER is not None:
+        # a presença de todos os workers só o mestre conhece
+        resp = await CLUSTER.request({"op": "list_online", **query})
+        clients, next_cursor = resp.get("clients", []), resp.get("next_cursor")
+    else:
+        index = ONLINE if msg.get("online") else DIRECTORY
+        clients, next_cursor = index.page(**query)
+    payload = {"clients": clients, "next_cursor": next_cursor}
+    if query["cursor"] is None:
+        payload["groups"] = sorted(MEMBER_GROUPS.get(requester, ()))
+    await send_ok(conn, payload, rid)
+
+
+@handles("stats")
+async def on_stats(conn, msg, rid):
+    await send_ok(conn, {"stats": METRICS.snapshot(await gauges())}, rid)
+
+
+# --- NOVO: desconexão explícita ---
+@handles("disconnect")
+async def on_disconnect(conn, msg, rid):
+    if go_offline(conn):
+        log.info("[+] Cliente desconectado: %s", conn.client_id, extra=PER_MESSAGE)
+    await send_ok(conn, {"message": "disconnected"}, rid)
+    conn.done = True
+
+
+# --- Handler de conexões ---
+async def handle_reader(reader, writer):
+    if LIMITS.max_connections and len(CONNECTIONS) >= LIMITS.max_connections:
+        # recusa antes de alocar qualquer estado para a conexão
+        METRICS.limit("connections")
+        writer.write(encode_json({"status": "error", "reason": "servidor lotado, tente mais tarde"}))
+        writer.close()
+        with contextlib.suppress(builtins.BaseException):
+            await asyncio.wait_for(writer.wait_closed(), 2)
+        return
+    await serve(Connection(reader, writer))
+
+
+async def handle_websocket(ws):
+    if LIMITS.max_connections and len(CONNECTIONS) >= LIMITS.max_connections:
+        METRICS.limit("connections")
+        await ws.close(1013, "servidor lotado, tente mais tarde")
+        return
+    await serve(WSConnection(ws))
+
+
+async def serve(conn):
+    # o loop de pedidos de uma conexão, seja qual for o transporte
+    CONNECTIONS.add(conn)
+    try:
+        while not conn.done:
+            try:
+                header, body = await conn.read()
+            except FrameError as e:
+                # no modo binário não há como ressincronizar o stream (nem no json,
+                # se a linha passou do limite)
+                conn.begin(None)
+                await send_error(conn, f"invalid frame: {e}")
                 break
+            except ValueError as e:
+                conn.begin(None)
+                await send_error(conn, f"invalid json: {e}")
+                continue
+            if header is None:
+                break
+
+            if body is not None and "type" not in header:
+                # tipo sem código em wire.TYPES: o nome vai no corpo, que então
+                # precisa ser decodificado antes do despacho
+                try:
+                    header, body = conn.decode_body(header, body), None
+                except FrameError as e:
+                    conn.begin(None)
+                    await send_error(conn, f"invalid frame: {e}", header.get("req_id"))
+                    continue
 
+            rid = header.get("req_id")
+            handler = HANDLERS.get(header.get("type"))
+            conn.begin(handler.mtype if handler is not None else None)
+            if handler is None:
+                await send_error(conn, "unknown_type", rid)
+                continue
+            if handler.session and conn.client_id is None:
+                await send_error(conn, NO_SESSION, rid)
+                continue
+            if handler.rate_limited and not SEND_RATE.allow(conn.rate_key):
+                # recusado pelo cabeçalho, sem decodificar o blob
+                METRICS.limit("rate")
+                await send_error(conn, RATE_LIMITED, rid)
+                continue
+
+            if body is None:
+                # json, ou binário com o tipo no corpo: a mensagem já está inteira
+                msg = header
+                reason = handler.validate(conn, msg, run_check=True)
             else:
-                await send_error(writer, "unknown_type")
+                # binário, caminho rápido: o cabeçalho decide antes de o corpo
+                # (JSON e blobs) ser decodificado
+                reason = handler.validate_header(conn, header)
+                if reason is None:
+                    try:
+                        msg = conn.decode_body(header, body)
+                    except FrameError as e:
+                        # o frame foi lido inteiro: o stream continua sincronizado
+                        await send_error(conn, f"invalid frame: {e}", rid)
+                        continue
+                    reason = handler.validate(conn, msg)
+            if reason is not None:
+                await send_error(conn, reason, rid)
+                continue
+            await handler.fn(conn, msg, rid)
 
     except Exception as e:
-        print(f"[ERRO] Conexão com {client_id or addr} caiu: {e}")
+        log.warning("[ERRO] Conexão com %s caiu: %s", conn.client_id or conn.addr, e)
     finally:
-        writer.close()
-        with contextlib.suppress(builtins.BaseException):
-            await writer.wait_closed()
+        go_offline(conn)
+        unwatch_keys(conn)
+        CONNECTIONS.discard(conn)
+        await conn.shutdown()
+
+
+async def idle_loop(timeout):
+    # fecha as conexões sem nenhum pedido há mais de timeout segundos; clientes
+    # inscritos mandam ping (o intervalo vai na resposta do hello)
+    while True:
+        await asyncio.sleep(max(timeout / 4, 1.0))
+        deadline = time.perf_counter() - timeout
+        for conn in list(CONNECTIONS):
+            if conn.idle_timeout and conn.last_active < deadline and not conn.is_closing():
+                log.info("[LIMITE] Conexão ociosa com %s encerrada", conn.client_id or conn.addr)
+                METRICS.limit("idle")
+                conn.close()
+
+
+async def sweep_loop(interval):
+    # apaga os anexos mais velhos que o ttl
+    while True:
+        removed = await asyncio.to_thread(FILES.sweep)
+        if removed:
+            log.info("[ARQUIVO] %d anexos expirados apagados", removed)
+        await asyncio.sleep(interval)
+
+
+# --- Persistência da fila offline ---
+async def flush_loop(interval):
+    # agrupa os commits/fsyncs das escritas feitas durante o intervalo. Um erro não
+    # para o loop (a tarefa não é aguardada por ninguém): sem ele, nada mais seria
+    # gravado nem compactado
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            BLOBS.flush()
+        except Exception:
+            log.exception("[FILA] Erro no flush da fila offline")
 
 
 # --- Main ---
-async def main(certfile, keyfile, host="0.0.0.0", port=4433):
+def server_ssl_context(certfile, keyfile):
+    # retomada de sessão: tickets no TLS 1.3 e no 1.2 (o cache de ids de sessão do
+    # OpenSSL também fica ligado). Um cliente que volta com o ticket pula a troca de
+    # chaves e a assinatura com a chave do certificado
     sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     sslctx.load_cert_chain(certfile, keyfile)
-    server = await asyncio.start_server(handle_reader, host, port, ssl=sslctx)
+    sslctx.options &= ~ssl.OP_NO_TICKET
+    sslctx.num_tickets = TLS_TICKETS
+    return sslctx
+
+
+async def main(
+    certfile,
+    keyfile,
+    host="0.0.0.0",
+    port=4433,
+    reuse_port=False,
+    metrics_port=None,
+    ws_port=None,
+):
+    sslctx = TLS or server_ssl_context(certfile, keyfile)
+    # o FrameReader lê em blocos de FRAME_CHUNK; com o limite do StreamReader no
+    # mesmo tamanho, o socket para de ser lido quando o handler não acompanha
+    server = await asyncio.start_server(
+        handle_reader, host, port, ssl=sslctx, limit=FRAME_CHUNK, reuse_port=reuse_port
+    )
     addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-    print(f"Servidor rodando em {addrs}")
-    async with server:
-        await server.serve_forever()
+    log.info("Servidor rodando em %s (pid %d)", addrs, os.getpid())
+    ws_server = None
+    if ws_port is not None:
+        # mesmo TLS, mesmos handlers; permessage-deflate e ping/pong da biblioteca
+        ws_server = await ws_serve(
+            handle_websocket,
+            host,
+            ws_port,
+            ssl=sslctx,
+            compression="deflate",
+            ping_interval=WS_PING,
+            ping_timeout=WS_PING,
+            max_size=LIMITS.max_message or MAX_FRAME,
+            reuse_port=reuse_port,
+        )
+        log.info("WebSocket em wss://%s:%d", host, ws_port)
+    metrics_server = None
+    if metrics_port is not None:
+        # só local: as métricas não passam por TLS
+        metrics_server = await asyncio.start_server(handle_metrics, "127.0.0.1", metrics_port)
+        log.info("Métricas em http://127.0.0.1:%d/metrics", metrics_port)
+    background = []
+    if LIMITS.idle_timeout:
+        background.append(asyncio.create_task(idle_loop(LIMITS.idle_timeout)))
+    if CLUSTER is None:
+        background.append(asyncio.create_task(flush_loop(0.05)))
+        background.append(asyncio.create_task(KEYSTORE.run()))
+        background.append(asyncio.create_task(sweep_loop(3600)))
+    try:
+        # o servidor já está aceitando conexões; serve_forever não é usado porque,
+        # ao ser cancelado, ele espera todas as conexões (persistentes) fecharem.
+        # Um worker também termina se perder o broker
+        await (CLUSTER.closed if CLUSTER is not None else asyncio.Future())
+    finally:
+        server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if ws_server is not None:
+            ws_server.close()
+        for conn in list(CONNECTIONS):
+            conn.close()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(server.wait_closed(), 2)
+        for task in background:
+            task.cancel()
+        if CLUSTER is None:
+            BLOBS.close()
+            KEYSTORE.close()
 
 
-if __name__ == "__main__":
+async def worker_main(worker_id, socket_path, args):
+    global CLUSTER
+    CLUSTER = ClusterLink(socket_path, worker_id, on_broker_message)
+    await CLUSTER.connect()
+    # cada worker expõe as próprias métricas, em metrics-port + id
+    metrics_port = None if args.metrics_port is None else args.metrics_port + worker_id
+    await main(
+        args.certfile,
+        args.keyfile,
+        args.host,
+        args.port,
+        reuse_port=True,
+        metrics_port=metrics_port,
+        ws_port=args.ws_port,
+    )
+
+
+async def broker_main(socket_path):
+    global BROKER
+    BROKER = Broker(socket_path, on_worker_message)
+    await BROKER.start()
+    log.info("Broker do cluster em %s", socket_path)
+    flusher = asyncio.create_task(flush_loop(0.05))
+    key_writer = asyncio.create_task(KEYSTORE.run())
+    sweeper = asyncio.create_task(sweep_loop(3600))
+    try:
+        await asyncio.Future()
+    finally:
+        flusher.cancel()
+        key_writer.cancel()
+        sweeper.cancel()
+        await BROKER.close()
+        BLOBS.close()
+        KEYSTORE.close()
+
+
+def set_limits(limits):
+    global LIMITS, SEND_RATE
+    LIMITS = limits
+    SEND_RATE = RateLimiter(limits.rate, limits.burst)
+
+
+def open_tls(args):
+    global TLS
+    TLS = server_ssl_context(args.certfile, args.keyfile)
+
+
+def open_files(args):
+    # antes do fork: os workers gravam e leem os chunks direto do disco
+    global FILES
+    FILES = FileSpool(args.files_dir, max_size=args.max_file_size, ttl=args.file_ttl)
+
+
+def open_state(args):
+    global BLOBS
     init_pubkeys()
+    BLOBS = open_store(args.store, args.store_path, args.queue_quota, args.group_log_quota)
+    init_groups()
+
+
+def run_cluster(args):
+    # os workers são criados antes de abrir SQLite/arquivos: nada é herdado pelo fork
+    socket_path = os.path.join(tempfile.gettempdir(), f"chat-seguro-{os.getpid()}.sock")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    pids = []
+    for worker_id in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            # SIGTERM do mestre encerra como Ctrl+C, passando pelo finally
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            writer = setup_logging(args.log_level, args.log_sample, prefix=f"[w{worker_id}] ")
+            try:
+                asyncio.run(worker_main(worker_id, socket_path, args))
+            except (KeyboardInterrupt, ConnectionError):
+                pass
+            finally:
+                writer.stop()
+                os._exit(0)
+        pids.append(pid)
+    log_writer = setup_logging(args.log_level, args.log_sample, prefix="[mestre] ")
+    open_state(args)
+    try:
+        asyncio.run(broker_main(socket_path))
+    except KeyboardInterrupt:
+        log.info("Shutting down...")
+    finally:
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        log_writer.stop()
+
+
+if __name__ == "__main__":
     p = ArgumentParser()
     p.add_argument("certfile")
     p.add_argument("keyfile")
     p.add_argument("--host", default="0.0.0.0")
     p.add_argument("--port", default=4433, type=int)
+    p.add_argument(
+        "--ws-port",
+        type=int,
+        help="porta do gateway WebSocket (wss://), com os mesmos handlers e estado",
+    )
+    p.add_argument("--store", choices=["sqlite", "memory"], default="sqlite")
+    p.add_argument("--store-path", default="offline.db")
+    p.add_argument(
+        "--queue-quota",
+        type=int,
+        default=10000,
+        help="máximo de mensagens offline pendentes por destinatário",
+    )
+    p.add_argument(
+        "--group-log-quota",
+        type=int,
+        default=10000,
+        help="mensagens guardadas no log de cada grupo; cheio, as mais antigas saem",
+    )
+    p.add_argument("--files-dir", default="files", help="diretório dos chunks de anexos")
+    p.add_argument(
+        "--max-file-size",
+        type=int,
+        default=1024 * 1024 * 1024,
+        help="tamanho máximo em bytes de um anexo (já cifrado)",
+    )
+    p.add_argument(
+        "--file-ttl",
+        type=float,
+        default=7 * 24 * 3600,
+        help="segundos até um anexo ser apagado (0 mantém para sempre)",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processos servindo a mesma porta (SO_REUSEPORT) com estado no mestre",
+    )
+    p.add_argument(
+        "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"]
+    )
+    p.add_argument(
+        "--log-sample",
+        type=float,
+        default=1.0,
+        help="fração (0-1) das linhas de log por mensagem que são escritas",
+    )
+    p.add_argument(
+        "--metrics-port",
+        type=int,
+        help="porta local (127.0.0.1) com as métricas no formato do Prometheus",
+    )
+    # limites contra clientes lentos ou abusivos (0 desliga); com --workers,
+    # conexões e taxa valem por worker
+    defaults = Limits()
+    p.add_argument(
+        "--max-connections",
+        type=int,
+        default=defaults.max_connections,
+        help="conexões simultâneas; as excedentes são recusadas",
+    )
+    p.add_argument(
+        "--max-message",
+        type=int,
+        default=defaults.max_message,
+        help="tamanho máximo em bytes de um frame binário ou linha JSON",
+    )
+    p.add_argument(
+        "--rate",
+        type=float,
+        default=defaults.rate,
+        help="envios (send_blob/send_blobs/send_group_blob) por segundo por cliente",
+    )
+    p.add_argument(
+        "--burst",
+        type=int,
+        default=defaults.burst,
+        help="rajada de envios aceita acima de --rate",
+    )
+    p.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=defaults.idle_timeout,
+        help="segundos sem pedidos até a conexão ser fechada",
+    )
+    p.add_argument(
+        "--write-high-water",
+        type=int,
+        default=defaults.write_high_water,
+        help="bytes de saída pendentes a partir dos quais as respostas esperam o cliente ler",
+    )
+    p.add_argument(
+        "--max-write-buffer",
+        type=int,
+        default=defaults.max_write_buffer,
+        help="bytes de saída pendentes a partir dos quais um cliente inscrito é desconectado",
+    )
     args = p.parse_args()
-    try:
-        asyncio.run(main(args.certfile, args.keyfile, args.host, args.port))
-    except KeyboardInterrupt:
-        print("Shutting down...")
+    if not 0 <= args.max_message <= MAX_FRAME:
+        p.error(f"--max-message deve estar entre 0 e {MAX_FRAME}")
+    set_limits(
+        Limits(
+            max_connections=args.max_connections,
+            max_message=args.max_message,
+            rate=args.rate,
+            burst=args.burst,
+            idle_timeout=args.idle_timeout,
+            write_high_water=args.write_high_water,
+            max_write_buffer=args.max_write_buffer,
+        )
+    )
+    open_tls(args)
+    open_files(args)
+    if args.workers > 1:
+        run_cluster(args)
+    else:
+        log_writer = setup_logging(args.log_level, args.log_sample)
+        open_state(args)
+        try:
+            asyncio.run(
+                main(
+                    args.certfile,
+                    args.keyfile,
+                    args.host,
+                    args.port,
+                    metrics_port=args.metrics_port,
+                    ws_port=args.ws_port,
+                )
+            )
+        except KeyboardInterrupt:
+            log.info("Shutting down...")
+        finally:
+            log_writer.stop()
@@ -0,0 +1,606 @@
+import itertools
+import json
+import logging
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("storage")
+
+# Backends da fila offline (BLOBS). Os dois expõem a mesma interface:
+#   append(recipient, item) -> bool   False se a cota do destinatário estourou
+#   fetch(recipient, limit=None, max_bytes=None) -> [item]   entrega e confirma até
+#       limit pendentes e até max_bytes de blob (a primeira sempre vem, mesmo maior)
+#   pending(recipient) -> int
+#   stats() -> {"offline_pending", "offline_recipients", "group_backlog"}
+#   flush() / close()
+#
+# Mensagens de grupo são gravadas uma única vez num log por grupo; cada membro
+# tem um cursor (próximo seq a ler), de modo que o fan-out não copia nada:
+#   add_group(group_id, group)                 registra o grupo, cursores no fim do log
+#   load_groups() -> {group_id: group}
+#   append_group(group_id, item) -> seq        com o log cheio (group_quota entradas),
+#       descarta as mais antigas: quem não leu as perde, e o grupo não para
+#   fetch_group(group_id, member, limit=None, max_bytes=None) -> [item]   lê a partir
+#       do cursor e o avança (limit e max_bytes como no fetch)
+#   ack_group(group_id, member, next_seq)      membro recebeu por push até next_seq
+#   group_pending(group_id, member) -> int     entradas do log que o membro não leu
+#   update_members(group_id, group, added, removed)   grava a nova lista de membros;
+#       quem entra começa no fim do log (não lê o que veio antes), quem sai perde
+#       o cursor
+
+
+class Queued:
+    # item guardado na memória: um registro com slots no lugar do dict de cada
+    # mensagem, o blob em bytes crus, os ids internados (uma cópia por cliente ou
+    # grupo, não por mensagem; no broker cada item chega com strings novas) e o meta
+    # em JSON compacto, ou None quando vazio, que é o caso comum
+    __slots__ = ("sender", "blob", "meta", "group_id")
+
+    def __init__(self, item):
+        self.sender = sys.intern(item["from"])
+        self.blob = bytes(item["blob"])
+        meta = item.get("meta")
+        self.meta = json.dumps(meta, separators=(",", ":")) if meta else None
+        group_id = item.get("group_id")
+        self.group_id = None if group_id is None else sys.intern(group_id)
+
+    def item(self):
+        if self.group_id is None:
+            return {"from": self.sender, "blob": self.blob, "meta": self.meta_dict()}
+        item = {"from": self.sender, "blob": self.blob, "group_id": self.group_id, "type": "group"}
+        if self.meta is not None:
+            item["meta"] = self.meta_dict()
+        return item
+
+    def meta_dict(self):
+        return {} if self.meta is None else json.loads(self.meta)
+
+
+def within(entries, count, max_bytes):
+    # quantas das primeiras count entradas cabem em max_bytes de blob; a primeira
+    # sempre conta, para uma mensagem grande não travar a fila
+    if max_bytes is None:
+        return count
+    total = 0
+    for i, entry in enumerate(itertools.islice(entries, count)):
+        total += len(entry.blob)
+        if i and total > max_bytes:
+            return i
+    return count
+
+
+class GroupLog:
+    def __init__(self, members, head=0):
+        self.base = head  # seq da primeira entrada ainda guardada
+        self.entries = deque()
+        self.cursors = dict.fromkeys(members, head)
+
+    @property
+    def head(self):
+        return self.base + len(self.entries)
+
+    def read(self, member, limit=None, max_bytes=None):
+        start = max(self.cursors.get(member, self.head), self.base)
+        stop = self.head if limit is None else min(self.head, start + limit)
+        tail = itertools.islice(self.entries, start - self.base, None)
+        stop = start + within(tail, stop - start, max_bytes)
+        self.cursors[member] = stop
+        entries = itertools.islice(self.entries, start - self.base, stop - self.base)
+        return [entry.item() for entry in entries]
+
+    def advance(self, low):
+        # cursores atrás de low pulam para ele (as entradas antes dele vão sair)
+        for member, cursor in self.cursors.items():
+            if cursor < low:
+                self.cursors[member] = low
+
+    def trim(self):
+        # descarta o que todos os membros já leram
+        low = min(self.cursors.values(), default=self.head)
+        while self.base < low and self.entries:
+            self.entries.popleft()
+            self.base += 1
+
+
+class MemoryStore:
+    def __init__(self, quota=None, group_quota=None):
+        self.quota = quota
+        self.group_quota = group_quota
+        self._queues = {}  # recipient -> deque[item]
+        self._groups = {}  # group_id -> GroupLog
+        self._groups_meta = {}
+        self._touched = set()  # grupos com cursores avançados desde o último trim
+
+    def append(self, recipient, item):
+        queue = self._queues.setdefault(recipient, deque())
+        if self.quota is not None and len(queue) >= self.quota:
+            return False
+        queue.append(Queued(item))
+        return True
+
+    def fetch(self, recipient, limit=None, max_bytes=None):
+        queue = self._queues.get(recipient)
+        if not queue:
+            return []
+        count = len(queue) if limit is None else min(limit, len(queue))
+        count = within(queue, count, max_bytes)
+        if count == len(queue):
+            del self._queues[recipient]
+            return [entry.item() for entry in queue]
+        return [queue.popleft().item() for _ in range(count)]
+
+    def pending(self, recipient):
+        return len(self._queues.get(recipient, ()))
+
+    def stats(self):
+        return {
+            "offline_pending": sum(len(q) for q in self._queues.values()),
+            "offline_recipients": sum(1 for q in self._queues.values() if q),
+            "group_backlog": sum(len(log.entries) for log in self._groups.values()),
+        }
+
+    def add_group(self, group_id, group):
+        self._groups_meta[group_id] = group
+        self._groups[group_id] = GroupLog(group["members"])
+
+    def load_groups(self):
+        return dict(self._groups_meta)
+
+    def update_members(self, group_id, group, added, removed):
+        self._groups_meta[group_id] = group
+        log = self._groups[group_id]
+        for member in added:
+            log.cursors.setdefault(member, log.head)
+        for member in removed:
+            log.cursors.pop(member, None)
+        self._touched.add(group_id)
+
+    def append_group(self, group_id, item):
+        log = self._groups[group_id]
+        if self.group_quota is not None and len(log.entries) >= self.group_quota:
+            log.trim()
+            if len(log.entries) >= self.group_quota:
+                # um membro que não lê não pode travar o grupo
+                log.advance(log.head - self.group_quota + 1)
+                log.trim()
+        log.entries.append(Queued(item))
+        return log.head - 1
+
+    def fetch_group(self, group_id, member, limit=None, max_bytes=None):
+        log = self._groups.get(group_id)
+        if log is None or log.cursors.get(member) == log.head:
+            return []
+        self._touched.add(group_id)
+        return log.read(member, limit, max_bytes)
+
+    def group_pending(self, group_id, member):
+        log = self._groups.get(group_id)
+        if log is None or member not in log.cursors:
+            return 0
+        return log.head - max(log.cursors[member], log.base)
+
+    def ack_group(self, group_id, member, next_seq):
+        log = self._groups[group_id]
+        if member not in log.cursors:
+            return  # saiu do grupo enquanto o push ia
+        log.cursors[member] = next_seq
+        self._touched.add(group_id)
+
+    def flush(self):
+        for group_id in self._touched:
+            self._groups[group_id].trim()
+        self._touched.clear()
+
+    def close(self):
+        pass
+
+
+# o ciphertext vai numa coluna BLOB própria; o resto do item, em JSON
+def pack_item(item):
+    meta = {k: v for k, v in item.items() if k != "blob"}
+    return json.dumps(meta), item["blob"]
+
+
+def unpack_item(meta, blob):
+    item = json.loads(meta)
+    item["blob"] = blob
+    return item
+
+
+def take_rows(cursor, max_bytes):
+    # as linhas (..., blob) do cursor até max_bytes de blob, sem ler as seguintes;
+    # a primeira sempre vem
+    rows = []
+    total = 0
+    for row in cursor:
+        total += len(row[-1])
+        if rows and max_bytes is not None and total > max_bytes:
+            break
+        rows.append(row)
+    return rows
+
+
+# Log append-only em SQLite (WAL). Cada destinatário tem um offset com o último
+# id confirmado; fetch só avança o offset e as linhas já entregues são apagadas
+# depois, em lote, pela compactação. As escritas não rodam no event loop: cada
+# uma vira um comando numa lista, e flush() (a cada batch_size escritas ou pelo
+# flush_loop) entrega a lista a uma thread com a sua própria conexão, que a grava
+# numa transação (o commit e o fsync ficam lá). Enquanto um lote grava, o
+# seguinte se acumula. O event loop lê pela outra conexão e completa a leitura
+# com as linhas ainda não gravadas, que ficam em memória até o commit do lote.
+MAX_PENDING_BATCHES = 64  # lotes acumulados (em batch_size) antes de esperar o disco
+
+
+class SQLiteStore:
+    def __init__(self, path, quota=None, group_quota=None, batch_size=256, compact_every=1024):
+        self.quota = quota
+        self.group_quota = group_quota
+        self.batch_size = batch_size
+        self.compact_every = compact_every
+        # uma única thread: os lotes são gravados na ordem
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._executor.submit(self._open_writer, path).result()
+        self._db = sqlite3.connect(path, isolation_level=None)  # leituras, no event loop
+        self._offsets = dict(self._db.execute("SELECT recipient, acked FROM offsets"))
+        self._pending = dict(
+            self._db.execute(
+                """
+                SELECT m.recipient, COUNT(*) FROM messages m
+                LEFT JOIN offsets o ON o.recipient = m.recipient
+                WHERE m.id > COALESCE(o.acked, 0)
+                GROUP BY m.recipient
+                """
+            )
+        )
+        # os ids são dados aqui, não pelo SQLite: a linha ainda não gravada já tem o
+        # seu. Começam acima de qualquer offset, mesmo com a tabela compactada
+        (last_id,) = self._db.execute("SELECT MAX(id) FROM messages").fetchone()
+        self._next_id = max([last_id or 0, *self._offsets.values()]) + 1
+        # só a cabeça do log e os cursores ficam em memória; as mensagens, em disco
+        self._heads = {}  # group_id -> próximo seq
+        self._bases = {}  # group_id -> menor seq ainda guardado
+        self._cursors = {}  # group_id -> {member: next_seq}
+        for group_id, member, next_seq in self._db.execute(
+            "SELECT group_id, member, next_seq FROM group_cursors"
+        ):
+            self._cursors.setdefault(group_id, {})[member] = next_seq
+            self._heads[group_id] = max(self._heads.get(group_id, 0), next_seq)
+        for group_id, base, head in self._db.execute(
+            "SELECT group_id, MIN(seq), MAX(seq) + 1 FROM group_messages GROUP BY group_id"
+        ):
+            self._bases[group_id] = base
+            self._heads[group_id] = max(self._heads.get(group_id, 0), head)
+        # grupo com o log vazio (nunca usado, ou já lido e apagado): a cabeça vem
+        # dos cursores, que podem estar adiante das linhas que sobraram
+        for (group_id,) in self._db.execute("SELECT group_id FROM groups"):
+            self._cursors.setdefault(group_id, {})
+            self._bases.setdefault(group_id, self._heads.setdefault(group_id, 0))
+        self._dirty_cursors = {}  # (group_id, member) -> next_seq ainda não gravado
+        self._acked = set()  # destinatários com linhas já entregues a compactar
+        self._acked_rows = 0
+        self._ops = []  # (sql, parâmetros, executemany) do lote em preparo
+        self._batch = 1  # número do lote em preparo
+        self._committed = 0  # último lote gravado (escrito pela thread)
+        self._writing = None  # Future do lote em gravação
+        self._writing_ops = []  # os comandos dele, para regravar se falhar
+        self._failing = False  # a última gravação falhou (já logado)
+        # linhas de lotes ainda não gravados: recipient -> deque[(id, lote, item, blob)]
+        # e group_id -> deque[(seq, lote, item, blob)]
+        self._recent = {}
+        self._recent_groups = {}
+
+    def _open_writer(self, path):
+        self._wdb = sqlite3.connect(path, isolation_level=None)
+        self._wdb.execute("PRAGMA journal_mode=WAL")
+        self._wdb.execute("PRAGMA synchronous=FULL")
+        self._wdb.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                recipient TEXT NOT NULL,
+                item TEXT NOT NULL,
+                blob BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id);
+            CREATE TABLE IF NOT EXISTS offsets (
+                recipient TEXT PRIMARY KEY,
+                acked INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS groups (
+                group_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS group_messages (
+                group_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                item TEXT NOT NULL,
+                blob BLOB NOT NULL,
+                PRIMARY KEY (group_id, seq)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS group_cursors (
+                group_id TEXT NOT NULL,
+                member TEXT NOT NULL,
+                next_seq INTEGER NOT NULL,
+                PRIMARY KEY (group_id, member)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def _write(self, sql, params, many=False):
+        self._ops.append((sql, params, many))
+
+    def _rows(self, sql, key, start, recent):
+        # linhas (id ou seq, item, blob) a partir de start: as do disco e, depois
+        # delas, as de lotes ainda não gravados (as que o commit já levou ao disco
+        # não se repetem)
+        cursor = self._db.execute(sql, (key, start))
+        last = start - 1
+        try:
+            for row in cursor:
+                last = row[0]
+                yield row
+        finally:
+            cursor.close()
+        for row_id, _, item, blob in recent or ():
+            if row_id > last:
+                yield row_id, item, blob
+
+    def append(self, recipient, item):
+        count = self._pending.get(recipient, 0)
+        if self.quota is not None and count >= self.quota:
+            return False
+        msg_id = self._next_id
+        self._next_id += 1
+        meta, blob = pack_item(item)
+        self._recent.setdefault(recipient, deque()).append((msg_id, self._batch, meta, blob))
+        self._pending[recipient] = count + 1
+        self._write(
+            "INSERT INTO messages (id, recipient, item, blob) VALUES (?, ?, ?, ?)",
+            (msg_id, recipient, meta, blob),
+        )
+        if len(self._ops) >= self.batch_size:
+            self.flush()
+        return True
+
+    def fetch(self, recipient, limit=None, max_bytes=None):
+        if not self._pending.get(recipient):
+            return []
+        rows = self._rows(
+            "SELECT id, item, blob FROM messages WHERE recipient = ? AND id >= ? ORDER BY id",
+            recipient,
+            self._offsets.get(recipient, 0) + 1,
+            self._recent.get(recipient),
+        )
+        rows = take_rows(itertools.islice(rows, limit), max_bytes)
+        if not rows:
+            return []
+        acked = rows[-1][0]
+        self._offsets[recipient] = acked
+        left = self._pending.pop(recipient) - len(rows)
+        if left > 0:
+            self._pending[recipient] = left
+        self._acked.add(recipient)
+        self._acked_rows += len(rows)
+        self._write(
+            "INSERT INTO offsets (recipient, acked) VALUES (?, ?) "
+            "ON CONFLICT (recipient) DO UPDATE SET acked = excluded.acked",
+            (recipient, acked),
+        )
+        if self._acked_rows >= self.compact_every:
+            self.compact()
+        return [unpack_item(item, blob) for _, item, blob in rows]
+
+    def pending(self, recipient):
+        return self._pending.get(recipient, 0)
+
+    def stats(self):
+        # só os contadores em memória: não toca no disco
+        return {
+            "offline_pending": sum(self._pending.values()),
+            "offline_recipients": len(self._pending),
+            "group_backlog": sum(
+                head - self._bases.get(group_id, head) for group_id, head in self._heads.items()
+            ),
+        }
+
+    def add_group(self, group_id, group):
+        head = self._heads.setdefault(group_id, 0)
+        self._bases.setdefault(group_id, head)
+        self._cursors[group_id] = dict.fromkeys(group["members"], head)
+        self._write(
+            "INSERT OR REPLACE INTO groups (group_id, data) VALUES (?, ?)",
+            (group_id, json.dumps(group)),
+        )
+        self._write(
+            "INSERT OR REPLACE INTO group_cursors (group_id, member, next_seq) VALUES (?, ?, ?)",
+            [(group_id, member, head) for member in group["members"]],
+            many=True,
+        )
+
+    def load_groups(self):
+        return {
+            group_id: json.loads(data)
+            for group_id, data in self._db.execute("SELECT group_id, data FROM groups")
+        }
+
+    def update_members(self, group_id, group, added, removed):
+        head = self._heads[group_id]
+        cursors = self._cursors[group_id]
+        self._write("UPDATE groups SET data = ? WHERE group_id = ?", (json.dumps(group), group_id))
+        for member in added:
+            if member not in cursors:
+                cursors[member] = head
+                self._dirty_cursors.pop((group_id, member), None)
+                self._write(
+                    "INSERT OR REPLACE INTO group_cursors (group_id, member, next_seq) "
+                    "VALUES (?, ?, ?)",
+                    (group_id, member, head),
+                )
+        for member in removed:
+            if cursors.pop(member, None) is not None:
+                self._dirty_cursors.pop((group_id, member), None)
+                self._write(
+                    "DELETE FROM group_cursors WHERE group_id = ? AND member = ?",
+                    (group_id, member),
+                )
+
+    def append_group(self, group_id, item):
+        seq = self._heads[group_id]
+        if self.group_quota is not None and seq - self._bases[group_id] >= self.group_quota:
+            self._trim_group(group_id)
+            if seq - self._bases[group_id] >= self.group_quota:
+                # um membro que não lê não pode travar o grupo
+                low = seq - self.group_quota + 1
+                for member, cursor in self._cursors[group_id].items():
+                    if cursor < low:
+                        self._cursors[group_id][member] = low
+                        self._dirty_cursors[(group_id, member)] = low
+                self._trim_group(group_id)
+        meta, blob = pack_item(item)
+        self._recent_groups.setdefault(group_id, deque()).append((seq, self._batch, meta, blob))
+        self._heads[group_id] = seq + 1
+        self._write(
+            "INSERT INTO group_messages (group_id, seq, item, blob) VALUES (?, ?, ?, ?)",
+            (group_id, seq, meta, blob),
+        )
+        if len(self._ops) >= self.batch_size:
+            self.flush()
+        return seq
+
+    def fetch_group(self, group_id, member, limit=None, max_bytes=None):
+        cursors = self._cursors.get(group_id)
+        head = self._heads.get(group_id, 0)
+        if cursors is None or cursors.get(member, head) >= head:
+            return []
+        rows = self._rows(
+            "SELECT seq, item, blob FROM group_messages WHERE group_id = ? AND seq >= ? "
+            "ORDER BY seq",
+            group_id,
+            cursors[member],
+            self._recent_groups.get(group_id),
+        )
+        rows = take_rows(itertools.islice(rows, limit), max_bytes)
+        self.ack_group(group_id, member, rows[-1][0] + 1 if rows else head)
+        return [unpack_item(item, blob) for _, item, blob in rows]
+
+    def group_pending(self, group_id, member):
+        head = self._heads.get(group_id, 0)
+        return head - self._cursors.get(group_id, {}).get(member, head)
+
+    def ack_group(self, group_id, member, next_seq):
+        cursors = self._cursors[group_id]
+        if member not in cursors:
+            return  # saiu do grupo enquanto o push ia
+        cursors[member] = next_seq
+        self._dirty_cursors[(group_id, member)] = next_seq
+
+    def _trim_group(self, group_id):
+        low = min(self._cursors[group_id].values(), default=self._heads[group_id])
+        if low > self._bases[group_id]:
+            self._bases[group_id] = low
+            self._write(
+                "DELETE FROM group_messages WHERE group_id = ? AND seq < ?", (group_id, low)
+            )
+
+    def compact(self):
+        # as leituras filtram pelo offset, então apagar mais tarde não muda nada
+        acked, self._acked = self._acked, set()
+        self._acked_rows = 0
+        for recipient in acked:
+            self._write(
+                "DELETE FROM messages WHERE recipient = ? AND id <= ?",
+                (recipient, self._offsets[recipient]),
+            )
+        # cursores avançados por push/fetch são gravados uma vez por flush,
+        # não uma vez por mensagem entregue
+        if self._dirty_cursors:
+            cursors, self._dirty_cursors = self._dirty_cursors, {}
+            self._write(
+                "UPDATE group_cursors SET next_seq = ? WHERE group_id = ? AND member = ?",
+                [(seq, gid, member) for (gid, member), seq in cursors.items()],
+                many=True,
+            )
+            for group_id in {gid for gid, _ in cursors}:
+                self._trim_group(group_id)
+
+    def _forget_committed(self):
+        # as linhas de lotes já gravados são lidas do disco
+        for recent in (self._recent, self._recent_groups):
+            for key in list(recent):
+                rows = recent[key]
+                while rows and rows[0][1] <= self._committed:
+                    rows.popleft()
+                if not rows:
+                    del recent[key]
+
+    def _commit(self, ops, batch):
+        db = self._wdb
+        db.execute("BEGIN")
+        try:
+            for sql, params, many in ops:
+                if many:
+                    db.executemany(sql, params)
+                else:
+                    db.execute(sql, params)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self._committed = batch
+
+    def flush(self):
+        writing = self._writing
+        if writing is not None:
+            if not writing.done() and len(self._ops) < MAX_PENDING_BATCHES * self.batch_size:
+                return  # o lote seguinte vai quando este terminar
+            # ainda gravando: o disco não acompanha, e aqui o event loop espera, em vez
+            # de a memória crescer sem limite
+            self._writing = None
+            try:
+                writing.result()
+            except Exception:
+                # o _commit desfez a transação: os comandos voltam para a frente da
+                # fila e as linhas continuam em memória até o lote ser regravado
+                self._ops[:0] = self._writing_ops
+                if not self._failing:
+                    log.exception("[FILA] Falha ao gravar a fila offline; tentando de novo")
+                self._failing = True
+            else:
+                if self._failing:
+                    log.warning("[FILA] Gravação da fila offline voltou ao normal")
+                self._failing = False
+            self._forget_committed()
+        if self._acked or self._dirty_cursors:
+            self.compact()
+        if not self._ops:
+            return
+        self._writing_ops, self._ops = self._ops, []
+        self._writing = self._executor.submit(self._commit, self._writing_ops, self._batch)
+        self._batch += 1
+
+    def close(self):
+        if self._writing is not None:
+            try:
+                self._writing.result()
+            except Exception:
+                self._ops[:0] = self._writing_ops  # última tentativa, logo abaixo
+            self._writing = None
+        self.compact()
+        if self._ops:
+            self._executor.submit(self._commit, self._ops, self._batch).result()
+            self._ops = []
+        self._db.close()
+        self._executor.submit(self._close_writer).result()
+        self._executor.shutdown()
+
+    def _close_writer(self):
+        self._wdb.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._wdb.close()
+
+
+def open_store(kind, path=None, quota=None, group_quota=None):
+    if kind == "sqlite":
+        return SQLiteStore(path, quota=quota, group_quota=group_quota)
+    return MemoryStore(quota=quota, group_quota=group_quota)
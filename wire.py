@@ -0,0 +1,256 @@
+import base64
+import json
+import struct
+
+# Protocolo de transporte compartilhado entre cliente e servidor.
+#
+# Modo "json" (padrão): um objeto JSON por linha; valores bytes viajam em base64.
+#
+# Modo "bin1", negociado com {"type": "hello", "proto": "bin1"} logo após a conexão:
+#   frame   := u32 tamanho | payload
+#   payload := u8 tipo | u32 req_id | str from | str to | str group_id
+#              | u32 tamanho_json | json (demais campos) | blobs
+#   str     := u16 tamanho | utf-8   (vazio = campo ausente)
+#   blobs   := (u32 tamanho | bytes)*
+# Valores bytes do objeto (ex.: "blob") não passam pelo JSON: no lugar deles fica
+# {"$b": i} e os bytes crus vão, na ordem, depois do JSON. Assim o servidor lê o
+# cabeçalho de roteamento sem tocar no payload e repassa o ciphertext sem
+# base64 nem cópia para texto.
+
+PROTO_BINARY = "bin1"
+MAX_FRAME = 64 * 1024 * 1024
+FRAME_CHUNK = 256 * 1024  # leitura do socket por vez no FrameReader
+MAX_BATCH = 1000  # itens por get_keys/send_blobs; o cliente divide listas maiores
+
+TYPES = [
+    None,  # 0: sem "type" (respostas) ou tipo desconhecido, que vai no JSON
+    "hello",
+    "publish_key",
+    "get_key",
+    "send_blob",
+    "create_group",
+    "send_group_blob",
+    "fetch_blobs",
+    "subscribe",
+    "list_all",
+    "disconnect",
+    "deliver",
+    "get_keys",
+    "send_blobs",
+    "key_update",
+]
+TYPE_CODES = {name: code for code, name in enumerate(TYPES) if name}
+HEADER_FIELDS = ("from", "to", "group_id")
+
+_HEAD = struct.Struct("!BI")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_EMPTY_STR = _U16.pack(0)
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _bytes_to_b64(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode()
+    raise TypeError(f"{type(value).__name__} não é serializável em JSON")
+
+
+def encode_json(obj):
+    return (json.dumps(obj, default=_bytes_to_b64) + "\n").encode()
+
+
+def decode_json(line):
+    return json.loads(line)
+
+
+_COMPACT = (",", ":")
+_PLAIN = json.JSONEncoder(separators=_COMPACT)
+_BINARY = (bytes, bytearray, memoryview)
+
+
+def _encode_body(rest):
+    # valores bytes viram {"$b": i} e vão para a lista de blobs. A troca é feita
+    # pelo default do próprio encoder JSON (em C), sem percorrer o objeto em
+    # Python; sem bytes, dict ou list no primeiro nível não há o que trocar
+    if not any(isinstance(v, (*_BINARY, dict, list)) for v in rest.values()):
+        return _PLAIN.encode(rest).encode(), ()
+    blobs = []
+
+    def collect(value):
+        if isinstance(value, _BINARY):
+            blobs.append(value)
+            return {"$b": len(blobs) - 1}
+        raise TypeError(f"{type(value).__name__} não é serializável em JSON")
+
+    return json.JSONEncoder(separators=_COMPACT, default=collect).encode(rest).encode(), blobs
+
+
+def encode_frame(obj):
+    rest = dict(obj)
+    mtype = rest.get("type")
+    code = TYPE_CODES.get(mtype, 0)
+    if code:
+        del rest["type"]
+    req_id = rest.pop("req_id", None)
+    if not isinstance(req_id, int) or not 0 < req_id < 2**32:
+        if req_id is not None:
+            rest["req_id"] = req_id
+        req_id = 0
+    parts = [b"", _HEAD.pack(code, req_id)]
+    for field in HEADER_FIELDS:
+        value = rest.get(field)
+        if isinstance(value, str) and value:
+            del rest[field]
+            raw = value.encode()
+            parts += [_U16.pack(len(raw)), raw]
+        else:
+            parts.append(_EMPTY_STR)
+    body, blobs = _encode_body(rest) if rest else (b"", ())
+    parts += [_U32.pack(len(body)), body]
+    for blob in blobs:
+        parts += [_U32.pack(len(blob)), blob]
+    size = sum(map(len, parts))
+    if size > MAX_FRAME:
+        raise FrameError("frame maior que o limite")
+    parts[0] = _U32.pack(size)
+    return b"".join(parts)
+
+
+def decode_header(payload):
+    # só o cabeçalho de roteamento: tipo, req_id, from/to/group_id e onde começa
+    # o restante do frame
+    try:
+        code, req_id = _HEAD.unpack_from(payload, 0)
+        pos = _HEAD.size
+        header = {}
+        if code:
+            header["type"] = TYPES[code]
+        if req_id:
+            header["req_id"] = req_id
+        for field in HEADER_FIELDS:
+            (n,) = _U16.unpack_from(payload, pos)
+            pos += _U16.size
+            if n:
+                header[field] = bytes(payload[pos : pos + n]).decode()
+                pos += n
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise FrameError(f"cabeçalho inválido: {e}") from None
+    return header, pos
+
+
+def decode_body(payload, pos):
+    # o restante do frame (JSON e blobs), a partir da posição devolvida por
+    # decode_header; separado para o servidor decidir só pelo cabeçalho
+    try:
+        (n,) = _U32.unpack_from(payload, pos)
+        pos += _U32.size
+        body = payload[pos : pos + n]
+        pos += n
+        if pos == len(payload):
+            # sem blobs: nada a restaurar, json.loads sem object_hook
+            return json.loads(bytes(body)) if n else {}
+        blobs = []
+        while pos < len(payload):
+            (size,) = _U32.unpack_from(payload, pos)
+            pos += _U32.size
+            blobs.append(bytes(payload[pos : pos + size]))
+            pos += size
+        if pos != len(payload):
+            raise FrameError("frame truncado")
+
+        def restore(d):
+            if len(d) == 1 and "$b" in d:
+                i = d["$b"]
+                # só um índice válido: {"$b": "x"} ou {"$b": -1} não é um blob
+                if type(i) is not int or not 0 <= i < len(blobs):
+                    raise FrameError(f"referência de blob inválida: {i!r}")
+                return blobs[i]
+            return d
+
+        return json.loads(bytes(body), object_hook=restore) if n else {}
+    except (struct.error, IndexError, ValueError) as e:
+        raise FrameError(f"frame inválido: {e}") from None
+
+
+def decode_frame(payload):
+    payload = memoryview(payload)
+    header, pos = decode_header(payload)
+    rest = decode_body(payload, pos)
+    rest.update(header)
+    return rest
+
+
+async def read_frame(reader):
+    # devolve o payload do próximo frame, ou None se a conexão terminou
+    try:
+        (size,) = _U32.unpack(await reader.readexactly(_U32.size))
+    except EOFError:
+        return None
+    if size > MAX_FRAME:
+        raise FrameError("frame maior que o limite")
+    return await reader.readexactly(size)
+
+
+class FrameReader:
+    # Lê linhas JSON ou frames binários de um StreamReader com buffer próprio:
+    # frames que chegam juntos (pipelining) saem do buffer sem um await de leitura
+    # para cada um. Linhas e frames usam o mesmo buffer, então a troca de framing
+    # depois do "hello" não perde o que já foi lido. max_size limita o frame (ou
+    # a linha) e, com isso, o quanto o buffer pode crescer.
+    def __init__(self, reader, chunk=FRAME_CHUNK, max_size=MAX_FRAME):
+        self.reader = reader
+        self.chunk = chunk
+        self.max_size = max_size
+        self.buf = bytearray()
+
+    async def _fill(self):
+        data = await self.reader.read(self.chunk)
+        if data:
+            self.buf += data
+        return bool(data)
+
+    async def read(self):
+        # payload do próximo frame, ou None se a conexão terminou
+        buf = self.buf
+        while True:
+            if len(buf) >= _U32.size:
+                (size,) = _U32.unpack_from(buf, 0)
+                if size > self.max_size:
+                    raise FrameError("frame maior que o limite")
+                end = _U32.size + size
+                if len(buf) >= end:
+                    payload = bytes(buf[_U32.size : end])
+                    del buf[:end]
+                    return payload
+            if not await self._fill():
+                if buf:
+                    raise FrameError("conexão encerrada no meio de um frame")
+                return None
+
+    async def readline(self):
+        # a próxima linha com o "\n"; no fim da conexão, o que sobrou (ou b"")
+        buf = self.buf
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end >= 0:
+                line = bytes(buf[: end + 1])
+                del buf[: end + 1]
+                return line
+            if len(buf) > self.max_size:
+                raise FrameError("linha maior que o limite")
+            start = len(buf)
+            if not await self._fill():
+                line = bytes(buf)
+                buf.clear()
+                return line
+
+
+def blob_bytes(value):
+    # no modo binário o blob já chega em bytes; no modo json, em base64
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value)